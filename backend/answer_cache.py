@@ -0,0 +1,141 @@
+"""
+Semantic cache of verified answers to policy questions.
+
+Policy questions repeat constantly with small wording changes. Each entry keeps
+the query's normalized MiniLM embedding, the answer that passed
+check_answer_relevance and how long the full graph took to produce it. A lookup
+scores the incoming query against every live entry with one matrix-vector
+product and returns the best one at or above ANSWER_CACHE_THRESHOLD (cosine).
+
+Entries expire after ANSWER_CACHE_TTL_SECONDS and the least recently used ones
+are evicted beyond ANSWER_CACHE_MAX_ENTRIES. The whole cache is dropped when the
+content of the policy source file changes (its mtime is checked at most every
+ANSWER_CACHE_SOURCE_CHECK_SECONDS, and the content hash only when the mtime
+moved), so answers never outlive the policies they were drawn from.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from vector_store import normalize_rows
+
+ANSWER_CACHE_ENABLED = bool(int(os.getenv("ANSWER_CACHE_ENABLED", "1")))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.92"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_SOURCE_CHECK_SECONDS = float(os.getenv("ANSWER_CACHE_SOURCE_CHECK_SECONDS", "5"))
+
+
+@dataclass
+class CachedAnswer:
+    query: str
+    answer: str
+    vector: np.ndarray
+    expires_at: float
+    produce_ms: float  # graph latency when the answer was first produced
+    hits: int = 0
+
+
+def _file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class SemanticAnswerCache:
+    def __init__(self, source_path: str, threshold: float = ANSWER_CACHE_THRESHOLD,
+                 ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 source_check_interval: float = ANSWER_CACHE_SOURCE_CHECK_SECONDS):
+        """source_path: file the cached answers depend on (db/policies.md); any content change clears the cache."""
+        self.source_path = source_path
+        self.threshold = threshold
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.source_check_interval = source_check_interval
+        self._entries = OrderedDict()  # query -> CachedAnswer, least recently used first
+        self._lock = threading.Lock()
+        # Stacked vectors of _entries, rebuilt on the first lookup after a change
+        self._matrix = None
+        self._keys = []
+        self._source_mtime = None
+        self._source_digest = None
+        self._next_source_check = 0.0
+
+    def _check_source(self) -> None:
+        # Caller holds self._lock.
+        now = time.monotonic()
+        if now < self._next_source_check:
+            return
+        self._next_source_check = now + self.source_check_interval
+        try:
+            mtime = os.stat(self.source_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._source_mtime:
+            return
+        digest = _file_digest(self.source_path)
+        if self._source_digest is not None and digest != self._source_digest:
+            self._entries.clear()
+            self._matrix = None
+            print(f"Answer cache cleared: {self.source_path} changed.")
+        self._source_mtime = mtime
+        self._source_digest = digest
+
+    def _evict_expired(self, now: float) -> None:
+        expired = [key for key, entry in self._entries.items() if entry.expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def lookup(self, vector: Sequence[float]) -> Optional[Tuple[CachedAnswer, float]]:
+        """Return (entry, similarity) for the closest live entry at or above the threshold, else None."""
+        query = normalize_rows(vector)[0]
+        with self._lock:
+            self._check_source()
+            self._evict_expired(time.monotonic())
+            if not self._entries:
+                return None
+            if self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = np.stack([self._entries[key].vector for key in self._keys])
+            scores = self._matrix @ query
+            best = int(np.argmax(scores))
+            similarity = float(scores[best])
+            if similarity < self.threshold:
+                return None
+            key = self._keys[best]
+            entry = self._entries[key]
+            entry.hits += 1
+            # Recency only changes the eviction order, not the row order of _matrix.
+            self._entries.move_to_end(key)
+            return entry, similarity
+
+    def put(self, query: str, answer: str, vector: Sequence[float], produce_ms: float) -> None:
+        with self._lock:
+            self._check_source()
+            self._entries[query] = CachedAnswer(
+                query=query,
+                answer=answer,
+                vector=normalize_rows(vector)[0],
+                expires_at=time.monotonic() + self.ttl,
+                produce_ms=produce_ms,
+            )
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
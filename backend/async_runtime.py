@@ -0,0 +1,57 @@
+"""
+Shared background event loop for LangGraph runs.
+
+Flask executes every `async def` view on its own short-lived event loop, so
+coroutines awaited there are serialized per request thread and cannot share
+loop-bound resources such as the AsyncConnectionPool. Graph runs are submitted
+to one long-lived loop instead, which lets a single worker keep many
+conversations in flight while they wait on Gemini and Postgres.
+
+Blocking work inside nodes must be offloaded (asyncio.to_thread) so it does
+not stall every other conversation on this loop.
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ddtrace import tracer
+
+GRAPH_OFFLOAD_WORKERS = int(os.getenv("GRAPH_OFFLOAD_WORKERS", "16"))
+
+_loop = None
+_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Return the shared loop, starting its thread on first use."""
+    global _loop
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(
+                    ThreadPoolExecutor(max_workers=GRAPH_OFFLOAD_WORKERS, thread_name_prefix="graph-offload")
+                )
+                thread = threading.Thread(target=loop.run_forever, name="graph-event-loop", daemon=True)
+                thread.start()
+                _loop = loop
+    return _loop
+
+
+async def _run_with_context(coro, parent_context):
+    # Re-activate the request's trace so node spans land in the same flame graph.
+    if parent_context is not None:
+        tracer.context_provider.activate(parent_context)
+    return await coro
+
+
+def submit(coro, parent_context=None):
+    """Schedule coro on the shared loop and return a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(_run_with_context(coro, parent_context), get_loop())
+
+
+async def run(coro, parent_context=None):
+    """Await coro on the shared loop from any other event loop (e.g. a Flask view)."""
+    return await asyncio.wrap_future(submit(coro, parent_context))
@@ -0,0 +1,104 @@
+"""
+Offline evaluation of the kNN pre-router (knn_router.py).
+
+Every labelled example from the corpora is routed leave-one-out (its own row is
+excluded from the neighbours) with the real MiniLM embeddings. For each
+confidence threshold reports:
+
+  coverage   share of queries routed locally (the rest go to the LLM router)
+  accuracy   share of those local routes that match the label
+  leaks      security examples routed locally (should be 0)
+  route ms   expected routing latency per query: embedding + kNN, plus the LLM
+             router's median latency for the fallback share (--llm-sample)
+
+plus per-query embedding and kNN latency, and the examples misrouted at the
+chosen threshold.
+
+Only labels in --labels (default KNN_ROUTER_LABELS) are routed locally, as in
+the graph; pass --labels policy,database,request,statement to see what
+routing every label locally would give.
+
+Usage: python bench_knn_router.py [--thresholds 0.6,0.7,0.8,0.9,0.95] [--k 5]
+       [--min-similarity 0.5] [--labels policy,statement] [--llm-sample 10] [--show-errors 0.9]
+--llm-sample times classify_query + get_rag_type on that many examples and
+requires GOOGLE_API_KEY; without it route ms covers the local part only.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import numpy as np
+
+from knn_router import (KNN_ROUTER_K, KNN_ROUTER_LABELS, KNN_ROUTER_MIN_SIMILARITY, KNN_ROUTER_THRESHOLD, SECURITY,
+                        KNNRouter, load_examples)
+from rag import get_embeddings
+
+
+async def llm_route_ms(queries) -> float:
+    """Median latency of the chain router (classify_query, then get_rag_type for questions)."""
+    from bench_router import run_chain
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        await run_chain({"query": query, "user_identifier": "test@example.com", "rag_type": "", "is_question": ""})
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--thresholds", default="0.6,0.7,0.8,0.9,0.95")
+    parser.add_argument("--k", type=int, default=KNN_ROUTER_K)
+    parser.add_argument("--min-similarity", type=float, default=KNN_ROUTER_MIN_SIMILARITY)
+    parser.add_argument("--labels", default=KNN_ROUTER_LABELS, help="labels routed locally")
+    parser.add_argument("--llm-sample", type=int, default=0, help="examples to time the LLM router on")
+    parser.add_argument("--show-errors", type=float, default=KNN_ROUTER_THRESHOLD,
+                        help="list misrouted examples at this threshold")
+    args = parser.parse_args()
+
+    examples = load_examples()
+    embeddings = get_embeddings()
+    start = time.perf_counter()
+    router = KNNRouter(embeddings, examples, k=args.k, min_similarity=args.min_similarity, labels=args.labels)
+    print(f"{len(examples)} labelled examples, index built in {time.perf_counter() - start:.2f}s")
+
+    texts = [text for text, _ in examples]
+    labels = [label for _, label in examples]
+    start = time.perf_counter()
+    vectors = np.asarray([embeddings.embed_query(text) for text in texts])
+    embed_ms = (time.perf_counter() - start) * 1000 / len(texts)
+    start = time.perf_counter()
+    for i, vector in enumerate(vectors):
+        router.guess_vectors([vector], exclude=[i])
+    knn_ms = (time.perf_counter() - start) * 1000 / len(texts)
+    guesses = router.guess_vectors(vectors, exclude=np.arange(len(texts)))
+    print(f"per query: embed {embed_ms:.2f} ms, kNN {knn_ms:.3f} ms")
+
+    llm_ms = None
+    if args.llm_sample:
+        llm_ms = asyncio.run(llm_route_ms(texts[::max(1, len(texts) // args.llm_sample)][:args.llm_sample]))
+        print(f"LLM router p50: {llm_ms:.0f} ms")
+
+    print(f"{'threshold':>9} | {'coverage':>8} | {'accuracy':>8} | {'leaks':>5} | {'route ms':>8}")
+    for threshold in (float(t) for t in args.thresholds.split(",")):
+        decided = [
+            (guess, label) for guess, label in zip(guesses, labels)
+            if guess.route is not None and guess.confidence >= threshold
+        ]
+        coverage = len(decided) / len(labels)
+        accuracy = sum(guess.label == label for guess, label in decided) / len(decided) if decided else float("nan")
+        leaks = sum(label == SECURITY for _, label in decided)
+        route_ms = embed_ms + knn_ms + ((1 - coverage) * llm_ms if llm_ms is not None else 0.0)
+        print(f"{threshold:>9.2f} | {coverage:>8.1%} | {accuracy:>8.1%} | {leaks:>5} | {route_ms:>8.1f}")
+
+    print(f"misrouted at {args.show_errors}:")
+    for text, label, guess in zip(texts, labels, guesses):
+        if guess.route is not None and guess.confidence >= args.show_errors and guess.label != label:
+            print(f"  {label:>9} -> {guess.label:<9} ({guess.confidence:.2f}) {text}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmark round trips and latency of order writes against item count.
+
+Compares the previous per-item write path (customer SELECT, order INSERT, one
+INSERT per item, total UPDATE, COMMIT) with the single autocommit statement used
+by place_new_order. Round trips are counted from the libpq protocol trace as
+switches from client to server messages.
+
+Usage: python bench_order_writes.py [--runs 20] [--items 1,2,5,10,25,50]
+Requires the supportdb database (see db/Dockerfile). Orders created by the
+benchmark are deleted when it finishes.
+"""
+
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+import uuid
+from decimal import Decimal
+
+import psycopg
+from psycopg.pq import Trace
+
+from db_utils import DB_SETTINGS, write_new_order
+
+BENCH_KEY_PREFIX = "bench:"
+
+
+async def legacy_write(conn, customer_email, resolved, status):
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT customer_id FROM customers WHERE email = %s", (customer_email,))
+        customer_id = (await cur.fetchone())[0]
+        await cur.execute(
+            """
+            INSERT INTO orders (customer_id, status, total, currency, idempotency_key)
+            VALUES (%s, %s, 0, 'USD', %s)
+            RETURNING order_id
+            """,
+            (customer_id, status, BENCH_KEY_PREFIX + uuid.uuid4().hex),
+        )
+        order_id = (await cur.fetchone())[0]
+        total = Decimal("0")
+        for item in resolved:
+            await cur.execute(
+                """
+                INSERT INTO order_items (order_id, product_id, quantity, unit_price)
+                VALUES (%s, %s, %s, %s)
+                """,
+                (order_id, item["product_id"], item["qty"], item["price"]),
+            )
+            total += item["price"] * item["qty"]
+        await cur.execute("UPDATE orders SET total = %s WHERE order_id = %s", (total, order_id))
+    await conn.commit()
+
+
+async def batched_write(conn, customer_email, resolved, status):
+    await write_new_order(conn, customer_email, resolved, status, BENCH_KEY_PREFIX + uuid.uuid4().hex)
+
+
+def count_round_trips(trace_file) -> int:
+    # Each switch from frontend (F) to backend (B) messages is one network round trip;
+    # messages sent back to back (BEGIN + statements) only switch direction once.
+    round_trips = 0
+    previous = None
+    for line in trace_file:
+        direction = line.split("\t", 1)[0]
+        if direction == "B" and previous == "F":
+            round_trips += 1
+        if direction in ("F", "B"):
+            previous = direction
+    return round_trips
+
+
+async def measure(conn, write, customer_email, resolved, runs):
+    latencies = []
+    round_trips = 0
+    with tempfile.TemporaryFile("w+") as trace_file:
+        for i in range(runs):
+            # Trace only the first run; the protocol exchange is identical for the rest.
+            if i == 0:
+                conn.pgconn.trace(trace_file.fileno())
+                conn.pgconn.set_trace_flags(Trace.SUPPRESS_TIMESTAMPS)
+            start = time.perf_counter()
+            await write(conn, customer_email, resolved, "processing")
+            latencies.append((time.perf_counter() - start) * 1000)
+            if i == 0:
+                conn.pgconn.untrace()
+                trace_file.seek(0)
+                round_trips = count_round_trips(trace_file)
+    return round_trips, statistics.median(latencies), max(latencies)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--items", default="1,2,5,10,25,50")
+    args = parser.parse_args()
+    item_counts = [int(n) for n in args.items.split(",")]
+
+    conn = await psycopg.AsyncConnection.connect(**DB_SETTINGS)
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT email FROM customers ORDER BY customer_id LIMIT 1")
+            customer_email = (await cur.fetchone())[0]
+            await cur.execute("SELECT product_id, unit_price FROM products ORDER BY product_id")
+            products = await cur.fetchall()
+        await conn.commit()
+
+        print(f"{'items':>5} | {'path':<8} | {'round trips':>11} | {'p50 ms':>8} | {'max ms':>8}")
+        for count in item_counts:
+            resolved = [
+                {"product_id": products[i % len(products)][0], "price": Decimal(products[i % len(products)][1]), "qty": 1}
+                for i in range(count)
+            ]
+            for name, write in (("legacy", legacy_write), ("batched", batched_write)):
+                round_trips, p50, worst = await measure(conn, write, customer_email, resolved, args.runs)
+                print(f"{count:>5} | {name:<8} | {round_trips:>11} | {p50:>8.2f} | {worst:>8.2f}")
+    finally:
+        async with conn.cursor() as cur:
+            await cur.execute("DELETE FROM orders WHERE idempotency_key LIKE %s", (BENCH_KEY_PREFIX + "%",))
+        await conn.commit()
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+"""
+Benchmark the structured router against the classify_query/get_rag_type chain.
+
+Every numbered query in queries.md is routed both ways against the live Gemini
+API:
+
+  chain       classify_query, then get_rag_type (only for questions) alongside
+              the check_query_classification critic, as the graph runs them
+  structured  a single route_query call (ROUTER_MODE=structured)
+
+Reports p50/p95 latency and total cost per path (from the cost ledger) and how
+often both paths pick the same route (policy, database, no, request or
+Security Violation), listing the disagreements. The LLM reply cache is
+disabled so every call reaches the model.
+
+Usage: python bench_router.py [--limit 20] [--user test@example.com] [--concurrency 4]
+Requires GOOGLE_API_KEY.
+"""
+
+import os
+
+os.environ["LLM_CACHE_ENABLED"] = "0"
+
+import argparse
+import asyncio
+import re
+import statistics
+import time
+import uuid
+
+import cost_ledger
+from critic import check_query_classification
+from llm import classify_query, get_rag_type, route_decision, route_query
+
+
+def load_queries(path: str = "queries.md") -> list:
+    with open(path, encoding="utf-8") as f:
+        return [m.group(1).strip() for m in (re.match(r"\d+\.\s+(.*)", line) for line in f) if m]
+
+
+async def run_chain(state: dict) -> str:
+    classified = await classify_query(state)
+    state = {**state, **classified}
+    if state["is_question"] != "yes":
+        await check_query_classification(state)
+        return state["is_question"]
+    routed, _ = await asyncio.gather(get_rag_type(state), check_query_classification(state))
+    return routed["rag_type"]
+
+
+async def run_structured(state: dict) -> str:
+    return route_decision({**state, **(await route_query(state))})
+
+
+async def measure(name: str, route, query: str, user: str) -> tuple:
+    request_id = f"bench-{name}-{uuid.uuid4().hex}"
+    state = {"query": query, "user_identifier": user, "rag_type": "", "is_question": ""}
+    start = time.perf_counter()
+    with cost_ledger.request_scope(request_id, "bench", user):
+        decision = await route(state)
+    latency_ms = (time.perf_counter() - start) * 1000
+    totals = cost_ledger.ledger.totals("request", request_id)["request"].get(request_id, {})
+    return decision, latency_ms, totals.get("cost", 0.0), totals.get("calls", 0)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--user", default="test@example.com")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    queries = load_queries()[:args.limit]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def both(query):
+        async with semaphore:
+            return await measure("chain", run_chain, query, args.user), await measure("structured", run_structured, query, args.user)
+
+    results = await asyncio.gather(*(both(query) for query in queries))
+
+    print(f"{len(queries)} queries")
+    print(f"{'path':<11} | {'p50 ms':>8} | {'p95 ms':>8} | {'calls':>5} | {'cost $':>10}")
+    for i, name in enumerate(("chain", "structured")):
+        latencies = sorted(r[i][1] for r in results)
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        calls = sum(r[i][3] for r in results)
+        cost = sum(r[i][2] for r in results)
+        print(f"{name:<11} | {statistics.median(latencies):>8.0f} | {p95:>8.0f} | {calls:>5} | {cost:>10.6f}")
+    agree = sum(chain[0] == structured[0] for chain, structured in results)
+    print(f"route agreement: {agree}/{len(queries)} ({agree / len(queries):.1%})")
+    for query, (chain, structured) in zip(queries, results):
+        if chain[0] != structured[0]:
+            print(f"  chain={chain[0]!r:<22} structured={structured[0]!r:<22} {query}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
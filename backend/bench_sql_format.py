@@ -0,0 +1,131 @@
+"""
+Benchmark SQL result formats (sql_format.py) on the sql_queries.md corpus.
+
+For every numbered question, generate_query writes the SQL once and the guarded
+executor runs it against the database. The same rows are then serialized in
+each format and answered by get_answer's prompt:
+
+  rows   "col: val, col: val" per row (the original format)
+  table  column names once, type-aware values
+
+Reports per format the estimated context tokens, the input tokens get_answer
+was billed for, and how often the answer agrees with the one from the rows
+format: same numbers mentioned and fuzzy similarity (rapidfuzz
+token_set_ratio) at or above --agreement. Disagreements are listed.
+--budget applies the token budget (and SQL_RESULT_OVERFLOW) to every format.
+
+Usage: python bench_sql_format.py [--limit 30] [--user alex.martin@example.com] [--budget 2000]
+       [--agreement 85] [--concurrency 4]
+Requires GOOGLE_API_KEY and the database. The LLM reply cache and the SQL plan
+cache are disabled so every question is generated and answered afresh.
+"""
+
+import os
+
+os.environ["LLM_CACHE_ENABLED"] = "0"
+os.environ["SQL_PLAN_CACHE_ENABLED"] = "0"
+
+import argparse
+import asyncio
+import re
+
+from rapidfuzz import fuzz
+
+import async_runtime
+import llm_gateway
+from bench_router import load_queries
+from db_utils import get_async_db_conn
+from llm import ANSWER_PROMPT, generate_sql
+from llm_gateway import FLASH_MODEL
+from sql_format import SQL_RESULT_FORMATS, SQL_RESULT_OVERFLOW, estimate_tokens, serialize
+from sql_guard import QueryRejected, run_guarded
+
+BASELINE = "rows"
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+def numbers(text: str) -> set:
+    return {match.replace(",", "") for match in _NUMBER.findall(text)}
+
+
+def agrees(answer: str, baseline: str, threshold: float) -> bool:
+    return numbers(answer) == numbers(baseline) and fuzz.token_set_ratio(answer, baseline) >= threshold
+
+
+async def fetch(query: str, user: str):
+    """Generate and run the SQL for query; None when it fails or is refused."""
+    state = {"query": query, "user_identifier": user}
+    generated = await generate_sql(state)
+    try:
+        async with get_async_db_conn() as conn:
+            return await run_guarded(conn, generated["sql_query"])
+    except QueryRejected as exc:
+        print(f"  skipped ({exc}): {query}")
+    except Exception as exc:
+        print(f"  skipped ({type(exc).__name__}): {query}")
+    return None
+
+
+async def answer(query: str, context: str) -> tuple:
+    prompt = ANSWER_PROMPT.invoke({"context": context, "query": query})
+    result = await llm_gateway.call("get_answer", FLASH_MODEL, prompt)
+    return result.text, result.input_tokens
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--user", default="alex.martin@example.com")
+    parser.add_argument("--budget", type=int, default=0, help="token budget per result (0: none)")
+    parser.add_argument("--agreement", type=float, default=85.0, help="minimum token_set_ratio")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    queries = load_queries("sql_queries.md")[:args.limit]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run(query):
+        async with semaphore:
+            result = await fetch(query, args.user)
+            if result is None:
+                return None
+            contexts = {
+                fmt: serialize(result.columns, result.rows, fmt=fmt, token_budget=args.budget,
+                               overflow=SQL_RESULT_OVERFLOW, more_rows=result.truncated)
+                for fmt in SQL_RESULT_FORMATS
+            }
+            answers = await asyncio.gather(*(answer(query, contexts[fmt]) for fmt in SQL_RESULT_FORMATS))
+            return contexts, dict(zip(SQL_RESULT_FORMATS, answers))
+
+    results = [
+        (query, result) for query, result in zip(queries, await asyncio.gather(*(run(q) for q in queries)))
+        if result is not None
+    ]
+    if not results:
+        print("No query produced a result.")
+        return
+
+    print(f"{len(results)}/{len(queries)} queries answered")
+    baseline_tokens = sum(answers[BASELINE][1] for _, (_, answers) in results)
+    print(f"{'format':<6} | {'context est':>11} | {'input tokens':>12} | {'vs rows':>7} | {'agreement':>9}")
+    for fmt in SQL_RESULT_FORMATS:
+        estimated = sum(estimate_tokens(contexts[fmt]) for _, (contexts, _) in results)
+        billed = sum(answers[fmt][1] for _, (_, answers) in results)
+        agree = sum(
+            agrees(answers[fmt][0], answers[BASELINE][0], args.agreement) for _, (_, answers) in results
+        )
+        print(f"{fmt:<6} | {estimated:>11} | {billed:>12} | {billed / baseline_tokens - 1:>+7.1%} | "
+              f"{agree / len(results):>9.1%}")
+
+    for fmt in SQL_RESULT_FORMATS:
+        if fmt == BASELINE:
+            continue
+        for query, (_, answers) in results:
+            if not agrees(answers[fmt][0], answers[BASELINE][0], args.agreement):
+                print(f"  {fmt} disagrees: {query}")
+                print(f"    {BASELINE}: {answers[BASELINE][0]}")
+                print(f"    {fmt}: {answers[fmt][0]}")
+
+
+if __name__ == "__main__":
+    # The async DB pool lives on the shared loop
+    async_runtime.submit(main()).result()
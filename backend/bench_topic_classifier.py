@@ -0,0 +1,118 @@
+"""
+Benchmark the embedding topic classifier against zero-shot BART-MNLI.
+
+Every bullet in tag_queries.md is classified by both paths. Reports load time,
+single-message p50 latency, per-message latency when the whole set is run as
+one batch, accuracy against the section headings (sections that map to no
+label only count towards agreement) and how often the two paths agree on the
+top topic.
+
+When the embedding prototypes are seeded from tag_queries.md the queries are
+split in two folds and each fold is classified with prototypes built from the
+other, so accuracy is never measured on the seed examples themselves.
+
+Usage: python bench_topic_classifier.py [--runs 5] [--prototypes tag_queries|labels] [--skip-bart]
+"""
+
+import argparse
+import statistics
+import time
+
+from topic_classifier import (
+    CANDIDATE_LABELS,
+    TOPIC_PROTOTYPES_PATH,
+    BartTopicClassifier,
+    EmbeddingTopicClassifier,
+)
+
+
+def load_queries(path):
+    """Return [(query, gold label or None)] for every bullet in path."""
+    queries = []
+    gold = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("## "):
+                heading = line[3:].strip()
+                gold = next((label for label in CANDIDATE_LABELS if heading.startswith(label)), None)
+            elif line.startswith(("* ", "- ")):
+                queries.append((line[2:].strip(), gold))
+    return queries
+
+
+def time_classifier(classify, texts, runs):
+    classify(texts[:1])  # warmup
+    single = []
+    for _ in range(runs):
+        for text in texts:
+            start = time.perf_counter()
+            classify([text])
+            single.append((time.perf_counter() - start) * 1000)
+    batch = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        classify(texts)
+        batch.append((time.perf_counter() - start) * 1000 / len(texts))
+    return statistics.median(single), statistics.median(batch)
+
+
+def build_embedding_folds(embeddings, queries, seeded):
+    """Return one classifier per query: built from the other fold when seeded, label names otherwise."""
+    if not seeded:
+        classifier = EmbeddingTopicClassifier(embeddings)
+        return [classifier] * len(queries), classifier
+    folds = []
+    for fold in (0, 1):
+        prototypes = {}
+        for i, (text, gold) in enumerate(queries):
+            if gold and i % 2 != fold:
+                prototypes.setdefault(gold, []).append(text)
+        folds.append(EmbeddingTopicClassifier(embeddings, prototypes=prototypes))
+    return [folds[i % 2] for i in range(len(queries))], folds[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--prototypes", choices=("tag_queries", "labels"), default="tag_queries")
+    parser.add_argument("--skip-bart", action="store_true", help="only time the embedding path")
+    args = parser.parse_args()
+
+    queries = load_queries(TOPIC_PROTOTYPES_PATH)
+    texts = [text for text, _ in queries]
+    labelled = [i for i, (_, gold) in enumerate(queries) if gold]
+
+    from rag import get_embeddings
+
+    start = time.perf_counter()
+    embeddings = get_embeddings()
+    per_query, timed = build_embedding_folds(embeddings, queries, args.prototypes == "tag_queries")
+    embedding_load = time.perf_counter() - start
+    embedding_top = [classifier([text])[0]["labels"][0] for classifier, text in zip(per_query, texts)]
+    results = [("embedding", embedding_load, time_classifier(timed, texts, args.runs), embedding_top)]
+
+    if not args.skip_bart:
+        start = time.perf_counter()
+        bart = BartTopicClassifier()
+        bart_load = time.perf_counter() - start
+        bart_top = [result["labels"][0] for result in bart(texts)]
+        results.append(("bart", bart_load, time_classifier(bart, texts, args.runs), bart_top))
+
+    print(f"{len(texts)} queries ({len(labelled)} labelled), prototypes: {args.prototypes}")
+    print(f"{'path':<9} | {'load s':>7} | {'single p50 ms':>13} | {'batch ms/msg':>12} | {'accuracy':>8}")
+    for name, load, (single, batch), top in results:
+        accuracy = sum(top[i] == queries[i][1] for i in labelled) / len(labelled)
+        print(f"{name:<9} | {load:>7.2f} | {single:>13.2f} | {batch:>12.2f} | {accuracy:>8.1%}")
+
+    if len(results) == 2:
+        embedding_top, bart_top = results[0][3], results[1][3]
+        agree = sum(a == b for a, b in zip(embedding_top, bart_top))
+        print(f"agreement with bart: {agree}/{len(texts)} ({agree / len(texts):.1%})")
+        for text, a, b in zip(texts, embedding_top, bart_top):
+            if a != b:
+                print(f"  embedding={a!r:<22} bart={b!r:<22} {text}")
+
+
+if __name__ == "__main__":
+    main()
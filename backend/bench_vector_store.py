@@ -0,0 +1,96 @@
+"""
+Benchmark policy retrieval backends across corpus sizes.
+
+Uses synthetic unit vectors (MiniLM's 384 dimensions by default) drawn around
+topic centres, like real article embeddings, so the numbers measure search
+alone, not the embedding model. For each corpus size reports
+per-query latency of:
+
+  inmemory   langchain InMemoryVectorStore (the previous backend)
+  exact      MatrixVectorStore, one matrix-vector product + argpartition
+  batch      MatrixVectorStore.batch_similarity_search_by_vector_with_score, per query
+  ivf        MatrixVectorStore with the approximate IVF index, plus recall@k vs exact
+
+Usage: python bench_vector_store.py [--sizes 1000,10000,100000] [--queries 200] [--k 3]
+       [--dim 384] [--inmemory-max 20000]
+"""
+
+import argparse
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import InMemoryVectorStore
+
+from vector_store import MatrixVectorStore, normalize_rows
+
+
+class LookupEmbeddings(Embeddings):
+    """Returns precomputed vectors for texts "0".."n-1" (the documents) so no model runs."""
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def embed_documents(self, texts):
+        return [self.matrix[int(text)].tolist() for text in texts]
+
+    def embed_query(self, text):
+        return self.matrix[int(text)].tolist()
+
+
+def per_query_ms(search, queries):
+    start = time.perf_counter()
+    for query in queries:
+        search(query)
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--inmemory-max", type=int, default=20000, help="skip InMemoryVectorStore above this size")
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    print(f"{'docs':>8} | {'inmemory ms':>11} | {'exact ms':>8} | {'batch ms':>8} | {'ivf ms':>7} | {'ivf build s':>11} | {'recall@k':>8}")
+    for size in (int(n) for n in args.sizes.split(",")):
+        centres = rng.standard_normal((max(1, size // 100), args.dim))
+        matrix = normalize_rows(centres[rng.integers(0, len(centres), size)] + rng.standard_normal((size, args.dim)))
+        texts = [str(i) for i in range(size)]
+        metadatas = [{} for _ in texts]
+        # Queries are perturbed corpus rows, so each has a meaningful nearest neighbourhood.
+        queries = normalize_rows(matrix[rng.integers(0, size, args.queries)] + 0.5 * rng.standard_normal((args.queries, args.dim)) / np.sqrt(args.dim))
+        query_lists = queries.tolist()
+
+        inmemory_ms = float("nan")
+        if size <= args.inmemory_max:
+            inmemory = InMemoryVectorStore(LookupEmbeddings(matrix))
+            inmemory.add_texts(texts)
+            inmemory_ms = per_query_ms(lambda q: inmemory.similarity_search_by_vector(q, k=args.k), query_lists)
+
+        exact = MatrixVectorStore(LookupEmbeddings(matrix), texts, metadatas, matrix, approximate=False)
+        exact_ms = per_query_ms(lambda q: exact.similarity_search_by_vector_with_score(q, k=args.k), query_lists)
+        start = time.perf_counter()
+        expected = exact.batch_similarity_search_by_vector_with_score(query_lists, k=args.k)
+        batch_ms = (time.perf_counter() - start) * 1000 / len(query_lists)
+
+        ivf = MatrixVectorStore(LookupEmbeddings(matrix), texts, metadatas, matrix, approximate=True)
+        start = time.perf_counter()
+        ivf.similarity_search_by_vector_with_score(query_lists[0], k=args.k)  # builds the index
+        build_s = time.perf_counter() - start
+        ivf_ms = per_query_ms(lambda q: ivf.similarity_search_by_vector_with_score(q, k=args.k), query_lists)
+        found = [ivf.similarity_search_by_vector_with_score(q, k=args.k) for q in query_lists]
+        hits = sum(
+            len({doc.id for doc, _ in want} & {doc.id for doc, _ in got})
+            for want, got in zip(expected, found)
+        )
+        recall = hits / (len(query_lists) * min(args.k, size))
+
+        print(f"{size:>8} | {inmemory_ms:>11.3f} | {exact_ms:>8.3f} | {batch_ms:>8.3f} | {ivf_ms:>7.3f} | {build_s:>11.2f} | {recall:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
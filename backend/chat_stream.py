@@ -0,0 +1,130 @@
+"""
+Server-Sent Events for /api/chat/stream.
+
+The graph runs on the shared loop like /api/chat, but with astream() instead
+of ainvoke(), and every event is pushed onto a thread-safe queue that the Flask
+response generator drains:
+
+  event: status   {"node": ..., plus is_question/rag_type/route_source once routed}
+                  after each graph step
+  event: token    {"node": ..., "text": ...} for each delta of get_answer and
+                  process_request (llm_gateway.stream_tokens)
+  event: done     {"prompt", "reply", "request_id", "received_at", "ttft_ms", "total_ms"}
+  event: error    {"error": ...} if the graph failed
+
+Time to first token (request received -> first token queued) is reported as
+chatbot.chat.ttft_ms and on the chat.stream span. Replies that are not
+generated token by token (answer cache hits, security violations) count their
+done event as the first token, tagged source:final.
+"""
+
+import json
+import os
+import queue
+import time
+from datetime import datetime, timezone
+from typing import Iterator
+
+from datadog import statsd
+from ddtrace import tracer
+
+import async_runtime
+import cost_ledger
+import llm_gateway
+from llm import chatagent
+
+CHAT_STREAM_KEEPALIVE_SECONDS = float(os.getenv("CHAT_STREAM_KEEPALIVE_SECONDS", "15"))
+
+# State fields worth surfacing in status events (routing decisions, not payloads)
+STATUS_FIELDS = ("is_question", "rag_type", "route_source", "answer_cache_hit")
+
+_END = object()
+
+
+def sse(event: str, data: dict) -> str:
+    """Format one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class ChatStream:
+    def __init__(self, state: dict, received: float):
+        """state: the initial graph state; received: time.perf_counter() when the request arrived."""
+        self.state = state
+        self.received = received
+        self.events = queue.Queue()
+        self.ttft_ms = None
+        self.tokens = 0
+        self.span = None
+
+    def _elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.received) * 1000
+
+    def _first_token(self, source: str) -> None:
+        if self.ttft_ms is not None:
+            return
+        self.ttft_ms = self._elapsed_ms()
+        if self.span is not None:
+            self.span.set_metric("chat.ttft_ms", self.ttft_ms)
+            self.span.set_tag("chat.ttft_source", source)
+        statsd.distribution("chatbot.chat.ttft_ms", self.ttft_ms, tags=["source:{}".format(source)])
+
+    def _on_token(self, node: str, text: str) -> None:
+        self._first_token("tokens")
+        self.tokens += 1
+        self.events.put(("token", {"node": node, "text": text}))
+
+    async def run(self) -> None:
+        """Run the graph, queueing status and token events, then done (or error)."""
+        state = self.state
+        with tracer.trace("chat.stream") as span:
+            self.span = span
+            try:
+                with cost_ledger.request_scope(state["request_id"], state["session_id"], state["user_identifier"]):
+                    with llm_gateway.stream_tokens(self._on_token):
+                        final = state
+                        async for mode, chunk in chatagent.astream(state, stream_mode=["updates", "values"]):
+                            if mode == "values":
+                                final = chunk
+                                continue
+                            for node, update in chunk.items():
+                                status = {"node": node}
+                                status.update(
+                                    (field, update[field]) for field in STATUS_FIELDS
+                                    if isinstance(update, dict) and field in update
+                                )
+                                self.events.put(("status", status))
+                self._first_token("final")
+                total_ms = self._elapsed_ms()
+                span.set_metric("chat.total_ms", total_ms)
+                span.set_metric("chat.stream_tokens", self.tokens)
+                statsd.distribution("chatbot.chat.stream_total_ms", total_ms)
+                self.events.put(("done", {
+                    "prompt": state["query"],
+                    "reply": final["answer"],
+                    "request_id": state["request_id"],
+                    "received_at": datetime.now(timezone.utc).isoformat(),
+                    "ttft_ms": round(self.ttft_ms, 1),
+                    "total_ms": round(total_ms, 1),
+                }))
+            except Exception as exc:
+                span.set_exc_info(type(exc), exc, exc.__traceback__)
+                print(f"Streaming chat failed: {exc!r}")
+                self.events.put(("error", {"error": "Something went wrong. Please try again."}))
+            finally:
+                self.events.put(_END)
+
+    def start(self, parent_context=None) -> None:
+        """Schedule the graph on the shared loop; events_sse() can be consumed from any thread."""
+        async_runtime.submit(self.run(), parent_context)
+
+    def events_sse(self) -> Iterator[str]:
+        """Yield the queued events as SSE text, with keep-alive comments while the graph is quiet."""
+        while True:
+            try:
+                event = self.events.get(timeout=CHAT_STREAM_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if event is _END:
+                return
+            yield sse(*event)
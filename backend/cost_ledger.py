@@ -0,0 +1,180 @@
+"""
+In-process LLM cost accounting.
+
+- PricingTable: cost-per-mil.json loaded once and reloaded only when the file's
+  mtime changes (checked at most every PRICING_RELOAD_CHECK_SECONDS).
+- CostLedger: per-call usage is appended to a deque (an atomic operation under
+  the GIL, so the hot path takes no lock) and folded into totals by request,
+  session, user, graph node and model whenever totals are read or flushed.
+
+request_scope() binds the request/session/user for every call made inside it;
+LangGraph copies the context into each node task, so nodes do not need to pass
+it along.
+"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from datadog import statsd
+
+PRICING_PATH = os.getenv("COST_PER_MIL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cost-per-mil.json"))
+PRICING_RELOAD_CHECK_SECONDS = float(os.getenv("PRICING_RELOAD_CHECK_SECONDS", "5"))
+COST_LEDGER_MAX_KEYS = int(os.getenv("COST_LEDGER_MAX_KEYS", "10000"))
+COST_FLUSH_INTERVAL_SECONDS = float(os.getenv("COST_FLUSH_INTERVAL_SECONDS", "60"))
+
+DIMENSIONS = ("request", "session", "user", "node", "model")
+
+_scope = contextvars.ContextVar("cost_scope", default={})
+
+
+class PricingTable:
+    def __init__(self, path: str = PRICING_PATH, check_interval: float = PRICING_RELOAD_CHECK_SECONDS):
+        self.path = path
+        self.check_interval = check_interval
+        self._prices = {}
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            mtime = os.stat(self.path).st_mtime
+            if mtime != self._mtime:
+                with open(self.path, "r") as f:
+                    self._prices = json.load(f)
+                self._mtime = mtime
+            self._next_check = now + self.check_interval
+
+    def get(self, model_name: str) -> dict:
+        self._maybe_reload()
+        return self._prices[model_name]
+
+    def cost(self, input_tokens: int, output_tokens: int, model_name: str) -> float:
+        price = self.get(model_name)
+        return (price["input"] * input_tokens / 1_000_000) + (price["output"] * output_tokens / 1_000_000)
+
+
+class CostLedger:
+    def __init__(self, max_keys: int = COST_LEDGER_MAX_KEYS):
+        self.max_keys = max_keys
+        self._events = deque()
+        # Only readers take this lock; record() never does.
+        self._fold_lock = threading.Lock()
+        self._totals = {dim: OrderedDict() for dim in DIMENSIONS}
+        # (node, model) -> [calls, input_tokens, output_tokens, cost] since the last flush
+        self._unflushed = {}
+
+    def record(self, node: str, model: str, input_tokens: int, output_tokens: int, cost: float) -> None:
+        """Queue one call's usage; unknown token counts (the gateway's -1) count as 0."""
+        input_tokens, output_tokens = max(input_tokens, 0), max(output_tokens, 0)
+        cost = max(cost, 0.0)
+        scope = _scope.get()
+        self._events.append((
+            {
+                "request": scope.get("request_id"),
+                "session": scope.get("session_id"),
+                "user": scope.get("user"),
+                "node": node,
+                "model": model,
+            },
+            input_tokens,
+            output_tokens,
+            cost,
+        ))
+
+    def _add(self, table: OrderedDict, key, input_tokens: int, output_tokens: int, cost: float) -> None:
+        entry = table.get(key)
+        if entry is None:
+            entry = table[key] = {"calls": 0, "input_tokens": 0, "output_tokens": 0, "cost": 0.0}
+            # Request/session/user keys grow without bound; keep the most recent ones.
+            if len(table) > self.max_keys:
+                table.popitem(last=False)
+        else:
+            table.move_to_end(key)
+        entry["calls"] += 1
+        entry["input_tokens"] += input_tokens
+        entry["output_tokens"] += output_tokens
+        entry["cost"] += cost
+
+    def _fold(self) -> None:
+        # Caller holds _fold_lock.
+        while True:
+            try:
+                keys, input_tokens, output_tokens, cost = self._events.popleft()
+            except IndexError:
+                return
+            for dim in DIMENSIONS:
+                if keys[dim] is not None:
+                    self._add(self._totals[dim], keys[dim], input_tokens, output_tokens, cost)
+            pending = self._unflushed.setdefault((keys["node"], keys["model"]), [0, 0, 0, 0.0])
+            pending[0] += 1
+            pending[1] += input_tokens
+            pending[2] += output_tokens
+            pending[3] += cost
+
+    def totals(self, dimension: str = None, key: str = None) -> dict:
+        """
+        Output: {dimension: {key: {calls, input_tokens, output_tokens, cost}}}, narrowed
+        to one dimension (and one key) when given.
+        """
+        if dimension is not None and dimension not in DIMENSIONS:
+            raise ValueError(f"Unknown dimension '{dimension}'; expected one of {', '.join(DIMENSIONS)}")
+        with self._fold_lock:
+            self._fold()
+            dims = [dimension] if dimension else DIMENSIONS
+            result = {}
+            for dim in dims:
+                table = self._totals[dim]
+                if key is not None:
+                    result[dim] = {key: dict(table[key])} if key in table else {}
+                else:
+                    result[dim] = {k: dict(v) for k, v in table.items()}
+            return result
+
+    def flush(self) -> None:
+        """Emit per-node/model deltas since the last flush as statsd counters."""
+        with self._fold_lock:
+            self._fold()
+            pending, self._unflushed = self._unflushed, {}
+        for (node, model), (calls, input_tokens, output_tokens, cost) in pending.items():
+            tags = ["node:{}".format(node), "model:{}".format(model)]
+            statsd.increment("chatbot.llm.calls", calls, tags=tags)
+            statsd.increment("chatbot.llm.input_tokens", input_tokens, tags=tags)
+            statsd.increment("chatbot.llm.output_tokens", output_tokens, tags=tags)
+            statsd.increment("chatbot.llm.cost", cost, tags=tags)
+
+
+pricing = PricingTable()
+ledger = CostLedger()
+
+
+@contextmanager
+def request_scope(request_id: str = None, session_id: str = None, user: str = None):
+    """Attribute every LLM call made inside this block to the given request/session/user."""
+    token = _scope.set({"request_id": request_id, "session_id": session_id, "user": user})
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def start_flusher(interval_seconds: float = COST_FLUSH_INTERVAL_SECONDS) -> threading.Thread:
+    """Flush ledger deltas to statsd from a daemon thread every interval_seconds."""
+    def _loop():
+        while True:
+            time.sleep(interval_seconds)
+            ledger.flush()
+
+    thread = threading.Thread(target=_loop, name="cost-ledger-flush", daemon=True)
+    thread.start()
+    return thread
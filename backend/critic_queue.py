@@ -0,0 +1,154 @@
+"""
+Background evaluation queue for the critics.
+
+check_query_classification, check_rag_relevance and check_answer_relevance run
+on the pro model, yet their verdicts only end up as span tags. With
+CRITIC_MODE=deferred the graph hands them to this queue and returns as soon as
+the answer is ready; the evaluations run afterwards on the shared graph loop.
+
+- At most CRITIC_QUEUE_MAX_PENDING jobs wait or run at once; further jobs are
+  dropped (chatbot.critic_queue.dropped) so a slow pro model cannot build up
+  unbounded work. CRITIC_QUEUE_WORKERS of them call the model concurrently and
+  each is abandoned after CRITIC_QUEUE_TIMEOUT_SECONDS.
+- Each job runs under the trace context captured at submit time, inside a
+  critic.deferred span, so the critic spans land in the request's trace even
+  though the request span has already finished. Verdicts are also attached to
+  the original LLMObs span with record_evaluation().
+- The cost scope is copied along with the context, so critic calls are still
+  attributed to the request in the cost ledger.
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import os
+import threading
+import time
+
+from datadog import statsd
+from ddtrace import tracer
+from ddtrace.llmobs import LLMObs
+
+import async_runtime
+
+CRITIC_MODE = os.getenv("CRITIC_MODE", "inline")
+CRITIC_MODES = ("inline", "deferred")
+CRITIC_QUEUE_MAX_PENDING = int(os.getenv("CRITIC_QUEUE_MAX_PENDING", "1000"))
+CRITIC_QUEUE_WORKERS = int(os.getenv("CRITIC_QUEUE_WORKERS", "4"))
+CRITIC_QUEUE_TIMEOUT_SECONDS = float(os.getenv("CRITIC_QUEUE_TIMEOUT_SECONDS", "120"))
+CRITIC_QUEUE_DRAIN_SECONDS = float(os.getenv("CRITIC_QUEUE_DRAIN_SECONDS", "10"))
+
+
+class CriticQueue:
+    def __init__(self, max_pending: int = CRITIC_QUEUE_MAX_PENDING, workers: int = CRITIC_QUEUE_WORKERS,
+                 timeout_seconds: float = CRITIC_QUEUE_TIMEOUT_SECONDS):
+        self.max_pending = max_pending
+        self.workers = workers
+        self.timeout = timeout_seconds
+        self._pending = 0
+        self._lock = threading.Lock()
+        # Bound to the shared loop, so created there on first use
+        self._slots = None
+        self._futures = set()
+
+    def submit(self, name: str, make_job, parent_context=None) -> bool:
+        """
+        Queue make_job() (a zero-argument callable returning a coroutine) to run in the background.
+        parent_context: trace context the job's spans are parented to (defaults to the current one).
+        Returns False when the queue is full and the job was dropped.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                dropped = True
+            else:
+                dropped = False
+                self._pending += 1
+                depth = self._pending
+        tags = ["critic:{}".format(name)]
+        if dropped:
+            statsd.increment("chatbot.critic_queue.dropped", tags=tags)
+            return False
+        statsd.gauge("chatbot.critic_queue.depth", depth)
+        if parent_context is None:
+            parent_context = tracer.current_trace_context()
+        future = async_runtime.submit(self._run(name, make_job, time.monotonic()), parent_context)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return True
+
+    def _done(self, future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Deferred critic job crashed: {future.exception()!r}")
+        with self._lock:
+            self._pending -= 1
+            self._futures.discard(future)
+            depth = self._pending
+        statsd.gauge("chatbot.critic_queue.depth", depth)
+
+    async def _run(self, name: str, make_job, enqueued_at: float) -> None:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        tags = ["critic:{}".format(name)]
+        async with self._slots:
+            wait_ms = (time.monotonic() - enqueued_at) * 1000
+            with tracer.trace("critic.deferred", resource=name) as span:
+                span.set_metric("critic_queue.wait_ms", wait_ms)
+                statsd.distribution("chatbot.critic_queue.wait_ms", wait_ms, tags=tags)
+                start = time.perf_counter()
+                try:
+                    await asyncio.wait_for(make_job(), self.timeout)
+                except Exception as exc:
+                    # Evaluations are best effort; the user already has the answer.
+                    span.set_tag("critic.error", type(exc).__name__)
+                    statsd.increment("chatbot.critic_queue.failed", tags=tags)
+                    print(f"Deferred critic {name} failed: {exc!r}")
+                statsd.distribution("chatbot.critic_queue.run_ms", (time.perf_counter() - start) * 1000, tags=tags)
+
+    def pending(self) -> int:
+        return self._pending
+
+    def drain(self, timeout: float = None) -> bool:
+        """Block until every queued job has finished (e.g. before exit or in a benchmark). Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                futures = list(self._futures)
+            if not futures:
+                return True
+            for future in futures:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    future.result(remaining)
+                except concurrent.futures.TimeoutError:
+                    return False
+                except BaseException:
+                    pass  # reported by _done
+
+
+def record_evaluation(span_context, label: str, value, sample_weight: float = 1.0) -> None:
+    """
+    Attach a critic verdict to an LLMObs span exported (LLMObs.export_span) while the request ran,
+    tagged with the critic's sampling weight (see critic_sampling).
+    """
+    if span_context is None:
+        return
+    try:
+        LLMObs.submit_evaluation(
+            span_context=span_context,
+            label=label,
+            metric_type="categorical",
+            value=str(value),
+            tags={"critic.sample_weight": str(sample_weight)},
+        )
+    except Exception as exc:
+        print(f"Could not submit evaluation {label}: {exc!r}")
+
+
+critic_queue = CriticQueue()
+
+
+@atexit.register
+def _drain_on_shutdown() -> None:
+    if critic_queue.pending() and not critic_queue.drain(CRITIC_QUEUE_DRAIN_SECONDS):
+        print(f"Exiting with {critic_queue.pending()} deferred critic evaluations unfinished.")
@@ -0,0 +1,173 @@
+"""
+Stratified sampling for the LLM-as-judge critics.
+
+Every critic runs on the pro model, so evaluating 100% of traffic roughly
+doubles the LLM cost of a request. Monitors only need unbiased rates, so each
+critic is run for a sample of requests instead:
+
+  - CRITIC_SAMPLE_RATE is the default probability of evaluating a request and
+    CRITIC_SAMPLE_RATES overrides it per critic
+    ("check_answer_relevance=0.1,check_rag_relevance=0.05").
+  - CRITIC_STRATUM_RATES sets rates for strata of rag_type and user.topic
+    ("rag_type:database=0.2,topic:Billing & Account=0.5"). When several rules
+    match, the highest rate wins, so small strata can be oversampled.
+  - CRITIC_ALWAYS_EVALUATE lists rules that bypass sampling: new_session (the
+    first message of a session seen by this worker), security (queries routed
+    as "Security Violation") and low_confidence (router output outside the
+    expected labels, or a kNN pre-router confidence below
+    CRITIC_LOW_CONFIDENCE).
+
+One uniform draw per request (a hash of request_id when known) is shared by
+all critics, so at equal rates a request is judged by all of them or none.
+Each evaluated span carries critic.sample_weight = 1 / rate (1 for
+always-evaluate rules); summing it instead of counting spans gives unbiased
+(Horvitz-Thompson) estimates of the full-traffic counts.
+"""
+
+import hashlib
+import os
+import random
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from datadog import statsd
+
+CRITIC_SAMPLE_RATE = float(os.getenv("CRITIC_SAMPLE_RATE", "1.0"))
+CRITIC_SAMPLE_RATES = os.getenv("CRITIC_SAMPLE_RATES", "")
+CRITIC_STRATUM_RATES = os.getenv("CRITIC_STRATUM_RATES", "")
+CRITIC_ALWAYS_EVALUATE = os.getenv("CRITIC_ALWAYS_EVALUATE", "new_session,security,low_confidence")
+CRITIC_SEEN_SESSIONS = int(os.getenv("CRITIC_SEEN_SESSIONS", "10000"))
+CRITIC_LOW_CONFIDENCE = float(os.getenv("CRITIC_LOW_CONFIDENCE", "0.5"))
+
+ALWAYS_EVALUATE_RULES = ("new_session", "security", "low_confidence")
+STRATA = ("rag_type", "topic")
+
+ROUTE_LABELS = ("yes", "no", "request", "Security Violation")
+RAG_TYPES = ("policy", "database")
+
+
+def _rate(value: str, name: str) -> float:
+    rate = float(value)
+    if not 0.0 < rate <= 1.0:
+        raise ValueError(f"Sample rate for {name} must be in (0, 1], got {rate}")
+    return rate
+
+
+def parse_rates(spec: str) -> Dict[str, float]:
+    """"name=0.1,other=0.5" -> {"name": 0.1, "other": 0.5}. Names may contain spaces."""
+    rates = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, value = item.rpartition("=")
+        rates[name.strip()] = _rate(value, name.strip())
+    return rates
+
+
+def parse_stratum_rates(spec: str) -> Dict[Tuple[str, str], float]:
+    """"rag_type:database=0.2" -> {("rag_type", "database"): 0.2}. Raises ValueError for unknown strata."""
+    rates = {}
+    for name, rate in parse_rates(spec).items():
+        stratum, _, value = name.partition(":")
+        if stratum not in STRATA:
+            raise ValueError(f"CRITIC_STRATUM_RATES keys must start with one of {', '.join(STRATA)}, got {name!r}")
+        rates[(stratum, value.strip())] = rate
+    return rates
+
+
+@dataclass
+class SamplingDecision:
+    evaluate: bool
+    rate: float
+    weight: float  # 1 / rate when evaluated, 0 otherwise
+    reason: str  # "always:<rule>", "stratum:<stratum>=<value>" or "critic"
+
+
+class CriticSampler:
+    def __init__(self, default_rate: float = CRITIC_SAMPLE_RATE, critic_rates: str = CRITIC_SAMPLE_RATES,
+                 stratum_rates: str = CRITIC_STRATUM_RATES, always: str = CRITIC_ALWAYS_EVALUATE,
+                 seen_sessions: int = CRITIC_SEEN_SESSIONS, low_confidence: float = CRITIC_LOW_CONFIDENCE):
+        self.default_rate = _rate(default_rate, "CRITIC_SAMPLE_RATE")
+        self.critic_rates = parse_rates(critic_rates)
+        self.stratum_rates = parse_stratum_rates(stratum_rates)
+        self.always = tuple(rule.strip() for rule in always.split(",") if rule.strip())
+        unknown = set(self.always) - set(ALWAYS_EVALUATE_RULES)
+        if unknown:
+            raise ValueError(f"CRITIC_ALWAYS_EVALUATE rules must be among {', '.join(ALWAYS_EVALUATE_RULES)}")
+        self.max_seen_sessions = seen_sessions
+        self.low_confidence = low_confidence
+        # session_id -> request_id of the first message this worker saw for it
+        self._seen_sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def needs_topic(self) -> bool:
+        """Whether decide() uses the topic stratum (so callers can skip classifying the query)."""
+        return any(stratum == "topic" for stratum, _ in self.stratum_rates)
+
+    def _first_message(self, state: dict) -> bool:
+        session_id = state.get('session_id')
+        if not session_id:
+            return False
+        request_id = state.get('request_id')
+        with self._lock:
+            first_request = self._seen_sessions.get(session_id)
+            if first_request is None:
+                self._seen_sessions[session_id] = request_id
+                if len(self._seen_sessions) > self.max_seen_sessions:
+                    self._seen_sessions.popitem(last=False)
+                return True
+            self._seen_sessions.move_to_end(session_id)
+        # Every critic of the first request counts as new, not just the first one asked.
+        return request_id is not None and first_request == request_id
+
+    def _always_rule(self, state: dict) -> Optional[str]:
+        if "new_session" in self.always and self._first_message(state):
+            return "new_session"
+        if "security" in self.always and state.get('is_question') == "Security Violation":
+            return "security"
+        confidence = state.get('route_confidence')
+        # rag_type is still empty when the query critic runs right after classify_query (chain router)
+        rag_type = state.get('rag_type')
+        if "low_confidence" in self.always and (
+            state.get('is_question') not in ROUTE_LABELS
+            or (state.get('is_question') == "yes" and rag_type and rag_type not in RAG_TYPES)
+            or (confidence is not None and confidence < self.low_confidence)
+        ):
+            return "low_confidence"
+        return None
+
+    @staticmethod
+    def _draw(state: dict) -> float:
+        request_id = state.get('request_id')
+        if not request_id:
+            return random.random()
+        digest = hashlib.blake2b(str(request_id).encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") / 2 ** 64
+
+    def decide(self, critic: str, state: dict, topic: str = None) -> SamplingDecision:
+        """
+        Purpose: decide whether critic should evaluate this request.
+        Input: the graph state (request_id, session_id, is_question, rag_type) and the query's topic, if known.
+        Output: SamplingDecision; its weight is what the critic's span should carry.
+        """
+        rule = self._always_rule(state)
+        if rule is not None:
+            decision = SamplingDecision(True, 1.0, 1.0, "always:" + rule)
+        else:
+            rate = self.critic_rates.get(critic, self.default_rate)
+            reason = "critic"
+            for stratum, value in (("rag_type", state.get('rag_type')), ("topic", topic)):
+                stratum_rate = self.stratum_rates.get((stratum, value))
+                if stratum_rate is not None and stratum_rate > rate:
+                    rate, reason = stratum_rate, f"stratum:{stratum}={value}"
+            evaluate = rate >= 1.0 or self._draw(state) < rate
+            decision = SamplingDecision(evaluate, rate, 1.0 / rate if evaluate else 0.0, reason)
+        tags = ["critic:{}".format(critic), "reason:{}".format(decision.reason.partition("=")[0])]
+        statsd.increment("chatbot.critic.sampled" if decision.evaluate else "chatbot.critic.skipped", tags=tags)
+        return decision
+
+
+sampler = CriticSampler()
@@ -58,7 +58,9 @@ CREATE TABLE IF NOT EXISTS orders (
   status TEXT NOT NULL DEFAULT 'processing',
   total NUMERIC(12,2) NOT NULL DEFAULT 0,
   currency TEXT NOT NULL DEFAULT 'USD',
-  placed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+  placed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  -- Set by the order tools so a retried tool call cannot create a duplicate order.
+  idempotency_key TEXT
 );
 
 CREATE TABLE IF NOT EXISTS order_items (
@@ -70,11 +72,39 @@ CREATE TABLE IF NOT EXISTS order_items (
   line_total NUMERIC(12,2) GENERATED ALWAYS AS (quantity * unit_price) STORED
 );
 
+-- Single-row catalog version, bumped on any change to products so the app can
+-- cheaply tell when its in-memory product index is stale.
+CREATE TABLE IF NOT EXISTS catalog_version (
+  id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+  version BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO catalog_version (id, version) VALUES (TRUE, 0) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+BEGIN
+  UPDATE catalog_version SET version = version + 1;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS products_catalog_version ON products;
+CREATE TRIGGER products_catalog_version
+  AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON products
+  FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version();
+
 -- Track per-session conversation length.
 ALTER TABLE IF EXISTS user_sessions
   ADD COLUMN IF NOT EXISTS conversation_count INTEGER NOT NULL DEFAULT 0;
 
+-- Idempotent order writes for existing deployments.
+ALTER TABLE IF EXISTS orders
+  ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+
+-- Session expiry: the background reaper scans by created_at, login by user + created_at.
+CREATE INDEX IF NOT EXISTS idx_user_sessions_created_at ON user_sessions(created_at);
+CREATE INDEX IF NOT EXISTS idx_user_sessions_user_created ON user_sessions(user_identifier, created_at);
 CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders(customer_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency_key ON orders(idempotency_key);
 CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id);
 
 INSERT INTO customers (email, full_name, phone) VALUES
@@ -14,18 +14,27 @@ Tools:
     Resolve product name via fuzzy match, then fetch the most recent order_id for that customer containing the item.
 
 Item format for order tools: [{"name": "Desk", "quantity": 2}]
+
+The tools are coroutines backed by the async pool; call them with `ainvoke`.
 """
 
-from contextlib import contextmanager
+import asyncio
+import atexit
+from contextlib import asynccontextmanager, contextmanager
 import os
 import random
 from decimal import Decimal
-import re
-from typing import Iterable, Mapping, Sequence
+import threading
+import time
+from typing import Annotated, Iterable, Mapping, Sequence
 
-import psycopg
+from datadog import statsd
 from langchain.tools import tool
-from thefuzz import process
+from langchain_core.tools import InjectedToolCallId
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+import async_runtime
+from product_catalog import ProductCatalog
 
 ORDER_STATUSES = ["processing", "shipped", "delivered"]
 
@@ -37,60 +46,222 @@ DB_SETTINGS = {
     "password": os.getenv("DB_PASSWORD", "support_ro"),
 }
 
+# Shared pool sizing. Every request borrows from the same process-wide pool
+# instead of paying a TCP + auth handshake per query.
+DB_POOL_SETTINGS = {
+    "min_size": int(os.getenv("DB_POOL_MIN_SIZE", "1")),
+    "max_size": int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+    "max_idle": float(os.getenv("DB_POOL_MAX_IDLE_SECONDS", "300")),
+    "max_lifetime": float(os.getenv("DB_POOL_MAX_LIFETIME_SECONDS", "1800")),
+    "timeout": float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "10")),
+}
+
 SESSION_MAX_AGE_SECONDS = int(os.getenv('SESSION_MAX_AGE_SECONDS', '300'))
 
+_pool = None
+_pool_lock = threading.Lock()
+# The async pool is bound to async_runtime's shared loop: asyncio pools cannot be shared
+# across loops, and a pool per short-lived loop (asyncio.run) would outlive its loop.
+_async_pool = None
+_async_pool_opened = None
+
 def render_graph_image(app):
     png_data = app.get_graph().draw_mermaid_png()
     with open("graph_visualization.png", "wb") as f:
         f.write(png_data)
 
-@contextmanager
-def get_db_conn():
-  conn = psycopg.connect(**DB_SETTINGS)
-  try:
-    yield conn
-  finally:
-    conn.close() # default 5 minutes
-
-
-def _lookup_product_by_name(name: str) -> dict:
+def get_pool() -> ConnectionPool:
     """
-    Purpose: internal helper to resolve a name fragment to one product using fuzzy matching.
-    Input: name (str), tolerant of plurals/extra words; strips digits before matching.
-    Output: {"sku": str, "product_id": int, "price": Decimal}
-    Errors: raises if no confident match.
+    Purpose: return the process-wide sync pool, opening it on first use.
+    Connections are health-checked on checkout and recycled after max_lifetime.
     """
-    cleaned = re.sub(r"\d+", "", name).strip()
-    if not cleaned:
-        raise ValueError("Product name is empty after cleaning")
-
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT name, sku, product_id, unit_price FROM products")
-        rows = cur.fetchall()
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    kwargs=DB_SETTINGS,
+                    check=ConnectionPool.check_connection,
+                    name="supportdb",
+                    open=True,
+                    **DB_POOL_SETTINGS,
+                )
+    return _pool
+
+
+async def get_async_pool() -> AsyncConnectionPool:
+    """
+    Purpose: return the process-wide async pool, opening it on first use.
+    Errors: RuntimeError when called outside async_runtime's loop; run such coroutines with
+            async_runtime.run() or async_runtime.submit().
+    """
+    global _async_pool, _async_pool_opened
+    if asyncio.get_running_loop() is not async_runtime.get_loop():
+        raise RuntimeError("The async DB pool is only available on async_runtime's shared event loop")
+    # Only the shared loop's thread gets here, so no lock is needed.
+    if _async_pool is None:
+        _async_pool = AsyncConnectionPool(
+            kwargs=DB_SETTINGS,
+            check=AsyncConnectionPool.check_connection,
+            name="supportdb-async",
+            open=False,
+            **DB_POOL_SETTINGS,
+        )
+        # Store the opening task so concurrent callers wait on the same open().
+        _async_pool_opened = asyncio.ensure_future(_async_pool.open())
+    await _async_pool_opened
+    return _async_pool
 
-    catalog = [r[0] for r in rows]
-    match = process.extractOne(cleaned, catalog, score_cutoff=70)
-    if not match:
-        raise ValueError(f"No products matched '{name}'")
 
-    matched_name = match[0]
-    for pname, sku, product_id, price in rows:
-        if pname == matched_name:
-            return {"sku": sku, "product_id": product_id, "price": Decimal(price)}
+@contextmanager
+def get_db_conn():
+    """Borrow a connection from the shared pool; committed on success, rolled back on error."""
+    with get_pool().connection() as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def get_async_db_conn():
+    """Async counterpart of get_db_conn, borrowing from the shared async pool."""
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        yield conn
+
+
+def _summarize_pool_stats(pool) -> dict:
+    raw = pool.get_stats()
+    size = raw.get("pool_size", 0)
+    available = raw.get("pool_available", 0)
+    in_use = size - available
+    requests_num = raw.get("requests_num", 0)
+    return {
+        "name": pool.name,
+        "size": size,
+        "max_size": pool.max_size,
+        "in_use": in_use,
+        "available": available,
+        "saturation": in_use / pool.max_size if pool.max_size else 0.0,
+        "requests_waiting": raw.get("requests_waiting", 0),
+        "requests_num": requests_num,
+        "avg_wait_ms": raw.get("requests_wait_ms", 0) / requests_num if requests_num else 0.0,
+        "requests_errors": raw.get("requests_errors", 0),
+        "connections_lost": raw.get("connections_lost", 0),
+    }
+
+
+def get_pool_stats() -> list:
+    """
+    Purpose: snapshot wait time, in-use and saturation for every open pool.
+    Output: list of dicts, one per open pool (sync pool first, then the async pool).
+    """
+    pools = [pool for pool in (_pool, _async_pool) if pool is not None]
+    return [_summarize_pool_stats(pool) for pool in pools]
+
+
+def report_pool_stats() -> list:
+    """Emit pool stats as statsd gauges and return them."""
+    stats = get_pool_stats()
+    for entry in stats:
+        tags = ["pool:{}".format(entry["name"])]
+        statsd.gauge("chatbot.db.pool.in_use", entry["in_use"], tags=tags)
+        statsd.gauge("chatbot.db.pool.size", entry["size"], tags=tags)
+        statsd.gauge("chatbot.db.pool.saturation", entry["saturation"], tags=tags)
+        statsd.gauge("chatbot.db.pool.requests_waiting", entry["requests_waiting"], tags=tags)
+        statsd.gauge("chatbot.db.pool.avg_wait_ms", entry["avg_wait_ms"], tags=tags)
+    return stats
+
+
+def start_pool_stats_reporter(interval_seconds: float = 15.0) -> threading.Thread:
+    """Report pool stats from a daemon thread every interval_seconds."""
+    def _loop():
+        while True:
+            report_pool_stats()
+            time.sleep(interval_seconds)
+
+    thread = threading.Thread(target=_loop, name="db-pool-stats", daemon=True)
+    thread.start()
+    return thread
+
+
+@atexit.register
+def _close_pool() -> None:
+    if _pool is not None:
+        _pool.close()
+    if _async_pool is not None:
+        # The shared loop's thread is a daemon and still running while atexit hooks run.
+        try:
+            async_runtime.submit(_async_pool.close()).result(timeout=5)
+        except Exception as exc:
+            print(f"Could not close the async DB pool: {exc!r}")
+
+
+# Shared name -> product resolver for the order tools; refreshed when the catalog version changes.
+product_catalog = ProductCatalog(get_async_db_conn)
+
+
+# Each order write is one statement: customer lookup, order row (with its final
+# total), and all line items via unnest() arrays. Re-running it with the same
+# idempotency_key returns the order created the first time instead of a duplicate.
+PLACE_ORDER_SQL = """
+WITH customer AS (
+    SELECT customer_id FROM customers WHERE email = %(email)s
+),
+new_order AS (
+    INSERT INTO orders (customer_id, status, total, currency, idempotency_key)
+    SELECT customer_id, %(status)s, %(total)s, 'USD', %(idempotency_key)s FROM customer
+    ON CONFLICT (idempotency_key) DO NOTHING
+    RETURNING order_id, status, total
+),
+new_items AS (
+    INSERT INTO order_items (order_id, product_id, quantity, unit_price)
+    SELECT new_order.order_id, item.product_id, item.quantity, item.unit_price
+    FROM new_order,
+         unnest(%(product_ids)s::bigint[], %(quantities)s::int[], %(prices)s::numeric[])
+           AS item(product_id, quantity, unit_price)
+),
+existing AS (
+    SELECT order_id, status, total FROM orders WHERE idempotency_key = %(idempotency_key)s
+)
+SELECT customer.customer_id, placed.order_id, placed.status, placed.total
+FROM (SELECT 1) AS anchor
+LEFT JOIN customer ON TRUE
+LEFT JOIN (
+    SELECT order_id, status, total FROM new_order
+    UNION ALL
+    SELECT order_id, status, total FROM existing
+) AS placed ON TRUE
+"""
 
-    raise ValueError(f"No products matched '{name}'")
+# Replacing items is naturally idempotent, so no key is needed; the status check,
+# delete, insert and total update still happen in a single statement.
+REPLACE_ORDER_ITEMS_SQL = """
+WITH target AS (
+    SELECT order_id, status FROM orders WHERE order_id = %(order_id)s FOR UPDATE
+),
+editable AS (
+    SELECT order_id FROM target WHERE status = 'processing'
+),
+removed AS (
+    DELETE FROM order_items WHERE order_id IN (SELECT order_id FROM editable)
+),
+added AS (
+    INSERT INTO order_items (order_id, product_id, quantity, unit_price)
+    SELECT editable.order_id, item.product_id, item.quantity, item.unit_price
+    FROM editable,
+         unnest(%(product_ids)s::bigint[], %(quantities)s::int[], %(prices)s::numeric[])
+           AS item(product_id, quantity, unit_price)
+),
+updated AS (
+    UPDATE orders SET total = %(total)s WHERE order_id IN (SELECT order_id FROM editable)
+)
+SELECT status FROM target
+"""
 
 
-@tool
-def place_new_order(customer_email: str, items: str) -> Mapping[str, object]:
+async def _resolve_items(items: str) -> list:
     """
-    Purpose: Create a new order for the given customer and insert line items.
-    Inputs:
-      - customer_email (str) must exist in customers.email
-      - items (str): JSON/list literal string representing [{"name": str, "quantity": int}]
-        names will be used as wildcard searches in the form of %name% to obtain correct product names.
-    Behavior: assigns a random status, inserts order + items, computes total.
-    Returns: {"order_id": int, "status": str, "total": float, "currency": "USD"}
+    Purpose: parse the tool's items JSON and resolve every name in one catalog pass.
+    Output: [{"sku", "product_id", "price", "qty"}]
     """
     import json
 
@@ -102,73 +273,108 @@ def place_new_order(customer_email: str, items: str) -> Mapping[str, object]:
     if not isinstance(parsed_items, list):
         raise ValueError("items must decode to a list")
 
-    resolved = []
+    quantities = []
     for item in parsed_items:
-        qty = int(item.get("quantity", 1))
+        quantities.append(int(item.get("quantity", 1)))
         if "name" not in item:
             raise ValueError("Each item must include a 'name'")
-        product = _lookup_product_by_name(item["name"])
+    resolved = await product_catalog.resolve_many([item["name"] for item in parsed_items])
+    for product, qty in zip(resolved, quantities):
         product["qty"] = qty
-        resolved.append(product)
-    status = random.choice(ORDER_STATUSES)
+    return resolved
 
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT customer_id FROM customers WHERE email = %s", (customer_email,))
-        row = cur.fetchone()
-        if not row:
-            raise ValueError(f"Customer not found for email {customer_email}")
-        customer_id = row[0]
 
-        cur.execute(
-            """
-            INSERT INTO orders (customer_id, status, total, currency)
-            VALUES (%s, %s, 0, 'USD')
-            RETURNING order_id
-            """,
-            (customer_id, status),
-        )
-        order_id = cur.fetchone()[0]
-
-        total = Decimal("0")
-        for item in resolved:
-            cur.execute(
-                """
-                INSERT INTO order_items (order_id, product_id, quantity, unit_price)
-                VALUES (%s, %s, %s, %s)
-                """,
-                (order_id, item["product_id"], item["qty"], item["price"]),
-            )
-            total += item["price"] * item["qty"]
+def _item_params(resolved: Sequence[Mapping]) -> dict:
+    return {
+        "product_ids": [item["product_id"] for item in resolved],
+        "quantities": [item["qty"] for item in resolved],
+        "prices": [item["price"] for item in resolved],
+        "total": sum((item["price"] * item["qty"] for item in resolved), Decimal("0")),
+    }
+
+
+async def _execute_single_statement(conn, query: str, params: Mapping):
+    # A lone statement is already atomic; running it in autocommit skips the
+    # separate BEGIN and COMMIT round trips. conn must be idle (as handed out by the pool).
+    await conn.set_autocommit(True)
+    try:
+        cur = await conn.execute(query, params)
+        return await cur.fetchone()
+    finally:
+        await conn.set_autocommit(False)
+
+
+async def write_new_order(conn, customer_email: str, resolved: Sequence[Mapping], status: str, idempotency_key: str):
+    """
+    Purpose: insert an order and all of its items in one round trip.
+    Output: (customer_id, order_id, status, total); order fields are None when the customer is unknown.
+    """
+    params = {"email": customer_email, "status": status, "idempotency_key": idempotency_key, **_item_params(resolved)}
+    return await _execute_single_statement(conn, PLACE_ORDER_SQL, params)
+
+
+async def replace_order_items(conn, order_id: int, resolved: Sequence[Mapping]):
+    """
+    Purpose: swap an order's items and total if it is still processing, in one round trip.
+    Output: (status, total); status is None when the order does not exist.
+    """
+    params = {"order_id": order_id, **_item_params(resolved)}
+    row = await _execute_single_statement(conn, REPLACE_ORDER_ITEMS_SQL, params)
+    return (row[0] if row else None), params["total"]
 
-        cur.execute("UPDATE orders SET total = %s WHERE order_id = %s", (total, order_id))
-        conn.commit()
 
-        return {
-            "order_id": order_id,
-            "status": status,
-            "total": float(total),
-            "currency": "USD",
-        }
+@tool
+async def place_new_order(
+    customer_email: str,
+    items: str,
+    tool_call_id: Annotated[str, InjectedToolCallId],
+) -> Mapping[str, object]:
+    """
+    Purpose: Create a new order for the given customer and insert line items.
+    Inputs:
+      - customer_email (str) must exist in customers.email
+      - items (str): JSON/list literal string representing [{"name": str, "quantity": int}]
+        names will be used as wildcard searches in the form of %name% to obtain correct product names.
+    Behavior: assigns a random status, inserts order + items, computes total.
+      Retrying the same tool call returns the original order instead of creating another one.
+    Returns: {"order_id": int, "status": str, "total": float, "currency": "USD"}
+    """
+    resolved = await _resolve_items(items)
+    status = random.choice(ORDER_STATUSES)
+
+    async with get_async_db_conn() as conn:
+        customer_id, order_id, status, total = await write_new_order(
+            conn, customer_email, resolved, status, f"place_new_order:{tool_call_id}"
+        )
+    if customer_id is None:
+        raise ValueError(f"Customer not found for email {customer_email}")
+
+    return {
+        "order_id": order_id,
+        "status": status,
+        "total": float(total),
+        "currency": "USD",
+    }
 
 
 @tool
-def get_order_status(order_id: int) -> str:
+async def get_order_status(order_id: int) -> str:
     """
     Purpose: Return the current status for an order.
     Input: order_id (int)
     Output: status string (e.g., processing, shipped, delivered)
     Errors: raises if order not found.
     """
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT status FROM orders WHERE order_id = %s", (order_id,))
-        row = cur.fetchone()
+    async with get_async_db_conn() as conn, conn.cursor() as cur:
+        await cur.execute("SELECT status FROM orders WHERE order_id = %s", (order_id,))
+        row = await cur.fetchone()
         if not row:
             raise ValueError(f"Order {order_id} not found")
         return row[0]
 
 
 @tool
-def update_order_items_if_processing(order_id: int, items: str) -> Mapping[str, object]:
+async def update_order_items_if_processing(order_id: int, items: str) -> Mapping[str, object]:
     """
     Purpose: Replace all items on an order only if status == 'processing'.
     Inputs:
@@ -179,84 +385,46 @@ def update_order_items_if_processing(order_id: int, items: str) -> Mapping[str,
     Returns: {"order_id": int, "status": str, "total": float, "currency": "USD"}
     Errors: raises if order not found, not processing, or name resolution is ambiguous/missing.
     """
-    import json
-
-    try:
-        parsed_items = json.loads(items)
-    except Exception as exc:
-        raise ValueError("items must be a JSON string representing a list of {name, quantity}") from exc
+    resolved = await _resolve_items(items)
 
-    if not isinstance(parsed_items, list):
-        raise ValueError("items must decode to a list")
+    async with get_async_db_conn() as conn:
+        status, total = await replace_order_items(conn, order_id, resolved)
+    if status is None:
+        raise ValueError(f"Order {order_id} not found")
+    if status != "processing":
+        return {"error": f"Order {order_id} is {status}; changes allowed only in processing."}
 
-    resolved = []
-    for item in parsed_items:
-        qty = int(item.get("quantity", 1))
-        if "name" not in item:
-            raise ValueError("Each item must include a 'name'")
-        product = _lookup_product_by_name(item["name"])
-        product["qty"] = qty
-        resolved.append(product)
-
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT status FROM orders WHERE order_id = %s", (order_id,))
-        row = cur.fetchone()
-        if not row:
-            raise ValueError(f"Order {order_id} not found")
-        status = row[0]
-        if status != "processing":
-            return {"error": f"Order {order_id} is {status}; changes allowed only in processing."}
-
-        # Clear existing items and insert new ones
-        cur.execute("DELETE FROM order_items WHERE order_id = %s", (order_id,))
-
-        total = Decimal("0")
-        for item in resolved:
-            cur.execute(
-                """
-                INSERT INTO order_items (order_id, product_id, quantity, unit_price)
-                VALUES (%s, %s, %s, %s)
-                """,
-                (order_id, item["product_id"], item["qty"], item["price"]),
-            )
-            total += item["price"] * item["qty"]
-
-        cur.execute("UPDATE orders SET total = %s WHERE order_id = %s", (total, order_id))
-        conn.commit()
-
-        return {"order_id": order_id, "status": status, "total": float(total), "currency": "USD"}
+    return {"order_id": order_id, "status": status, "total": float(total), "currency": "USD"}
 
 
 @tool
-def get_latest_order_id_by_product(email: str, item_name: str) -> int:
+async def get_latest_order_id_by_product(email: str, item_name: str) -> int:
     """
     Purpose: For a given customer email, find the most recent order containing the named product.
     Inputs: email (str), item_name (str) resolved via fuzzy match.
     Returns: order_id (int) of the latest matching order.
     Errors: raises if customer or product not found, or no matching order.
     """
-    product = _lookup_product_by_name(item_name)
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT customer_id FROM customers WHERE email = %s", (email,))
-        row = cur.fetchone()
-        if not row:
-            raise ValueError(f"Customer not found for email {email}")
-        customer_id = row[0]
-
-        cur.execute(
+    product = await product_catalog.resolve(item_name)
+    async with get_async_db_conn() as conn, conn.cursor() as cur:
+        await cur.execute(
             """
-            SELECT o.order_id
-            FROM orders o
-            JOIN order_items oi ON oi.order_id = o.order_id
-            WHERE o.customer_id = %s AND oi.product_id = %s
-            ORDER BY o.placed_at DESC NULLS LAST, o.order_id DESC
-            LIMIT 1
+            SELECT c.customer_id, (
+                SELECT o.order_id
+                FROM orders o
+                JOIN order_items oi ON oi.order_id = o.order_id
+                WHERE o.customer_id = c.customer_id AND oi.product_id = %s
+                ORDER BY o.placed_at DESC NULLS LAST, o.order_id DESC
+                LIMIT 1
+            )
+            FROM customers c
+            WHERE c.email = %s
             """,
-            (customer_id, product["product_id"]),
+            (product["product_id"], email),
         )
-        row = cur.fetchone()
+        row = await cur.fetchone()
         if not row:
+            raise ValueError(f"Customer not found for email {email}")
+        if row[1] is None:
             raise ValueError(f"No orders for {email} containing '{item_name}'")
-        return row[0]
-
-
+        return row[1]
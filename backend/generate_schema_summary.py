@@ -1,45 +1,131 @@
 """
 Generate a text summary of all tables, columns, and data types in supportdb.
 The output is written to backend/support_schema.txt and is formatted for LLM consumption.
+
+It also writes the schema catalog used to prune generate_query's schema context
+(see schema_catalog.py):
+
+  support_schema_catalog.json  tables, columns, foreign keys and descriptions
+                               (COMMENT ON TABLE/COLUMN; with --describe, Gemini
+                               writes one-line descriptions for tables without one)
+  support_schema_catalog.npy   one MiniLM embedding per table, in table order
+                               (skipped with --no-embeddings; computed at load instead)
+
+Both are replaced atomically, so running servers pick up the new catalog
+without ever reading a half-written one.
+
+Usage: python generate_schema_summary.py [--describe] [--no-embeddings]
 """
 
+import argparse
+import asyncio
+import json
 import os
-import psycopg
+import tempfile
 
-OUTPUT_PATH = os.path.join(os.path.dirname(__file__), "support_schema.txt")
+import numpy as np
+import psycopg
 
+from schema_catalog import SCHEMA_CATALOG_PATH, SchemaCatalog, embed_tables
 
-def main():
-    conn = psycopg.connect(
-        host=os.getenv("DB_HOST", "localhost"),
-        port=os.getenv("DB_PORT", "5431"),
-        dbname=os.getenv("DB_NAME", "supportdb"),
-        user=os.getenv("DB_USER", "support_ro"),
-        password=os.getenv("DB_PASSWORD", "support_ro"),
-    )
+OUTPUT_PATH = os.path.join(os.path.dirname(__file__), "support_schema.txt")
 
-    query = """
+COLUMNS_QUERY = """
     SELECT
         table_schema,
         table_name,
         column_name,
         data_type,
         is_nullable,
-        ordinal_position
+        ordinal_position,
+        col_description(format('%I.%I', table_schema, table_name)::regclass, ordinal_position)
     FROM information_schema.columns
     WHERE table_schema = 'public'
     ORDER BY table_name, ordinal_position;
     """
 
+TABLE_COMMENTS_QUERY = """
+    SELECT c.relname, obj_description(c.oid, 'pg_class')
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'public';
+    """
+
+# Column lists are ordered by their position in the constraint, so composite keys pair up.
+FOREIGN_KEYS_QUERY = """
+    SELECT
+        src.relname,
+        dst.relname,
+        array(SELECT a.attname FROM unnest(c.conkey) WITH ORDINALITY AS k(attnum, i)
+              JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum ORDER BY k.i),
+        array(SELECT a.attname FROM unnest(c.confkey) WITH ORDINALITY AS k(attnum, i)
+              JOIN pg_attribute a ON a.attrelid = c.confrelid AND a.attnum = k.attnum ORDER BY k.i)
+    FROM pg_constraint c
+    JOIN pg_class src ON src.oid = c.conrelid
+    JOIN pg_class dst ON dst.oid = c.confrelid
+    JOIN pg_namespace n ON n.oid = c.connamespace
+    WHERE c.contype = 'f' AND n.nspname = 'public'
+    ORDER BY src.relname, c.conname;
+    """
+
+DESCRIBE_PROMPT = """Write a one-sentence description (at most 20 words) of what a row of this
+PostgreSQL table represents, for a reader choosing tables to answer customer questions.
+Reply with the sentence only.
+
+{table}
+"""
+
+
+def _write_atomic(path: str, write) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+async def describe_tables(catalog: dict) -> None:
+    """Fill in missing table descriptions with the flash model."""
+    import llm_gateway
+
+    async def describe(table):
+        columns = ", ".join(f"{column['name']} {column['type']}" for column in table["columns"])
+        prompt = DESCRIBE_PROMPT.format(table=f"{table['name']}({columns})")
+        result = await llm_gateway.call("describe_table", llm_gateway.FLASH_MODEL, prompt, annotate=False)
+        table["description"] = result.text
+
+    await asyncio.gather(*(describe(table) for table in catalog["tables"] if not table["description"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--describe", action="store_true", help="describe uncommented tables with Gemini")
+    parser.add_argument("--no-embeddings", action="store_true", help="do not precompute table embeddings")
+    args = parser.parse_args()
+
+    conn = psycopg.connect(
+        host=os.getenv("DB_HOST", "localhost"),
+        port=os.getenv("DB_PORT", "5431"),
+        dbname=os.getenv("DB_NAME", "supportdb"),
+        user=os.getenv("DB_USER", "support_ro"),
+        password=os.getenv("DB_PASSWORD", "support_ro"),
+    )
+
     with conn, conn.cursor() as cur:
-        cur.execute(query)
+        cur.execute(COLUMNS_QUERY)
         rows = cur.fetchall()
+        cur.execute(TABLE_COMMENTS_QUERY)
+        table_comments = dict(cur.fetchall())
+        cur.execute(FOREIGN_KEYS_QUERY)
+        foreign_keys = cur.fetchall()
 
     # Group columns by table
     tables = {}
-    for schema, table, col, dtype, nullable, pos in rows:
+    for schema, table, col, dtype, nullable, pos, comment in rows:
         tables.setdefault(table, []).append(
-            {"name": col, "type": dtype, "nullable": nullable}
+            {"name": col, "type": dtype, "nullable": nullable, "description": comment or ""}
         )
 
     lines = []
@@ -59,7 +145,41 @@ def main():
 
     print(f"Schema summary written to {OUTPUT_PATH}")
 
+    catalog = {
+        "database": "supportdb",
+        "schema": "public",
+        "model": None,
+        "tables": [
+            {
+                "name": table_name,
+                "description": table_comments.get(table_name) or "",
+                "columns": [dict(col, nullable=col["nullable"] == "YES") for col in cols],
+                "foreign_keys": [
+                    {"columns": list(columns), "references": target, "ref_columns": list(ref_columns)}
+                    for source, target, columns, ref_columns in foreign_keys
+                    if source == table_name
+                ],
+            }
+            for table_name, cols in tables.items()
+        ],
+    }
+    if args.describe:
+        asyncio.run(describe_tables(catalog))
+
+    # The matrix goes first: a server that sees the new JSON must find matching embeddings.
+    matrix_path = os.path.splitext(SCHEMA_CATALOG_PATH)[0] + ".npy"
+    if not args.no_embeddings:
+        from rag import EMBEDDING_MODEL, get_embeddings
+
+        matrix = embed_tables(SchemaCatalog(catalog).tables, get_embeddings()).astype(np.float32)
+        _write_atomic(matrix_path, lambda f: np.save(f, matrix))
+        catalog["model"] = EMBEDDING_MODEL
+    elif os.path.exists(matrix_path):
+        os.unlink(matrix_path)
+    _write_atomic(SCHEMA_CATALOG_PATH, lambda f: f.write(json.dumps(catalog, indent=2).encode("utf-8")))
+
+    print(f"Schema catalog ({len(catalog['tables'])} tables) written to {SCHEMA_CATALOG_PATH}")
+
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,117 @@
+"""
+Micro-batching worker for CPU-bound model inference.
+
+Requests enqueue items without blocking; a dedicated thread drains the queue
+into batches (up to max_batch_size items, or whatever arrived within
+max_wait_ms of the first one) and hands each batch to the handler, so every
+model runs once per batch instead of once per message.
+
+The queue is bounded. When it is full, overflow_policy decides what to lose:
+"drop_newest" rejects the incoming item, "drop_oldest" evicts the oldest queued
+one. sample_rate < 1 admits only that fraction of items in the first place.
+Queue depth, batch size, batch latency and drops are reported to statsd.
+"""
+
+import os
+import queue
+import random
+import threading
+import time
+from typing import Callable, Sequence
+
+from datadog import statsd
+
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "256"))
+INFERENCE_MAX_BATCH_SIZE = int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "16"))
+INFERENCE_MAX_WAIT_MS = int(os.getenv("INFERENCE_MAX_WAIT_MS", "50"))
+INFERENCE_OVERFLOW_POLICY = os.getenv("INFERENCE_OVERFLOW_POLICY", "drop_newest")
+INFERENCE_SAMPLE_RATE = float(os.getenv("INFERENCE_SAMPLE_RATE", "1.0"))
+
+OVERFLOW_POLICIES = ("drop_newest", "drop_oldest")
+
+
+class MicroBatchWorker:
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Sequence], None],
+        queue_size: int = INFERENCE_QUEUE_SIZE,
+        max_batch_size: int = INFERENCE_MAX_BATCH_SIZE,
+        max_wait_ms: int = INFERENCE_MAX_WAIT_MS,
+        overflow_policy: str = INFERENCE_OVERFLOW_POLICY,
+        sample_rate: float = INFERENCE_SAMPLE_RATE,
+    ):
+        """handler receives a list of submitted items and runs in the worker thread."""
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow_policy must be one of {', '.join(OVERFLOW_POLICIES)}")
+        self.name = name
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.overflow_policy = overflow_policy
+        self.sample_rate = sample_rate
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._tags = ["worker:{}".format(name)]
+
+    def submit(self, item) -> bool:
+        """Enqueue item without blocking. Returns False when it was sampled out or dropped."""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            statsd.increment("chatbot.inference.sampled_out", tags=self._tags)
+            return False
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow_policy == "drop_newest":
+                statsd.increment("chatbot.inference.dropped", tags=self._tags + ["policy:drop_newest"])
+                return False
+            try:
+                self._queue.get_nowait()
+                statsd.increment("chatbot.inference.dropped", tags=self._tags + ["policy:drop_oldest"])
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                statsd.increment("chatbot.inference.dropped", tags=self._tags + ["policy:drop_oldest"])
+                return False
+        statsd.gauge("chatbot.inference.queue_depth", self._queue.qsize(), tags=self._tags)
+        return True
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=f"{self.name}-inference", daemon=True)
+                    self._thread.start()
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            start = time.perf_counter()
+            try:
+                self.handler(batch)
+            except Exception as exc:  # one bad batch must not stop the worker
+                statsd.increment("chatbot.inference.batch_errors", tags=self._tags)
+                print(f"{self.name} inference batch failed: {exc}")
+            statsd.distribution("chatbot.inference.batch_size", len(batch), tags=self._tags)
+            statsd.distribution("chatbot.inference.batch_latency_ms", (time.perf_counter() - start) * 1000, tags=self._tags)
+            statsd.gauge("chatbot.inference.queue_depth", self._queue.qsize(), tags=self._tags)
@@ -0,0 +1,189 @@
+"""
+Local embedding-kNN pre-router.
+
+The labelled corpora in backend/ (sql_queries.md, queries.md, tag_queries.md,
+orders.md) cover the routes the graph can take. Their examples are embedded
+once with MiniLM; an incoming query's embedding is scored against all of them
+with one matrix product, and its KNN_ROUTER_K nearest neighbours vote for a
+label, weighted by cosine similarity:
+
+  policy     is_question=yes, rag_type=policy
+  database   is_question=yes, rag_type=database
+  request    is_question=request (order changes, handled by process_request)
+  statement  is_question=no
+
+Confidence is the winning label's share of the vote, and 0 when even the
+nearest example is less similar than KNN_ROUTER_MIN_SIMILARITY. The graph
+takes the route directly at or above KNN_ROUTER_THRESHOLD and otherwise falls
+back to the LLM router.
+
+Security checks stay with the LLM: examples of injection and data-exfiltration
+attempts are labelled "security", and a query with any of them among its
+neighbours is never routed locally. Only the labels in KNN_ROUTER_LABELS are
+routed locally; by default that is policy and statement, whose routes expose
+no customer data. database and request queries rely on classify_query to flag
+attempts to reach other users' data, so enable them only after checking the
+evaluation.
+
+Evaluate thresholds offline with bench_knn_router.py.
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from vector_store import normalize_rows, top_k
+
+KNN_ROUTER_ENABLED = bool(int(os.getenv("KNN_ROUTER_ENABLED", "0")))
+KNN_ROUTER_THRESHOLD = float(os.getenv("KNN_ROUTER_THRESHOLD", "0.9"))
+KNN_ROUTER_K = int(os.getenv("KNN_ROUTER_K", "5"))
+KNN_ROUTER_MIN_SIMILARITY = float(os.getenv("KNN_ROUTER_MIN_SIMILARITY", "0.5"))
+KNN_ROUTER_LABELS = os.getenv("KNN_ROUTER_LABELS", "policy,statement")
+KNN_ROUTER_CORPUS_DIR = os.getenv("KNN_ROUTER_CORPUS_DIR", os.path.dirname(os.path.abspath(__file__)))
+
+SECURITY = "security"
+LABELS = ("policy", "database", "request", "statement", SECURITY)
+
+# State updates per label; "security" has none because it always goes to the LLM router.
+LABEL_ROUTES = {
+    "policy": {"is_question": "yes", "rag_type": "policy"},
+    "database": {"is_question": "yes", "rag_type": "database"},
+    "request": {"is_question": "request"},
+    "statement": {"is_question": "no"},
+}
+
+# file -> {heading substring: label}; "*" labels every example in the file. Examples under
+# headings that match nothing (mixed sections such as "Billing & Account") are not used.
+ROUTER_CORPORA = {
+    "sql_queries.md": {"*": "database"},
+    "orders.md": {"*": "request"},
+    "tag_queries.md": {
+        "Order Status": "database",
+        "Product Info": "database",
+        "Return & Refund": "policy",
+        "Shipping Policy": "policy",
+        "Security & Privacy": SECURITY,
+        "Other": "statement",
+    },
+    "queries.md": {
+        "TRAP 2": "policy",
+        "TRAP 3": SECURITY,
+        "TRAP 4": SECURITY,
+        "TRAP 5": "policy",
+        "Happiness & Gratitude": "statement",
+        "Sadness & Disappointment": "statement",
+    },
+}
+
+_EXAMPLE = re.compile(r"(?:\d+\.|[*-])\s+(.*)")
+
+
+def load_examples(corpora: Dict[str, Dict[str, str]] = ROUTER_CORPORA,
+                  base_dir: str = KNN_ROUTER_CORPUS_DIR) -> List[Tuple[str, str]]:
+    """
+    Purpose: collect labelled example queries from the markdown corpora.
+    Input: {file: {heading substring or "*": label}}; headings are "#" lines ("# Goal: ..." lines
+           describe the section above and do not start a new one); examples are numbered or bulleted lines.
+    Output: [(query, label), ...] in file order.
+    Errors: OSError if a corpus file cannot be read.
+    """
+    examples = []
+    for name, sections in corpora.items():
+        label = sections.get("*")
+        with open(os.path.join(base_dir, name), encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("#"):
+                    heading = line.lstrip("#").strip()
+                    if heading.startswith("Goal:"):
+                        continue
+                    label = sections.get("*") or next(
+                        (value for key, value in sections.items() if key in heading), None
+                    )
+                    continue
+                match = _EXAMPLE.match(line)
+                if label and match:
+                    text = match.group(1).strip().strip('"').strip()
+                    if text:
+                        examples.append((text, label))
+    return examples
+
+
+@dataclass
+class RouteGuess:
+    label: str
+    confidence: float
+    similarity: float  # cosine similarity of the nearest example
+    security_neighbour: bool
+    routable: bool  # label may be routed locally and no security example is close
+
+    @property
+    def route(self) -> Optional[dict]:
+        """State updates for this label, or None when the query must go to the LLM router."""
+        return LABEL_ROUTES[self.label] if self.routable else None
+
+
+class KNNRouter:
+    def __init__(self, embeddings, examples: Sequence[Tuple[str, str]], k: int = KNN_ROUTER_K,
+                 min_similarity: float = KNN_ROUTER_MIN_SIMILARITY, labels: str = KNN_ROUTER_LABELS):
+        """
+        embeddings: a LangChain Embeddings instance; examples: (query, label) pairs from load_examples;
+        labels: comma-separated labels that may be routed locally.
+        """
+        self.routable_labels = tuple(label.strip() for label in labels.split(",") if label.strip())
+        unknown = set(self.routable_labels) - set(LABEL_ROUTES)
+        if unknown:
+            raise ValueError(f"KNN_ROUTER_LABELS must be among {', '.join(LABEL_ROUTES)}")
+        self.embeddings = embeddings
+        self.texts = [text for text, _ in examples]
+        self.k = k
+        self.min_similarity = min_similarity
+        self.example_labels = np.asarray([LABELS.index(label) for _, label in examples])
+        self.matrix = normalize_rows(embeddings.embed_documents(self.texts))
+
+    def guess_vectors(self, vectors, exclude: Sequence[int] = None) -> List[RouteGuess]:
+        """
+        Purpose: route a batch of query embeddings with one matrix product.
+        Input: vectors (n x dim); exclude, optionally one example row per query to leave out
+               (leave-one-out evaluation).
+        Output: one RouteGuess per vector.
+        """
+        queries = normalize_rows(vectors)
+        scores = queries @ self.matrix.T
+        if exclude is not None:
+            scores[np.arange(len(queries)), np.asarray(exclude)] = -np.inf
+        neighbours = top_k(scores, self.k)
+        similarities = np.take_along_axis(scores, neighbours, axis=1)
+        labels = self.example_labels[neighbours]
+        close = similarities >= self.min_similarity
+        weights = np.where(close, similarities, 0.0)
+        # votes[q, l] = summed similarity of q's close neighbours labelled l
+        votes = (weights[:, :, None] * (labels[:, :, None] == np.arange(len(LABELS)))).sum(axis=1)
+        totals = votes.sum(axis=1)
+        winners = votes.argmax(axis=1)
+        confidences = np.where(totals > 0, votes[np.arange(len(queries)), winners] / np.maximum(totals, 1e-12), 0.0)
+        security = ((labels == LABELS.index(SECURITY)) & close).any(axis=1)
+        return [
+            RouteGuess(
+                label=LABELS[winners[i]],
+                confidence=float(confidences[i]),
+                similarity=float(similarities[i, 0]),
+                security_neighbour=bool(security[i]),
+                routable=LABELS[winners[i]] in self.routable_labels and not security[i],
+            )
+            for i in range(len(queries))
+        ]
+
+    def guess(self, vector) -> RouteGuess:
+        return self.guess_vectors([vector])[0]
+
+
+def build_router(embeddings=None) -> KNNRouter:
+    if embeddings is None:
+        from rag import get_embeddings
+
+        embeddings = get_embeddings()
+    return KNNRouter(embeddings, load_examples())
@@ -0,0 +1,236 @@
+"""
+Exact-match memoization for deterministic (temperature 0) LLM calls.
+
+classify_query, get_rag_type and check_query_classification are pure functions
+of the query text (plus the user, for the critic) and the prompt. Their replies
+are cached under a key made of the node, model, a fingerprint of the prompt
+template (so editing a prompt invalidates its entries), the normalized query
+(NFKC, case-folded, whitespace collapsed) and, where relevant, the user.
+
+Two tiers:
+  - in-process LRU with TTL (LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS);
+  - optional LLM_CACHE_BACKEND=sqlite: a local SQLite file (LLM_CACHE_PATH,
+    WAL mode) shared by every worker on the host, consulted on a local miss.
+
+Hits, misses, hit ratio, entry count and memory/disk footprint are reported by
+stats() and as chatbot.llm_cache.* statsd metrics tagged by node.
+"""
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+from datadog import statsd
+
+LLM_CACHE_ENABLED = bool(int(os.getenv("LLM_CACHE_ENABLED", "1")))
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")
+LLM_CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_cache.sqlite3")
+)
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "3600"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+
+LLM_CACHE_BACKENDS = ("memory", "sqlite")
+
+# Rough per-entry overhead of the OrderedDict node, tuple and str headers
+_ENTRY_OVERHEAD_BYTES = 200
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+_fingerprints = {}
+
+
+def prompt_fingerprint(prompt_template) -> str:
+    """Stable hash of a prompt template's text, memoized per template object."""
+    fingerprint = _fingerprints.get(id(prompt_template))
+    if fingerprint is None:
+        fingerprint = hashlib.sha256(prompt_template.pretty_repr().encode("utf-8")).hexdigest()[:16]
+        _fingerprints[id(prompt_template)] = fingerprint
+    return fingerprint
+
+
+def make_key(node: str, model: str, prompt_template, query: str, user: str = "") -> str:
+    return "\x1f".join((node, model, prompt_fingerprint(prompt_template), normalize_query(query), user))
+
+
+class _SqliteStore:
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._puts = 0
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[tuple]:
+        """Return (value, expires_at) for a live entry, else None."""
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT value, expires_at FROM llm_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        if row is not None:
+            conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    def put(self, key: str, value: str, expires_at: float) -> None:
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, value, expires_at, now),
+        )
+        self._puts += 1
+        # Trim expired and least recently used rows every so often rather than on every write.
+        if self._puts % 100 == 0:
+            conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                " SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def size_bytes(self) -> int:
+        return sum(os.path.getsize(p) for p in (self.path, self.path + "-wal") if os.path.exists(p))
+
+
+class LLMCache:
+    def __init__(self, backend: str = LLM_CACHE_BACKEND, path: str = LLM_CACHE_PATH,
+                 ttl_seconds: float = LLM_CACHE_TTL_SECONDS, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        if backend not in LLM_CACHE_BACKENDS:
+            raise ValueError(f"LLM_CACHE_BACKEND must be one of {', '.join(LLM_CACHE_BACKENDS)}")
+        self.backend = backend
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (value, expires_at as wall-clock time)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._shared = None
+        self._shared_path = path if backend == "sqlite" else None
+        self._shared_lock = threading.Lock()
+        self._hits = {}
+        self._misses = {}
+
+    def _store(self) -> Optional[_SqliteStore]:
+        if self._shared_path is not None and self._shared is None:
+            with self._shared_lock:
+                if self._shared is None:
+                    self._shared = _SqliteStore(self._shared_path, self.max_entries)
+        return self._shared
+
+    @staticmethod
+    def _entry_bytes(key: str, value: str) -> int:
+        return len(key.encode("utf-8")) + len(value.encode("utf-8")) + _ENTRY_OVERHEAD_BYTES
+
+    def _put_local(self, key: str, value: str, expires_at: float) -> None:
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= self._entry_bytes(key, previous[0])
+            self._entries[key] = (value, expires_at)
+            self._bytes += self._entry_bytes(key, value)
+            while len(self._entries) > self.max_entries:
+                old_key, (old_value, _) = self._entries.popitem(last=False)
+                self._bytes -= self._entry_bytes(old_key, old_value)
+
+    def _count(self, counter: dict, node: str, metric: str) -> None:
+        with self._lock:
+            counter[node] = counter.get(node, 0) + 1
+        statsd.increment(metric, tags=["node:{}".format(node)])
+
+    def get(self, node: str, key: str) -> Optional[str]:
+        """Return the cached reply for key, or None. Counts a hit or miss for node."""
+        now = time.time()
+        value = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    value = entry[0]
+                else:
+                    del self._entries[key]
+                    self._bytes -= self._entry_bytes(key, entry[0])
+        if value is not None:
+            self._count(self._hits, node, "chatbot.llm_cache.hit")
+            return value
+        store = self._store()
+        if store is not None:
+            try:
+                row = store.get(key)
+            except sqlite3.Error as exc:
+                print(f"LLM cache read failed: {exc}")
+                row = None
+            if row is not None:
+                self._put_local(key, row[0], row[1])
+                self._count(self._hits, node, "chatbot.llm_cache.hit")
+                return row[0]
+        self._count(self._misses, node, "chatbot.llm_cache.miss")
+        return None
+
+    def put(self, key: str, value: str) -> None:
+        expires_at = time.time() + self.ttl
+        self._put_local(key, value, expires_at)
+        store = self._store()
+        if store is not None:
+            try:
+                store.put(key, value, expires_at)
+            except sqlite3.Error as exc:
+                print(f"LLM cache write failed: {exc}")
+        statsd.gauge("chatbot.llm_cache.entries", len(self._entries))
+        statsd.gauge("chatbot.llm_cache.memory_bytes", self._bytes)
+
+    async def aget(self, node: str, key: str) -> Optional[str]:
+        # SQLite may wait on another worker's write lock; keep that off the event loop.
+        if self._shared_path is None:
+            return self.get(node, key)
+        return await asyncio.to_thread(self.get, node, key)
+
+    async def aput(self, key: str, value: str) -> None:
+        if self._shared_path is None:
+            return self.put(key, value)
+        await asyncio.to_thread(self.put, key, value)
+
+    def stats(self) -> dict:
+        """Hit ratio per node and overall, entry count and footprint."""
+        nodes = {}
+        for node in set(self._hits) | set(self._misses):
+            hits, misses = self._hits.get(node, 0), self._misses.get(node, 0)
+            nodes[node] = {"hits": hits, "misses": misses, "hit_ratio": round(hits / (hits + misses), 4)}
+        hits, misses = sum(self._hits.values()), sum(self._misses.values())
+        stats = {
+            "backend": self.backend,
+            "entries": len(self._entries),
+            "memory_bytes": self._bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+            "nodes": nodes,
+        }
+        if self._shared is not None:
+            stats["disk_bytes"] = self._shared.size_bytes()
+        return stats
+
+
+llm_cache = LLMCache()
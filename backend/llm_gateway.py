@@ -0,0 +1,227 @@
+"""
+Shared gateway for every Gemini call made by the graph.
+
+Owns one long-lived ChatGoogleGenerativeAI client per model (and per bound tool
+set), so HTTP sessions and TLS connections are reused across requests instead
+of being rebuilt by every node. All nodes go through call(), which does the
+usage -> cost -> ledger/LLMObs bookkeeping and text extraction in one place.
+
+Inside stream_tokens(), calls made with stream=True use the model's streaming
+API and hand each text delta to the registered callback as it arrives (the
+/api/chat/stream endpoint), while still returning the complete LLMResult.
+"""
+
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Sequence
+
+from ddtrace import tracer
+from ddtrace.llmobs import LLMObs
+from langchain_core.messages import AIMessage
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+from cost_ledger import ledger
+from llm_cache import LLM_CACHE_ENABLED, llm_cache
+from utils import get_cost
+
+FLASH_MODEL = "gemini-flash-latest"
+PRO_MODEL = "gemini-pro-latest"
+
+GEMINI_TRANSPORT = os.getenv("GEMINI_TRANSPORT", "rest")
+
+_clients = {}
+_clients_lock = threading.RLock()
+# Set by collect_usage(); every call() made in that context appends its LLMResult
+_usage_sink = contextvars.ContextVar("llm_usage_sink", default=None)
+# Set by stream_tokens(); called as on_token(node, text) for each streamed delta
+_token_sink = contextvars.ContextVar("llm_token_sink", default=None)
+
+
+@dataclass
+class LLMResult:
+    message: Any
+    text: str
+    input_tokens: int
+    output_tokens: int
+    total_tokens: int
+    cost: float
+    parsed: Any = None  # schema instance for structured-output calls
+
+
+def get_client(model: str, tools: Sequence = (), schema: type = None):
+    """
+    Return the cached client for model, bound to tools or to a structured-output schema when given.
+    Bound clients wrap the same underlying client, so they share its connections.
+    """
+    key = (model, tuple(t.name for t in tools), schema.__name__ if schema else None)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                if schema is not None:
+                    # include_raw keeps the AIMessage so usage metadata is still available
+                    client = get_client(model).with_structured_output(schema, include_raw=True)
+                elif tools:
+                    client = get_client(model).bind_tools(list(tools))
+                else:
+                    client = ChatGoogleGenerativeAI(
+                        model=model,
+                        temperature=0,
+                        api_key=os.getenv("GOOGLE_API_KEY"),
+                        transport=GEMINI_TRANSPORT,
+                    )
+                _clients[key] = client
+    return client
+
+
+@contextmanager
+def collect_usage(results: list = None):
+    """
+    Collect the LLMResult of every call() made inside the block (per asyncio task, since each
+    task runs in its own context copy). Used to attribute tokens to one speculative branch.
+    Pass results to append to a list the caller keeps, e.g. to read it after cancelling the task.
+    """
+    results = [] if results is None else results
+    token = _usage_sink.set(results)
+    try:
+        yield results
+    finally:
+        _usage_sink.reset(token)
+
+
+@contextmanager
+def stream_tokens(on_token: Callable[[str, str], None]):
+    """
+    Stream the reply of every call(stream=True) made inside the block (graph nodes included, since
+    LangGraph copies the context into node tasks): on_token(node, text) receives each text delta.
+    """
+    token = _token_sink.set(on_token)
+    try:
+        yield
+    finally:
+        _token_sink.reset(token)
+
+
+def _delta_text(chunk) -> str:
+    # Unlike extract_text, keep surrounding whitespace: it separates consecutive deltas.
+    if isinstance(chunk.content, list):
+        return "".join(block.get("text", "") if isinstance(block, dict) else str(block) for block in chunk.content)
+    return chunk.content
+
+
+async def _astream(client, prompt, node: str, on_token: Callable[[str, str], None]):
+    """Stream a reply, forwarding text deltas; returns the merged message (usage metadata included)."""
+    message = None
+    async for chunk in client.astream(prompt):
+        message = chunk if message is None else message + chunk
+        text = _delta_text(chunk)
+        if text:
+            on_token(node, text)
+    return message
+
+
+def extract_text(message) -> str:
+    """Flatten a model reply into plain text (Gemini may return a list of content blocks)."""
+    if isinstance(message, dict):
+        return message.get('content', '')
+    if isinstance(message.content, list):
+        return "".join(
+            block.__str__() if not isinstance(block, dict) else block.get("text", "") for block in message.content
+        )
+    return message.content.strip()
+
+
+def annotate_usage(node: str, input_tokens: int, output_tokens: int, cost: float, total_tokens: int = None,
+                   cache_hit: bool = None) -> None:
+    """Attach token and cost metrics to the active LLMObs span (and whether the reply came from llm_cache)."""
+    tags = {"node": node}
+    if cache_hit is not None:
+        tags["cache_hit"] = str(cache_hit).lower()
+        span = tracer.current_span()
+        if span:
+            span.set_tag("llm_cache.hit", tags["cache_hit"])
+    LLMObs.annotate(
+        metrics={
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens if total_tokens is None else total_tokens,
+            "total_cost": cost,
+        },
+        tags=tags,
+    )
+
+
+async def call(node: str, model: str, prompt, tools: Sequence = (), annotate: bool = True,
+               cache_key: str = None, schema: type = None, stream: bool = False) -> LLMResult:
+    """
+    Single path for a model call.
+    Inputs: node name (for tagging), model name, a prompt value or message list, optional tools.
+    Set annotate=False when the caller aggregates usage over several calls (e.g. a tool loop)
+    and reports it once with annotate_usage.
+    cache_key (see llm_cache.make_key) serves the reply from llm_cache when present and stores it
+    otherwise; only pass it for deterministic calls without tools.
+    schema (a pydantic model) requests structured output: result.parsed holds the instance and
+    result.text its JSON.
+    stream=True streams the reply to the stream_tokens() callback when one is active (not with schema).
+    """
+    use_cache = cache_key is not None and LLM_CACHE_ENABLED
+    sink = _usage_sink.get()
+    if use_cache:
+        cached = await llm_cache.aget(node, cache_key)
+        if cached is not None:
+            if annotate:
+                annotate_usage(node, 0, 0, 0.0, 0, cache_hit=True)
+            result = LLMResult(
+                message=AIMessage(content=cached),
+                text=cached,
+                input_tokens=0,
+                output_tokens=0,
+                total_tokens=0,
+                cost=0.0,
+                parsed=schema.model_validate_json(cached) if schema is not None else None,
+            )
+            if sink is not None:
+                sink.append(result)
+            return result
+
+    parsed = None
+    on_token = _token_sink.get() if stream and schema is None else None
+    if on_token is not None:
+        message = await _astream(get_client(model, tools), prompt, node, on_token)
+    else:
+        message = await get_client(model, tools, schema).ainvoke(prompt)
+    if schema is not None:
+        if message["parsing_error"] is not None:
+            raise message["parsing_error"]
+        parsed = message["parsed"]
+        message = message["raw"]
+        if parsed is None:
+            raise ValueError(f"{node}: model returned no {schema.__name__}")
+    # LangChain normalizes these keys for you
+    usage = getattr(message, "usage_metadata", None) or {}
+    input_tokens = usage.get("input_tokens", -1)
+    output_tokens = usage.get("output_tokens", -1)
+    total_tokens = usage.get("total_tokens", -1)
+    cost = get_cost(input_tokens, output_tokens, model)
+    ledger.record(node, model, input_tokens, output_tokens, cost)
+    text = parsed.model_dump_json() if parsed is not None else extract_text(message)
+    if use_cache:
+        await llm_cache.aput(cache_key, text)
+    if annotate:
+        annotate_usage(node, input_tokens, output_tokens, cost, total_tokens, cache_hit=False if use_cache else None)
+    result = LLMResult(
+        message=message,
+        text=text,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        total_tokens=total_tokens,
+        cost=cost,
+        parsed=parsed,
+    )
+    if sink is not None:
+        sink.append(result)
+    return result
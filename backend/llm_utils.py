@@ -1,76 +1,112 @@
+import time
+from functools import lru_cache
+
+from datadog import statsd
 from ddtrace import tracer
-from transformers import pipeline
-import torch
-
-# 1. Initialize once (Global scope) to avoid reloading heavy weights
-# device=-1 runs on CPU. Set to 0 if you have a GPU.
-
-device = "mps" if torch.backends.mps.is_available() else "cpu"
-
-msg_classifier = pipeline("zero-shot-classification", 
-                      model="facebook/bart-large-mnli",
-                      device=device) 
-
-CANDIDATE_LABELS = [
-    "Order Status", 
-    "Return & Refund", 
-    "Product Info", 
-    "Billing & Account", 
-    "Shipping Policy", 
-    "Technical Support", 
-    "Other"
-]
-
-emotion_pipeline = pipeline("text-classification", 
-                        model="SamLowe/roberta-base-go_emotions", 
-                        top_k=None,
-                        device=device)
-
-sentiment_pipeline = pipeline("sentiment-analysis", model="distilbert-base-uncased-finetuned-sst-2-english", device=device  )
-
-
-
-async def tag_message(query, parent_context, confusion_score):
-    # REACTIVATE the parent trace so this span appears in the same flame graph
-    tracer.context_provider.activate(parent_context)
-    
-    with tracer.trace("background.topic_classification") as span:
-
-        result = msg_classifier(query, CANDIDATE_LABELS)
-
-        top_topic = result['labels'][0]
-        #confidence = result['scores'][0]
-        
-        # Tag the span for analysis
-        span.set_tags({"user.topic": top_topic, "user.confusion_score": float(confusion_score)})     
-        # Emit a metric for dashboards
-        print(f"Background task finished. Topic: {top_topic}")
-
-async def get_confusion_score(text, parent_context):
-    # Run inference
-    tracer.context_provider.activate(parent_context)
-    
-    with tracer.trace("background.confusion_score") as span:
-
-        results = emotion_pipeline(text) # Returns list of lists [[{'label': 'confusion', 'score': 0.9}, ...]]
-        
-        # Extract just the 'confusion' score
-        # The output is a list of dicts; we find the one where label='confusion'
-        confusion_score = next(item['score'] for item in results[0] if item['label'] == 'confusion')
-
-        span.set_metric("user.confusion_score", float(confusion_score))
-        return confusion_score
-
-async def set_emotion(text, parent_context):
-    tracer.context_provider.activate(parent_context)
-    
-    with tracer.trace("background.emotion_classification") as span:
-        result = sentiment_pipeline(text)
-        emotion = result[0]['label']
-        span.set_tag("user.emotion", emotion)
-
-
-async def set_emotion_tags(text, parent_context):
-    await set_emotion(text, parent_context)
-    confusion_score = await get_confusion_score(text, parent_context)
-    await tag_message(text, parent_context, confusion_score)
\ No newline at end of file
+
+from inference_worker import MicroBatchWorker
+from startup import components
+from topic_classifier import TOPIC_CLASSIFIER, build_classifier
+
+# Models are loaded once per process by the startup manager (in the background or on
+# first use), so importing this module no longer pulls in torch or any weights.
+
+
+@lru_cache(maxsize=None)
+def get_device():
+    import torch
+
+    return "mps" if torch.backends.mps.is_available() else "cpu"
+
+
+def _load_emotion_pipeline():
+    from transformers import pipeline
+
+    return pipeline("text-classification",
+                    model="SamLowe/roberta-base-go_emotions",
+                    top_k=None,
+                    device=get_device())
+
+
+def _load_sentiment_pipeline():
+    from transformers import pipeline
+
+    return pipeline("sentiment-analysis", model="distilbert-base-uncased-finetuned-sst-2-english", device=get_device())
+
+
+# Tagging runs off the request path, so these models do not hold back readiness.
+components.register("sentiment_pipeline", _load_sentiment_pipeline,
+                    warmup=lambda model: model(["warmup"]), required=False)
+components.register("emotion_pipeline", _load_emotion_pipeline,
+                    warmup=lambda model: model(["warmup"]), required=False)
+# Zero-shot BART or MiniLM prototype similarity, selected by TOPIC_CLASSIFIER
+components.register("topic_classifier", lambda: build_classifier(TOPIC_CLASSIFIER, device=get_device()),
+                    warmup=lambda model: model(["warmup"]), required=False)
+
+
+def _timed_inference(model: str, run, batch_size: int):
+    """Run one model over the batch; return its output and the batch latency in ms (also sent to statsd)."""
+    start = time.perf_counter()
+    result = run()
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    statsd.distribution("chatbot.tagging.inference_ms", elapsed_ms, tags=["model:{}".format(model)])
+    statsd.distribution("chatbot.tagging.inference_ms_per_message", elapsed_ms / batch_size,
+                        tags=["model:{}".format(model)])
+    return result, elapsed_ms
+
+
+def tag_batch(items):
+    """
+    Run each classifier once over a batch of (text, parent_context) pairs, then
+    record the per-message spans under each message's original trace.
+
+    The spans are only opened once inference is done, so their own duration is
+    near zero; each carries its model's batch latency (inference.batch_ms) and
+    batch size instead.
+    """
+    texts = [text for text, _ in items]
+    batch_size = len(texts)
+    sentiments, sentiment_ms = _timed_inference(
+        "sentiment", lambda: components.get("sentiment_pipeline")(texts, batch_size=batch_size), batch_size)
+    # Returns one list per text: [{'label': 'confusion', 'score': 0.9}, ...]
+    emotions, emotion_ms = _timed_inference(
+        "emotion", lambda: components.get("emotion_pipeline")(texts, batch_size=batch_size), batch_size)
+    topics, topic_ms = _timed_inference(
+        "topic", lambda: components.get("topic_classifier")(texts), batch_size)
+
+    for (text, parent_context), sentiment, emotion_scores, topic in zip(items, sentiments, emotions, topics):
+        # REACTIVATE the parent trace so these spans appear in the same flame graph
+        tracer.context_provider.activate(parent_context)
+
+        with tracer.trace("background.emotion_classification") as span:
+            span.set_tag("user.emotion", sentiment['label'])
+            span.set_metric("inference.batch_ms", sentiment_ms)
+            span.set_metric("inference.batch_size", batch_size)
+
+        with tracer.trace("background.confusion_score") as span:
+            # Extract just the 'confusion' score
+            confusion_score = next(item['score'] for item in emotion_scores if item['label'] == 'confusion')
+            span.set_metric("user.confusion_score", float(confusion_score))
+            span.set_metric("inference.batch_ms", emotion_ms)
+            span.set_metric("inference.batch_size", batch_size)
+
+        with tracer.trace("background.topic_classification") as span:
+            top_topic = topic['labels'][0]
+            span.set_metric("inference.batch_ms", topic_ms)
+            span.set_metric("inference.batch_size", batch_size)
+            # Tag the span for analysis
+            span.set_tags({
+                "user.topic": top_topic,
+                "user.confusion_score": float(confusion_score),
+                "topic.classifier": TOPIC_CLASSIFIER,
+            })
+            print(f"Background task finished. Topic: {top_topic}")
+
+
+# Messages from concurrent requests are batched here so the models never run on the request path.
+tagging_worker = MicroBatchWorker("emotion_tags", tag_batch)
+
+
+def set_emotion_tags(text, parent_context) -> bool:
+    """Queue text for background sentiment/confusion/topic tagging; never blocks the caller."""
+    return tagging_worker.submit((text, parent_context))
@@ -1,26 +1,32 @@
 from __future__ import annotations
 import asyncio
 import subprocess
+import time
 from datadog.dogstatsd.base import statsd
 from dotenv import load_dotenv
 import os
-from contextlib import contextmanager
+import uuid
 from datetime import datetime, timezone
-from flask import Flask, jsonify, request, session
+from flask import Flask, Response, jsonify, request, session
 from typing import Any, Dict, Optional
 from ddtrace import patch_all
 from ddtrace import tracer
 patch_all(llm_providers=["langchain"])
-from llm import State, chatagent
+from llm import State, chatagent, sql_plan_cache
+import async_runtime
+from chat_stream import ChatStream
+import cost_ledger
+from startup import components
+from llm_cache import llm_cache
 
-import psycopg
-
-from db_utils import get_db_conn, DB_SETTINGS
+from db_utils import get_db_conn, get_pool_stats, start_pool_stats_reporter
 
 from utils import (
   create_session, 
   validate_session,
-  increment_session_count
+  increment_session_count,
+  flush_session_activity,
+  start_session_reaper
 )
 
 from llm_utils import set_emotion_tags
@@ -37,6 +43,15 @@ SESSION_COOKIE_SECURE = bool(int(os.getenv('SESSION_COOKIE_SECURE', '0')))
 SESSION_COOKIE_SAMESITE = os.getenv('SESSION_COOKIE_SAMESITE', 'Lax')
 SESSION_COOKIE_MAX_AGE = int(os.getenv('SESSION_COOKIE_MAX_AGE_SECONDS', str(60 * 60 * 12)))
 SESSION_MAX_AGE_SECONDS = int(os.getenv('SESSION_MAX_AGE_SECONDS', '300'))  # default 5 minutes
+DB_POOL_STATS_INTERVAL_SECONDS = float(os.getenv('DB_POOL_STATS_INTERVAL_SECONDS', '15'))
+# Users allowed to read everyone's costs from /api/costs; everyone else only sees their own
+COST_ADMIN_USERS = {u.strip().lower() for u in os.getenv('COST_ADMIN_USERS', '').split(',') if u.strip()}
+
+start_pool_stats_reporter(DB_POOL_STATS_INTERVAL_SECONDS)
+cost_ledger.start_flusher()
+start_session_reaper()
+# Models and the policy index load in the background; /ready reports when they are done
+components.start()
 
 @app.after_request
 def add_cors_headers(response):
@@ -50,16 +65,6 @@ def add_cors_headers(response):
   return response
 
 
-@contextmanager
-def get_db_conn():
-  conn = psycopg.connect(**DB_SETTINGS)
-  try:
-    yield conn
-  finally:
-    conn.close()
-
-
-
 @app.route('/api/login', methods=['POST'])
 def login() -> Any:
   payload: Dict[str, Any] = request.get_json(silent=True) or {}
@@ -70,6 +75,8 @@ def login() -> Any:
   user_identifier = str(payload.get('email') or payload.get('user') or '').strip()
   if not user_identifier:
     return jsonify({'error': 'Missing user identifier (email or user)'}), 400
+  # Kept in the signed session too; the plain cookie is not proof of who is asking
+  session["user_identifier"] = user_identifier
 
   try:
     session_id = create_session(user_identifier)
@@ -105,6 +112,47 @@ def health() -> Any:
   return jsonify({'status': 'ok', 'timestamp': datetime.now(timezone.utc).isoformat()})
 
 
+@app.route('/ready', methods=['GET'])
+def ready() -> Any:
+  """Readiness for load balancers: 503 until every required component is loaded and warmed up."""
+  status = components.status()
+  return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route('/health/db', methods=['GET'])
+def db_health() -> Any:
+  """Connection pool stats: size, in-use, saturation and average checkout wait."""
+  try:
+    with get_db_conn() as conn:
+      conn.execute("SELECT 1;")
+  except Exception as exc:
+    return jsonify({'status': 'error', 'error': str(exc), 'pools': get_pool_stats()}), 503
+  return jsonify({'status': 'ok', 'pools': get_pool_stats()})
+
+
+@app.route('/health/cache', methods=['GET'])
+def cache_health() -> Any:
+  """LLM reply cache: hit ratio per node, entries and memory/disk footprint; SQL plan cache hit ratio."""
+  return jsonify({**llm_cache.stats(), 'sql_plan_cache': sql_plan_cache.stats()})
+
+
+def initial_state(query: str, session_id: str) -> State:
+  return {
+    "messages": [],
+    "query": query,
+    "context": "",
+    "rag_type": "",
+    "rag_relevant": False,
+    "answer": "",
+    "is_question": True,
+    "user_identifier": request.cookies.get('user_identifier') or "",
+    "sql_query": "",
+    "session_id": session_id,
+    "request_id": uuid.uuid4().hex,
+    "started_at": time.perf_counter(),
+  }
+
+
 @app.route('/api/chat', methods=['POST'])
 async def chat() -> Any:
   
@@ -112,10 +160,10 @@ async def chat() -> Any:
     return jsonify({'error': 'Unauthorized. Please login first.'}), 401
 
   session_id = request.cookies.get('session_id')
-  if not validate_session(session_id):
+  if not await asyncio.to_thread(validate_session, session_id):
     return jsonify({'error': 'Session expired or invalid. Please login again.'}), 401
 
-  increment_session_count(session_id)
+  await asyncio.to_thread(increment_session_count, session_id)
 
   payload: Dict[str, Any] = request.get_json(silent=True) or {}
   query = str(payload.get('prompt', '')).strip()
@@ -125,33 +173,98 @@ async def chat() -> Any:
   
    
   current_context = tracer.current_trace_context()
-  asyncio.create_task(set_emotion_tags(query,current_context))
+  set_emotion_tags(query, current_context)
   
-  state: State = {
-    "messages": [],
-    "query": query,
-    "context": "",
-    "rag_type": "",
-    "rag_relevant": False,
-    "answer": "",
-    "is_question": True,
-    "user_identifier": request.cookies.get('user_identifier') or "",
-    "sql_query": "",
-  }
+  state = initial_state(query, session_id)
   if not state["user_identifier"]:
     return jsonify({'error': 'Missing user identifier'}), 400
 
-  response = await chatagent.ainvoke(state)
+  request_id = state["request_id"]
+
+  async def run_graph():
+    with cost_ledger.request_scope(request_id, session_id, state["user_identifier"]):
+      return await chatagent.ainvoke(state)
+
+  # Run the graph on the shared loop so concurrent conversations overlap their I/O.
+  response = await async_runtime.run(run_graph(), current_context)
 
   return jsonify(
       {
           'prompt': query,
           'reply': response['answer'],
+          'request_id': request_id,
           'received_at': datetime.now(timezone.utc).isoformat()
       }
   )
 
 
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream() -> Any:
+  """Same as /api/chat, answered as Server-Sent Events: status per graph step, answer tokens, then done."""
+  received = time.perf_counter()
+
+  if not session.get("is_authorized"):
+    return jsonify({'error': 'Unauthorized. Please login first.'}), 401
+
+  session_id = request.cookies.get('session_id')
+  if not validate_session(session_id):
+    return jsonify({'error': 'Session expired or invalid. Please login again.'}), 401
+
+  increment_session_count(session_id)
+
+  payload: Dict[str, Any] = request.get_json(silent=True) or {}
+  query = str(payload.get('prompt', '')).strip()
+
+  if not query:
+    return jsonify({'error': 'Missing query'}), 400
+
+  current_context = tracer.current_trace_context()
+  set_emotion_tags(query, current_context)
+
+  state = initial_state(query, session_id)
+  if not state["user_identifier"]:
+    return jsonify({'error': 'Missing user identifier'}), 400
+
+  stream = ChatStream(state, received)
+  stream.start(current_context)
+  return Response(
+    stream.events_sse(),
+    mimetype='text/event-stream',
+    # Keep proxies (nginx) from buffering the events
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+  )
+
+
+@app.route('/api/costs', methods=['GET'])
+def costs() -> Any:
+  """
+  Accumulated LLM cost; narrow with ?dimension=request|session|user|node|model and &key=...
+  Callers outside COST_ADMIN_USERS only get the user and session dimensions, for their own user and session.
+  """
+  if not session.get("is_authorized"):
+    return jsonify({'error': 'Unauthorized. Please login first.'}), 401
+  dimension = request.args.get('dimension')
+  key = request.args.get('key')
+  user_identifier = session.get("user_identifier") or ""
+  if user_identifier.lower() in COST_ADMIN_USERS:
+    try:
+      return jsonify(cost_ledger.ledger.totals(dimension, key))
+    except ValueError as exc:
+      return jsonify({'error': str(exc)}), 400
+
+  own = {'user': user_identifier, 'session': request.cookies.get('session_id')}
+  if dimension is None:
+    dimensions = [dim for dim, value in own.items() if value and key in (None, value)]
+  elif dimension in own and own[dimension] and key in (None, own[dimension]):
+    dimensions = [dimension]
+  else:
+    return jsonify({'error': 'Forbidden: only your own user and session costs are available.'}), 403
+  totals = {}
+  for dim in dimensions:
+    totals.update(cost_ledger.ledger.totals(dim, own[dim]))
+  return jsonify(totals)
+
+
 @app.route('/api/logout', methods=['POST'])
 def close_session() -> Any:
   session_id = request.cookies.get('session_id')
@@ -159,6 +272,7 @@ def close_session() -> Any:
   if not session_id:
     return jsonify({'error': 'Missing session'}), 400
 
+  flush_session_activity()
   with get_db_conn() as conn, conn.cursor() as cur:
     res = cur.execute("SELECT conversation_count FROM user_sessions WHERE user_identifier = %s ;", (user_identifier,))
     for chat_length in res:
@@ -171,6 +285,8 @@ def close_session() -> Any:
         )
     cur.execute("DELETE FROM user_sessions WHERE session_id = %s;", (session_id,))
     conn.commit()
+  # Evict only once the row is gone, so a concurrent request cannot re-cache the session as valid
+  flush_session_activity(session_id)
 
   response = jsonify({'status': 'closed'})
   response.delete_cookie('session_id', path='/')
@@ -186,9 +302,12 @@ def close_all_sessions() -> Any:
   if not user_identifier:
     return jsonify({'error': 'Missing user identifier'}), 400
 
+  flush_session_activity()
   with get_db_conn() as conn, conn.cursor() as cur:
     res = cur.execute("SELECT session_id, conversation_count FROM user_sessions WHERE user_identifier = %s;", (user_identifier,))
+    closed_sessions = []
     for session_id, chat_length in res:
+        closed_sessions.append(str(session_id))
         statsd.distribution(
             "chatbot.session.chat_length",
             chat_length,
@@ -198,6 +317,7 @@ def close_all_sessions() -> Any:
         )
     cur.execute("DELETE FROM user_sessions WHERE user_identifier = %s;", (user_identifier,))
     conn.commit()
+  flush_session_activity(*closed_sessions)
 
   resp = jsonify({'status': 'all sessions closed'})
   resp.delete_cookie('session_id', path='/')
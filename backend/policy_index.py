@@ -0,0 +1,173 @@
+"""
+On-disk cache of the policy embedding index.
+
+Each index is stored under POLICY_INDEX_DIR as two files named after its key:
+
+  <key>.npy   (chunks, dim) matrix of L2-normalized embeddings, float32 or float16
+  <key>.json  model, dtype, chunk texts, metadata and a hash per chunk
+
+The key is a hash of the source file bytes, the chunking settings, the
+embedding model and the dtype, so any change to one of them produces a new
+index while an unchanged deployment loads the existing one without running the
+splitter or the model. The matrix is opened with np.load(mmap_mode="r"): every
+worker on the host maps the same file and shares one page-cache copy.
+
+When the key is new, chunks whose text hash appears in an earlier index for the
+same model reuse that row, so editing one policy only re-embeds the chunks it
+touched. Files are written to a temporary name and renamed into place, so a
+worker never reads a half-written index even if several build at once.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Callable, List
+
+import numpy as np
+
+from vector_store import normalize_rows
+
+POLICY_INDEX_DIR = os.getenv(
+    "POLICY_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "policy_index")
+)
+POLICY_INDEX_DTYPE = os.getenv("POLICY_INDEX_DTYPE", "float32")
+POLICY_INDEX_KEEP = int(os.getenv("POLICY_INDEX_KEEP", "3"))
+
+POLICY_INDEX_DTYPES = ("float32", "float16")
+
+
+@dataclass
+class PersistedIndex:
+    key: str
+    texts: List[str]
+    metadatas: List[dict]
+    matrix: np.ndarray
+    embedded: int  # chunks embedded while building; 0 when loaded from disk
+
+
+def _sha256(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def index_key(source_path: str, settings: dict, model: str, dtype: str) -> str:
+    with open(source_path, "rb") as f:
+        source = f.read()
+    return _sha256(source, json.dumps(settings, sort_keys=True), model, dtype)[:32]
+
+
+def _write_atomic(path: str, write: Callable) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _load(index_dir: str, key: str):
+    meta_path = os.path.join(index_dir, key + ".json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    matrix = np.load(os.path.join(index_dir, key + ".npy"), mmap_mode="r")
+    return meta, matrix
+
+
+def _reusable_rows(index_dir: str, model: str) -> dict:
+    """chunk hash -> embedding row from earlier indexes built with the same model, newest first."""
+    rows = {}
+    metas = sorted(glob.glob(os.path.join(index_dir, "*.json")), key=os.path.getmtime, reverse=True)
+    for meta_path in metas:
+        key = os.path.splitext(os.path.basename(meta_path))[0]
+        try:
+            meta, matrix = _load(index_dir, key)
+        except (OSError, ValueError):
+            continue
+        if meta.get("model") != model:
+            continue
+        for i, chunk_hash in enumerate(meta["chunk_hashes"]):
+            rows.setdefault(chunk_hash, matrix[i])
+    return rows
+
+
+def _prune(index_dir: str, keep: int) -> None:
+    metas = sorted(glob.glob(os.path.join(index_dir, "*.json")), key=os.path.getmtime, reverse=True)
+    for meta_path in metas[keep:]:
+        for path in (meta_path, os.path.splitext(meta_path)[0] + ".npy"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def load_or_build(
+    source_path: str,
+    settings: dict,
+    split: Callable[[], list],
+    embeddings,
+    model: str,
+    index_dir: str = POLICY_INDEX_DIR,
+    dtype: str = POLICY_INDEX_DTYPE,
+    keep: int = POLICY_INDEX_KEEP,
+) -> PersistedIndex:
+    """
+    Purpose: return the embedding index for source_path, building and persisting it only when missing.
+    Input: settings (chunking parameters, part of the key); split() -> list of Documents, only
+           called on a miss; embeddings (LangChain Embeddings) for chunks not found in earlier
+           indexes; model name; dtype "float32" or "float16".
+    Output: PersistedIndex whose matrix is memory-mapped from index_dir.
+    Errors: ValueError for an unknown dtype; OSError if index_dir is not writable on a miss.
+    """
+    if dtype not in POLICY_INDEX_DTYPES:
+        raise ValueError(f"POLICY_INDEX_DTYPE must be one of {', '.join(POLICY_INDEX_DTYPES)}")
+    os.makedirs(index_dir, exist_ok=True)
+    key = index_key(source_path, settings, model, dtype)
+    loaded = _load(index_dir, key)
+    if loaded is not None:
+        meta, matrix = loaded
+        return PersistedIndex(key, meta["texts"], meta["metadatas"], matrix, embedded=0)
+
+    documents = split()
+    texts = [doc.page_content for doc in documents]
+    metadatas = [dict(doc.metadata) for doc in documents]
+    chunk_hashes = [_sha256(text) for text in texts]
+
+    previous = _reusable_rows(index_dir, model)
+    missing = [i for i, chunk_hash in enumerate(chunk_hashes) if chunk_hash not in previous]
+    fresh = normalize_rows(embeddings.embed_documents([texts[i] for i in missing])) if missing else None
+    if fresh is not None:
+        dim = fresh.shape[1]
+    else:
+        dim = len(next(iter(previous.values()))) if previous else 0
+    matrix = np.empty((len(texts), dim), dtype=dtype)
+    fresh_rows = dict(zip(missing, fresh if fresh is not None else ()))
+    for i, chunk_hash in enumerate(chunk_hashes):
+        matrix[i] = fresh_rows[i] if i in fresh_rows else previous[chunk_hash]
+
+    # Matrix first, metadata last: _load treats the .json file as the "index is complete" marker.
+    _write_atomic(os.path.join(index_dir, key + ".npy"), lambda f: np.save(f, matrix))
+    meta = {
+        "model": model,
+        "dtype": dtype,
+        "settings": settings,
+        "texts": texts,
+        "metadatas": metadatas,
+        "chunk_hashes": chunk_hashes,
+    }
+    _write_atomic(
+        os.path.join(index_dir, key + ".json"),
+        lambda f: f.write(json.dumps(meta, default=str).encode("utf-8")),
+    )
+    _prune(index_dir, keep)
+    meta, matrix = _load(index_dir, key)
+    return PersistedIndex(key, meta["texts"], meta["metadatas"], matrix, embedded=len(missing))
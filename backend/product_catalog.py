@@ -0,0 +1,159 @@
+"""
+In-memory product catalog index used by the order tools to resolve product names.
+
+The catalog is loaded once and kept in memory. A refresh is triggered only when
+catalog_version.version (bumped by a trigger on products, see db/init.sql)
+changes; the version itself is checked at most every CATALOG_VERSION_CHECK_SECONDS,
+so most resolutions never touch the database.
+
+Names are normalized once at load time. Resolution tries, in order:
+  1. exact match on the normalized name (dict lookup),
+  2. fuzzy match (rapidfuzz WRatio) over products sharing a token with the query,
+  3. fuzzy match over the whole catalog, batched across names with cdist.
+
+Building the index and matching are CPU-bound, so both run in a worker thread
+instead of on the shared event loop.
+"""
+
+import asyncio
+import os
+import re
+import time
+from decimal import Decimal
+from typing import Sequence
+
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
+
+CATALOG_VERSION_CHECK_SECONDS = float(os.getenv("CATALOG_VERSION_CHECK_SECONDS", "5"))
+CATALOG_SCORE_CUTOFF = int(os.getenv("CATALOG_SCORE_CUTOFF", "70"))
+
+
+def normalize_name(name: str) -> str:
+    """Strip digits (quantities typed into the name), lowercase and drop punctuation."""
+    return default_process(re.sub(r"\d+", "", name))
+
+
+def _token_key(token: str) -> str:
+    # Cheap plural folding so "mats" finds "mat".
+    return token[:-1] if len(token) > 3 and token.endswith("s") else token
+
+
+class _CatalogIndex:
+    def __init__(self, rows: Sequence[tuple], version):
+        self.version = version
+        self.products = []
+        self.names = []
+        self.by_name = {}
+        self.by_token = {}
+        for pname, sku, product_id, price in rows:
+            idx = len(self.products)
+            normalized = default_process(pname)
+            self.products.append({"sku": sku, "product_id": product_id, "price": Decimal(price)})
+            self.names.append(normalized)
+            self.by_name.setdefault(normalized, idx)
+            for token in set(normalized.split()):
+                self.by_token.setdefault(_token_key(token), []).append(idx)
+
+    def candidates(self, normalized: str) -> list:
+        found = set()
+        for token in normalized.split():
+            found.update(self.by_token.get(_token_key(token), ()))
+        return sorted(found)
+
+
+class ProductCatalog:
+    def __init__(self, connection_factory, score_cutoff: int = CATALOG_SCORE_CUTOFF,
+                 check_interval: float = CATALOG_VERSION_CHECK_SECONDS):
+        """connection_factory: async context manager yielding a psycopg AsyncConnection."""
+        self._connect = connection_factory
+        self.score_cutoff = score_cutoff
+        self.check_interval = check_interval
+        self._index = None
+        self._next_check = 0.0
+
+    async def refresh(self) -> None:
+        """Reload the catalog from the database unconditionally."""
+        async with self._connect() as conn, conn.cursor() as cur:
+            await cur.execute("SELECT version FROM catalog_version")
+            row = await cur.fetchone()
+            await cur.execute("SELECT name, sku, product_id, unit_price FROM products ORDER BY product_id")
+            rows = await cur.fetchall()
+        # Swap in a fully built index so concurrent readers never see a partial one.
+        self._index = await asyncio.to_thread(_CatalogIndex, rows, row[0] if row else None)
+        self._next_check = time.monotonic() + self.check_interval
+
+    async def ensure_fresh(self) -> _CatalogIndex:
+        if self._index is None:
+            await self.refresh()
+        elif time.monotonic() >= self._next_check:
+            async with self._connect() as conn, conn.cursor() as cur:
+                await cur.execute("SELECT version FROM catalog_version")
+                row = await cur.fetchone()
+            if (row[0] if row else None) != self._index.version:
+                await self.refresh()
+            else:
+                self._next_check = time.monotonic() + self.check_interval
+        return self._index
+
+    def _match_one(self, index: _CatalogIndex, normalized: str):
+        exact = index.by_name.get(normalized)
+        if exact is not None:
+            return exact
+        candidates = index.candidates(normalized)
+        if candidates:
+            match = process.extractOne(
+                normalized,
+                [index.names[i] for i in candidates],
+                scorer=fuzz.WRatio,
+                processor=None,
+                score_cutoff=self.score_cutoff,
+            )
+            if match:
+                return candidates[match[2]]
+        return None
+
+    def match_many(self, index: _CatalogIndex, normalized_names: Sequence[str]) -> list:
+        """Return the catalog position for each name, or None when nothing clears the cutoff."""
+        matches = [self._match_one(index, name) for name in normalized_names]
+        leftovers = [i for i, match in enumerate(matches) if match is None]
+        if leftovers and index.names:
+            scores = process.cdist(
+                [normalized_names[i] for i in leftovers],
+                index.names,
+                scorer=fuzz.WRatio,
+                processor=None,
+                score_cutoff=self.score_cutoff,
+                workers=-1,
+            )
+            for row, i in enumerate(leftovers):
+                best = int(scores[row].argmax())
+                if scores[row][best] >= self.score_cutoff:
+                    matches[i] = best
+        return matches
+
+    async def resolve_many(self, names: Sequence[str]) -> list:
+        """
+        Purpose: resolve product name fragments to catalog entries in one pass.
+        Input: names (list[str]), tolerant of plurals/extra words; digits are stripped before matching.
+        Output: list of {"sku": str, "product_id": int, "price": Decimal}, in input order.
+        Errors: raises ValueError for the first name that is empty or has no confident match.
+        """
+        normalized = []
+        for name in names:
+            cleaned = normalize_name(name)
+            if not cleaned:
+                raise ValueError("Product name is empty after cleaning")
+            normalized.append(cleaned)
+
+        index = await self.ensure_fresh()
+        resolved = []
+        matches = await asyncio.to_thread(self.match_many, index, normalized)
+        for name, match in zip(names, matches):
+            if match is None:
+                raise ValueError(f"No products matched '{name}'")
+            resolved.append(dict(index.products[match]))
+        return resolved
+
+    async def resolve(self, name: str) -> dict:
+        return (await self.resolve_many([name]))[0]
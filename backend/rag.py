@@ -2,58 +2,95 @@ from operator import itemgetter
 from ddtrace import patch_all
 patch_all(llm_providers=["langchain"])
 from ddtrace import tracer
+import os
 import nltk
 from nltk.tokenize import word_tokenize
-nltk.download('punkt')
 from langchain_community.document_loaders import UnstructuredMarkdownLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_core.vectorstores import InMemoryVectorStore
 from langchain_community.document_loaders import UnstructuredMarkdownLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from startup import components
+from policy_index import load_or_build
+from vector_store import MatrixVectorStore
 
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+# Tokenizer data is downloaded once into this directory and reused on later boots
+NLTK_DATA_DIR = os.getenv("NLTK_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "nltk_data"))
 
-def initialize_vector_store():
-    
+
+def ensure_nltk_data():
+    if NLTK_DATA_DIR not in nltk.data.path:
+        nltk.data.path.insert(0, NLTK_DATA_DIR)
+    try:
+        nltk.data.find("tokenizers/punkt")
+    except LookupError:
+        nltk.download("punkt", download_dir=NLTK_DATA_DIR, quiet=True, raise_on_error=True)
+
+
+def get_embeddings():
+    # One MiniLM instance per process, shared by the policy store and the topic classifier
+    return components.get("embeddings")
+
+
+components.register("nltk_punkt", ensure_nltk_data)
+components.register(
+    "embeddings",
+    lambda: HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL),
+    warmup=lambda embeddings: embeddings.embed_query("warmup"),
+)
+
+
+POLICIES_PATH = "db/policies.md"
+# Part of the persisted index key: changing any of these re-chunks and re-embeds
+CHUNK_SETTINGS = {
+    "chunk_size": 500,
+    "chunk_overlap": 50,
+    "separators": ["\n\n", "\n", " ", ""],
+}
+
+
+def split_policies():
     # A. Load the Markdown File
     # This reads your 50+ policies file
-    loader = UnstructuredMarkdownLoader("db/policies.md")
+    loader = UnstructuredMarkdownLoader(POLICIES_PATH)
     raw_documents = loader.load()
 
     # B. Split Text into Chunks
     # We use a small chunk size (500 chars) to catch specific policy headers
     # Overlap (50 chars) ensures we don't cut a sentence in half
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,
-        chunk_overlap=50,
-        separators=["\n\n", "\n", " ", ""] # Try to split by paragraphs first
-    )
-    documents = text_splitter.split_documents(raw_documents)
-    #print(f"Split into {len(documents)} chunks.")
-
-    # C. Initialize Embeddings (Vertex AI)
-    # This converts your text chunks into number lists (vectors)
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-
-    # D. Create the Store (In-Memory)
-    # This creates a search index in your RAM
-    vectorstore = InMemoryVectorStore.from_documents(
-        documents=documents,
-        embedding=embeddings
-    )
-    return vectorstore
+    # Separators try to split by paragraphs first
+    text_splitter = RecursiveCharacterTextSplitter(**CHUNK_SETTINGS)
+    return text_splitter.split_documents(raw_documents)
+
+
+def initialize_vector_store():
+    # C. Load the embedding index from disk, embedding only chunks that changed
+    # since the last build (see policy_index.py)
+    embeddings = get_embeddings()
+    index = load_or_build(POLICIES_PATH, CHUNK_SETTINGS, split_policies, embeddings, EMBEDDING_MODEL)
+    print(f"Policy index {index.key}: {len(index.texts)} chunks, {index.embedded} embedded.")
+
+    # D. Create the Store over the memory-mapped matrix
+    # Every worker on the host shares the same page-cache copy of the embeddings
+    return MatrixVectorStore(embeddings, index.texts, index.metadatas, index.matrix)
 
 
 # Define the RAG Chain
 def format_docs(docs):
     # Helper to join the retrieved chunks into one string
     content = "\n\n".join(doc.page_content for doc in docs)
+    components.get("nltk_punkt")
     tokens = word_tokenize(content)
     current_span = tracer.current_span()
     if current_span:
         current_span.set_metric("rag.context_size", len(tokens))
     return "\n\n".join(doc.page_content for doc in docs)
 
+def get_context_chain(retriever):
+    # query string -> retrieved policy chunks joined into one context string
+    return retriever | format_docs
+
 def get_rag_chain(retriever, model, prompt):
     rag_chain = (
     {"context": itemgetter("question") | retriever | format_docs, "question": itemgetter("question")}
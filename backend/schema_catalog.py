@@ -0,0 +1,239 @@
+"""
+Relevance-pruned schema context for generate_query.
+
+generate_schema_summary.py writes a structured catalog next to
+support_schema.txt: every table with its columns, foreign keys and a short
+description (support_schema_catalog.json), plus one MiniLM embedding per table
+(support_schema_catalog.npy, rows in table order).
+
+The catalog is loaded once per process and reloaded when the JSON file changes
+(its mtime is checked at most every SCHEMA_CATALOG_CHECK_SECONDS). Missing or
+stale embeddings (another model, another table count) are recomputed on load.
+
+For a question, the SCHEMA_TOP_K tables most similar to it are selected and
+connected through the foreign-key graph: each one is joined to the tables
+already chosen along the shortest path of at most SCHEMA_MAX_JOIN_HOPS foreign
+keys, and the tables on that path are included too. Catalogs with fewer than
+SCHEMA_PRUNE_MIN_TABLES tables are rendered whole. Without a catalog file,
+generate_query falls back to support_schema.txt.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from vector_store import normalize_rows, top_k
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_CATALOG_PATH = os.getenv("SCHEMA_CATALOG_PATH", os.path.join(_DIR, "support_schema_catalog.json"))
+SCHEMA_TOP_K = int(os.getenv("SCHEMA_TOP_K", "5"))
+SCHEMA_PRUNE_MIN_TABLES = int(os.getenv("SCHEMA_PRUNE_MIN_TABLES", "20"))
+SCHEMA_MAX_JOIN_HOPS = int(os.getenv("SCHEMA_MAX_JOIN_HOPS", "3"))
+SCHEMA_CATALOG_CHECK_SECONDS = float(os.getenv("SCHEMA_CATALOG_CHECK_SECONDS", "5"))
+
+
+@dataclass
+class Table:
+    name: str
+    description: str
+    columns: List[dict]  # {"name", "type", "nullable", "description"}
+    foreign_keys: List[dict]  # {"columns": [...], "references": table, "ref_columns": [...]}
+
+    def embedding_text(self) -> str:
+        """What a table's embedding is computed from: its name, description, columns and references."""
+        parts = [self.name.replace("_", " ")]
+        if self.description:
+            parts.append(self.description)
+        parts.append("columns: " + ", ".join(column["name"].replace("_", " ") for column in self.columns))
+        references = sorted({fk["references"] for fk in self.foreign_keys})
+        if references:
+            parts.append("references: " + ", ".join(references))
+        return ". ".join(parts)
+
+
+@dataclass
+class Join:
+    left: str
+    right: str
+    condition: str  # "orders.customer_id = customers.customer_id"
+
+
+@dataclass
+class Selection:
+    tables: List[str]  # ranked tables first, then tables only needed for joins
+    ranked: List[str]
+    joins: List[Join] = field(default_factory=list)
+
+
+class SchemaCatalog:
+    def __init__(self, catalog: dict, matrix: Optional[np.ndarray] = None):
+        """catalog: the parsed support_schema_catalog.json; matrix: normalized table embeddings, in table order."""
+        self.database = catalog.get("database", "")
+        self.schema = catalog.get("schema", "")
+        self.model = catalog.get("model")
+        self.tables = [
+            Table(t["name"], t.get("description") or "", t["columns"], t.get("foreign_keys", []))
+            for t in catalog["tables"]
+        ]
+        self.by_name = {table.name: table for table in self.tables}
+        self.matrix = matrix
+        # Undirected foreign-key graph: table -> [(neighbour, join), ...]
+        self.graph: Dict[str, List[Tuple[str, Join]]] = {table.name: [] for table in self.tables}
+        for table in self.tables:
+            for fk in table.foreign_keys:
+                if fk["references"] not in self.graph:
+                    continue
+                condition = " AND ".join(
+                    f"{table.name}.{column} = {fk['references']}.{ref}"
+                    for column, ref in zip(fk["columns"], fk["ref_columns"])
+                )
+                join = Join(table.name, fk["references"], condition)
+                self.graph[table.name].append((fk["references"], join))
+                self.graph[fk["references"]].append((table.name, join))
+
+    def __len__(self) -> int:
+        return len(self.tables)
+
+    def _path(self, start: str, targets: set, max_hops: int) -> Optional[List[Tuple[str, Join]]]:
+        """Shortest foreign-key path from start to any of targets, as [(table, join), ...] steps."""
+        previous = {start: None}
+        queue = deque([(start, 0)])
+        while queue:
+            name, hops = queue.popleft()
+            if name in targets:
+                steps = []
+                while previous[name] is not None:
+                    parent, join = previous[name]
+                    steps.append((parent, join))
+                    name = parent
+                return steps
+            if hops == max_hops:
+                continue
+            for neighbour, join in self.graph[name]:
+                if neighbour not in previous:
+                    previous[neighbour] = (name, join)
+                    queue.append((neighbour, hops + 1))
+        return None
+
+    def select(self, vector: Sequence[float], k: int = SCHEMA_TOP_K,
+               max_hops: int = SCHEMA_MAX_JOIN_HOPS) -> Selection:
+        """
+        Purpose: pick the tables a question needs.
+        Input: the question's embedding.
+        Output: Selection of the k most similar tables plus the tables and joins connecting them.
+        """
+        scores = self.matrix @ normalize_rows(vector)[0]
+        ranked = [self.tables[i].name for i in top_k(scores[None, :], min(k, len(self.tables)))[0]]
+        chosen = [ranked[0]]
+        joins = []
+        for name in ranked[1:]:
+            if name in chosen:
+                continue
+            path = self._path(name, set(chosen), max_hops)
+            if path is None:
+                chosen.append(name)
+                continue
+            chosen.append(name)
+            for table, join in path:
+                if table not in chosen:
+                    chosen.append(table)
+                if join not in joins:
+                    joins.append(join)
+        return Selection(tables=ranked + [name for name in chosen if name not in ranked], ranked=ranked, joins=joins)
+
+    def render(self, selection: Selection = None) -> str:
+        """The schema as prompt text: every table, or only the selected ones with their join paths."""
+        names = selection.tables if selection is not None else [table.name for table in self.tables]
+        lines = [f"Database: {self.database}", f"Schema: {self.schema}"]
+        if selection is not None:
+            lines.append("Only the tables relevant to the question are listed.")
+        lines.append("Tables:")
+        for name in names:
+            table = self.by_name[name]
+            lines.append(f"- {table.name}: {table.description}" if table.description else f"- {table.name}")
+            references = {
+                column: f"{fk['references']}.{ref}"
+                for fk in table.foreign_keys
+                for column, ref in zip(fk["columns"], fk["ref_columns"])
+            }
+            for column in table.columns:
+                nullable = "nullable" if column["nullable"] else "not null"
+                line = f"  - {column['name']}: {column['type']} ({nullable})"
+                if column["name"] in references:
+                    line += f" -> {references[column['name']]}"
+                if column.get("description"):
+                    line += f" -- {column['description']}"
+                lines.append(line)
+        if selection is not None and selection.joins:
+            lines.append("Join paths:")
+            lines.extend(f"- {join.condition}" for join in selection.joins)
+        return "\n".join(lines)
+
+
+def embed_tables(tables: Sequence[Table], embeddings) -> np.ndarray:
+    return normalize_rows(embeddings.embed_documents([table.embedding_text() for table in tables]))
+
+
+def load_catalog(path: str, embeddings_loader: Callable = None, model: str = None) -> SchemaCatalog:
+    """
+    Purpose: read a catalog and its embeddings.
+    Input: the catalog JSON path; embeddings_loader returns the embedding model, called only when the
+           saved embeddings are missing or were made by another model than `model`.
+    Errors: OSError/ValueError for unreadable catalogs.
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    catalog = SchemaCatalog(data)
+    matrix_path = os.path.splitext(path)[0] + ".npy"
+    matrix = None
+    if os.path.exists(matrix_path) and (model is None or data.get("model") == model):
+        matrix = np.load(matrix_path)
+        if matrix.shape[0] != len(catalog):
+            matrix = None
+    if matrix is None and embeddings_loader is not None:
+        matrix = embed_tables(catalog.tables, embeddings_loader())
+    catalog.matrix = matrix
+    return catalog
+
+
+class SchemaCatalogStore:
+    def __init__(self, path: str, embeddings_loader: Callable = None, model: str = None,
+                 check_interval: float = SCHEMA_CATALOG_CHECK_SECONDS):
+        self.path = path
+        self.embeddings_loader = embeddings_loader
+        self.model = model
+        self.check_interval = check_interval
+        self._catalog = None
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[SchemaCatalog]:
+        """The current catalog, reloaded if the file changed since the last check; None without a catalog file."""
+        now = time.monotonic()
+        if now < self._next_check:
+            return self._catalog
+        with self._lock:
+            if now < self._next_check:
+                return self._catalog
+            self._next_check = now + self.check_interval
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                self._catalog, self._mtime = None, None
+                return None
+            if mtime != self._mtime:
+                try:
+                    self._catalog = load_catalog(self.path, self.embeddings_loader, self.model)
+                    self._mtime = mtime
+                    print(f"Schema catalog loaded: {len(self._catalog)} tables from {self.path}")
+                except (OSError, ValueError, KeyError) as exc:
+                    # Keep serving the previous catalog, e.g. while the file is being replaced
+                    print(f"Could not load schema catalog {self.path}: {exc!r}")
+            return self._catalog
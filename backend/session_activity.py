@@ -0,0 +1,169 @@
+"""
+Write-behind buffering for user_sessions activity.
+
+Every chat turn used to issue two UPDATEs against user_sessions (last_seen and
+conversation_count), each with its own commit. SessionActivityBuffer merges
+those touches in memory per session and writes them with a single bulk UPDATE
+every SESSION_ACTIVITY_FLUSH_MS, or sooner once SESSION_ACTIVITY_FLUSH_EVENTS
+events are pending. Call flush() before reading conversation_count (logout) and
+at shutdown; an atexit hook covers the latter.
+
+SessionValidityCache remembers created_at for recently validated sessions for a
+few seconds, so repeated messages in one session skip the database entirely.
+Expiry is still evaluated on every check against the cached created_at.
+"""
+
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from db_utils import get_db_conn
+
+SESSION_ACTIVITY_FLUSH_MS = int(os.getenv("SESSION_ACTIVITY_FLUSH_MS", "500"))
+SESSION_ACTIVITY_FLUSH_EVENTS = int(os.getenv("SESSION_ACTIVITY_FLUSH_EVENTS", "200"))
+SESSION_VALIDITY_CACHE_SECONDS = float(os.getenv("SESSION_VALIDITY_CACHE_SECONDS", "5"))
+SESSION_VALIDITY_CACHE_SIZE = int(os.getenv("SESSION_VALIDITY_CACHE_SIZE", "10000"))
+
+FLUSH_SQL = """
+UPDATE user_sessions AS s
+SET last_seen = GREATEST(s.last_seen, v.last_seen),
+    conversation_count = s.conversation_count + v.increments
+FROM unnest(%s::uuid[], %s::timestamptz[], %s::int[]) AS v(session_id, last_seen, increments)
+WHERE s.session_id = v.session_id;
+"""
+
+
+class SessionActivityBuffer:
+    def __init__(self, flush_interval_ms: int = SESSION_ACTIVITY_FLUSH_MS,
+                 max_pending_events: int = SESSION_ACTIVITY_FLUSH_EVENTS):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending_events = max_pending_events
+        # session_id -> [last_seen, increments]
+        self._pending = {}
+        self._events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def touch(self, session_id: str) -> None:
+        """Record activity (last_seen = now) for session_id."""
+        self._record(session_id, 0)
+
+    def increment(self, session_id: str, count: int = 1) -> None:
+        """Add count to conversation_count for session_id (also counts as activity)."""
+        self._record(session_id, count)
+
+    def _record(self, session_id: str, increments: int) -> None:
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            entry = self._pending.get(session_id)
+            if entry is None:
+                self._pending[session_id] = [now, increments]
+            else:
+                entry[0] = now
+                entry[1] += increments
+            self._events += 1
+            full = self._events >= self.max_pending_events
+        self._ensure_started()
+        if full:
+            self._wakeup.set()
+
+    def _merge_back(self, pending: dict) -> None:
+        # A failed flush must not lose increments; newer touches win for last_seen.
+        with self._lock:
+            for session_id, (last_seen, increments) in pending.items():
+                entry = self._pending.get(session_id)
+                if entry is None:
+                    self._pending[session_id] = [last_seen, increments]
+                else:
+                    entry[0] = max(entry[0], last_seen)
+                    entry[1] += increments
+
+    def flush(self) -> int:
+        """Write all pending activity in one statement. Returns the number of sessions written."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._events = 0
+            if not pending:
+                return 0
+            session_ids = list(pending)
+            try:
+                with get_db_conn() as conn, conn.cursor() as cur:
+                    cur.execute(
+                        FLUSH_SQL,
+                        (
+                            session_ids,
+                            [pending[session_id][0] for session_id in session_ids],
+                            [pending[session_id][1] for session_id in session_ids],
+                        ),
+                    )
+            except Exception:
+                self._merge_back(pending)
+                raise
+            return len(session_ids)
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="session-activity-flush", daemon=True)
+                    self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as exc:  # retried on the next tick
+                print(f"Session activity flush failed: {exc}")
+
+
+class SessionValidityCache:
+    def __init__(self, ttl_seconds: float = SESSION_VALIDITY_CACHE_SECONDS,
+                 max_size: int = SESSION_VALIDITY_CACHE_SIZE):
+        self.ttl = ttl_seconds
+        self.max_size = max_size
+        # session_id -> (created_at, cached_until)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str):
+        """Return the cached created_at for session_id, or None when unknown or stale."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[session_id]
+                return None
+            return entry[0]
+
+    def put(self, session_id: str, created_at: datetime) -> None:
+        with self._lock:
+            self._entries[session_id] = (created_at, time.monotonic() + self.ttl)
+            self._entries.move_to_end(session_id)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def evict(self, *session_ids: str) -> None:
+        with self._lock:
+            for session_id in session_ids:
+                self._entries.pop(session_id, None)
+
+
+activity = SessionActivityBuffer()
+validity_cache = SessionValidityCache()
+
+
+@atexit.register
+def _flush_on_shutdown() -> None:
+    try:
+        activity.flush()
+    except Exception as exc:
+        print(f"Session activity flush at shutdown failed: {exc}")
@@ -0,0 +1,142 @@
+"""
+Serialization of SQL results for the answer LLM.
+
+The formatted result becomes `context` for get_answer, check_rag_relevance and
+check_answer_relevance, so every byte of it is paid for up to three times.
+
+SQL_RESULT_FORMAT selects the layout:
+
+  table  (default) column names once, then one "|"-separated line per row:
+           order_id | status | total | placed_at
+           4 | shipped | 549.00 | 2025-01-04 10:12 UTC
+         Values are formatted by type: Decimals without exponents, floats to 6
+         significant digits, timestamps to the minute in UTC, NULL as "null".
+  rows   the original "col: val, col: val" line per row.
+
+Results over SQL_RESULT_TOKEN_BUDGET estimated tokens (4 characters each; 0
+disables the budget) keep the rows that fit. SQL_RESULT_OVERFLOW decides what
+replaces the rest:
+
+  truncate  a note with the number of rows left out
+  summary   the note plus per-column aggregates over all rows: min/max/sum
+            for numbers, value counts for columns with few distinct values
+
+Compare formats with `python bench_sql_format.py`.
+"""
+
+import math
+import os
+from collections import Counter
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
+from typing import List, Sequence
+
+SQL_RESULT_FORMAT = os.getenv("SQL_RESULT_FORMAT", "table")
+SQL_RESULT_FORMATS = ("table", "rows")
+SQL_RESULT_TOKEN_BUDGET = int(os.getenv("SQL_RESULT_TOKEN_BUDGET", "2000"))
+SQL_RESULT_OVERFLOW = os.getenv("SQL_RESULT_OVERFLOW", "summary")
+SQL_RESULT_OVERFLOWS = ("truncate", "summary")
+
+CHARS_PER_TOKEN = 4
+# Text columns with at most this many distinct values get value counts in the summary
+SUMMARY_MAX_DISTINCT = 10
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def format_value(value) -> str:
+    """Compact, type-aware text for one value."""
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, Decimal):
+        return format(value, "f")
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            return value.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
+        return value.strftime("%Y-%m-%d %H:%M")
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    # Keep one row per line and the column separator unambiguous
+    return str(value).replace("\n", " ").replace("|", "/")
+
+
+def _table_lines(columns: Sequence[str], rows: Sequence[Sequence]) -> List[str]:
+    return [" | ".join(columns)] + [" | ".join(format_value(value) for value in row) for row in rows]
+
+
+def _rows_lines(columns: Sequence[str], rows: Sequence[Sequence]) -> List[str]:
+    # Zip creates pairs like: [('unit_price', 549.00), ('name', 'Lift Desk')]
+    # Result string: "unit_price: 549.00"
+    return [", ".join(f"{col}: {val}" for col, val in zip(columns, row)) for row in rows]
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def summarize(columns: Sequence[str], rows: Sequence[Sequence]) -> str:
+    """Per-column aggregates over rows: min/max/sum of numeric columns, counts of low-cardinality ones."""
+    parts = []
+    for index, column in enumerate(columns):
+        values = [row[index] for row in rows if row[index] is not None]
+        if not values:
+            continue
+        if all(_is_number(value) for value in values):
+            part = f"{column} min {format_value(min(values))}, max {format_value(max(values))}"
+            # Sums of identifiers mean nothing
+            if not (column == "id" or column.endswith("_id")):
+                part += f", sum {format_value(sum(values))}"
+            parts.append(part)
+            continue
+        counts = Counter(format_value(value) for value in values)
+        if len(counts) <= SUMMARY_MAX_DISTINCT and len(counts) < len(values):
+            parts.append(f"{column} " + ", ".join(f"{value} x{count}" for value, count in counts.most_common()))
+    return "; ".join(parts)
+
+
+def serialize(columns: Sequence[str], rows: Sequence[Sequence], fmt: str = SQL_RESULT_FORMAT,
+              token_budget: int = SQL_RESULT_TOKEN_BUDGET, overflow: str = SQL_RESULT_OVERFLOW,
+              more_rows: bool = False) -> str:
+    """
+    Purpose: turn a query result into the context text for the answer LLM.
+    Input: column names and rows; more_rows when the executor stopped before the end of the result.
+    Output: the formatted text, cut to token_budget estimated tokens when it is exceeded.
+    Errors: ValueError for an unknown format or overflow mode.
+    """
+    if fmt not in SQL_RESULT_FORMATS:
+        raise ValueError(f"SQL_RESULT_FORMAT must be one of {', '.join(SQL_RESULT_FORMATS)}")
+    if overflow not in SQL_RESULT_OVERFLOWS:
+        raise ValueError(f"SQL_RESULT_OVERFLOW must be one of {', '.join(SQL_RESULT_OVERFLOWS)}")
+    if not rows:
+        return ""
+    lines = _table_lines(columns, rows) if fmt == "table" else _rows_lines(columns, rows)
+    header = 1 if fmt == "table" else 0
+
+    shown = len(rows)
+    summary = ""
+    if token_budget > 0 and estimate_tokens("\n".join(lines)) > token_budget:
+        summary = summarize(columns, rows) if overflow == "summary" else ""
+        # Leave room for the note and the summary so the whole text stays within budget
+        budget_chars = token_budget * CHARS_PER_TOKEN - len(summary) - 80
+        used = sum(len(line) + 1 for line in lines[:header])
+        shown = 0
+        for line in lines[header:]:
+            used += len(line) + 1
+            if used > budget_chars:
+                break
+            shown += 1
+        shown = max(shown, 1)
+    text = "\n".join(lines[:header + shown])
+    if shown < len(rows):
+        text += f"\n({len(rows) - shown} more rows not shown)"
+        if summary:
+            text += f"\nOver all {len(rows)} rows: {summary}"
+    if more_rows:
+        text += f"\n(the query returned more than {len(rows)} rows; only those were read)"
+    return text
@@ -0,0 +1,125 @@
+"""
+Guarded execution of LLM-generated SQL.
+
+execute_query runs whatever generate_query wrote. With SQL_EXECUTION_MODE=guarded
+(default) every query runs in a read-only transaction that:
+
+  1. sets statement_timeout to SQL_STATEMENT_TIMEOUT_MS for its statements,
+  2. runs EXPLAIN first and refuses the query when the planner's total cost
+     exceeds SQL_MAX_PLAN_COST,
+  3. reads the result through a server-side cursor, SQL_FETCH_SIZE rows at a
+     time, and stops after SQL_MAX_ROWS rows or SQL_MAX_RESULT_BYTES bytes of
+     values, so one unbounded join neither pins a core nor floods the prompt.
+
+Planned cost and rows, actual rows, bytes and time are recorded on the
+sql.guarded_query span and as chatbot.sql_guard.* metrics. A refused or
+timed-out query raises QueryRejected, whose message is meant for get_answer.
+
+SQL_EXECUTION_MODE=plain keeps the previous behaviour (execute + fetchall),
+where cached SQL plans run as prepared statements.
+"""
+
+import os
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+from datadog import statsd
+from ddtrace import tracer
+from psycopg import errors
+
+SQL_EXECUTION_MODE = os.getenv("SQL_EXECUTION_MODE", "guarded")
+SQL_EXECUTION_MODES = ("guarded", "plain")
+SQL_STATEMENT_TIMEOUT_MS = int(os.getenv("SQL_STATEMENT_TIMEOUT_MS", "3000"))
+SQL_MAX_PLAN_COST = float(os.getenv("SQL_MAX_PLAN_COST", "50000"))
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "200"))
+SQL_MAX_RESULT_BYTES = int(os.getenv("SQL_MAX_RESULT_BYTES", "32768"))
+SQL_FETCH_SIZE = int(os.getenv("SQL_FETCH_SIZE", "50"))
+
+
+class QueryRejected(Exception):
+    """The guard refused or stopped a query; the message says why."""
+
+
+@dataclass
+class QueryResult:
+    columns: List[str]
+    rows: List[tuple]
+    truncated: bool  # more rows existed beyond the row or byte cap
+    bytes: int  # summed length of the returned values as text
+
+
+def _row_bytes(row: Sequence) -> int:
+    return sum(len(str(value).encode("utf-8")) for value in row)
+
+
+async def run_guarded(conn, sql_query: str, params: Optional[Sequence] = None,
+                      statement_timeout_ms: int = SQL_STATEMENT_TIMEOUT_MS, max_plan_cost: float = SQL_MAX_PLAN_COST,
+                      max_rows: int = SQL_MAX_ROWS, max_bytes: int = SQL_MAX_RESULT_BYTES,
+                      fetch_size: int = SQL_FETCH_SIZE) -> QueryResult:
+    """
+    Purpose: run one read-only query under a timeout, a plan cost budget and a row/byte cap.
+    Input: an async psycopg connection (not in a transaction), the SQL and its parameters (None for raw SQL).
+    Output: QueryResult with at most max_rows rows.
+    Errors: QueryRejected when the plan is over budget or the statement times out; other database errors
+            (e.g. invalid SQL) propagate.
+    """
+    sql_query = sql_query.strip().rstrip(";")
+    tags = []
+    with tracer.trace("sql.guarded_query") as span:
+        span.set_metric("sql.cost_budget", max_plan_cost)
+        span.set_metric("sql.statement_timeout_ms", statement_timeout_ms)
+        try:
+            async with conn.transaction():
+                await conn.execute("SET TRANSACTION READ ONLY")
+                await conn.execute("SELECT set_config('statement_timeout', %s, true)", [str(statement_timeout_ms)])
+
+                cur = conn.cursor()
+                await cur.execute("EXPLAIN (FORMAT JSON) " + sql_query, params)
+                plan = (await cur.fetchone())[0][0]["Plan"]
+                planned_cost, planned_rows = plan["Total Cost"], plan["Plan Rows"]
+                span.set_metric("sql.planned_cost", planned_cost)
+                span.set_metric("sql.planned_rows", planned_rows)
+                statsd.distribution("chatbot.sql_guard.planned_cost", planned_cost)
+                if planned_cost > max_plan_cost:
+                    tags.append("outcome:over_budget")
+                    raise QueryRejected(
+                        f"The query was not run: its estimated cost {planned_cost:.0f} exceeds the budget "
+                        f"of {max_plan_cost:.0f}."
+                    )
+
+                started = time.perf_counter()
+                rows, size, truncated = [], 0, False
+                async with conn.cursor(name="guarded_query") as server_cursor:
+                    await server_cursor.execute(sql_query, params)
+                    columns = [desc[0] for desc in server_cursor.description]
+                    while not truncated:
+                        batch = await server_cursor.fetchmany(fetch_size)
+                        if not batch:
+                            break
+                        for row in batch:
+                            row_size = _row_bytes(row)
+                            if len(rows) >= max_rows or size + row_size > max_bytes:
+                                truncated = True
+                                break
+                            rows.append(row)
+                            size += row_size
+                actual_ms = (time.perf_counter() - started) * 1000
+        except errors.QueryCanceled as exc:
+            tags.append("outcome:timeout")
+            raise QueryRejected(f"The query was stopped after {statement_timeout_ms} ms.") from exc
+        finally:
+            if tags:
+                span.set_tag("sql.outcome", tags[0].partition(":")[2])
+                statsd.increment("chatbot.sql_guard.rejected", tags=tags)
+
+        span.set_tag("sql.outcome", "truncated" if truncated else "ok")
+        span.set_metric("sql.actual_rows", len(rows))
+        span.set_metric("sql.actual_bytes", size)
+        span.set_metric("sql.actual_ms", actual_ms)
+        span.set_metric("sql.truncated", int(truncated))
+        statsd.distribution("chatbot.sql_guard.actual_ms", actual_ms)
+        statsd.distribution("chatbot.sql_guard.rows", len(rows))
+        if truncated:
+            statsd.increment("chatbot.sql_guard.truncated")
+    return QueryResult(columns=columns, rows=rows, truncated=truncated, bytes=size)
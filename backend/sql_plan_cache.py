@@ -0,0 +1,362 @@
+"""
+Parameterized plan cache for generate_query.
+
+Database questions repeat a handful of intents ("where is my order", "what is
+the price of X") that differ only in literals. Once a generated query has run
+successfully, each of its literals is traced to where its value came from:
+
+  user      the user identifier; bound to the current user on reuse
+  query     appears verbatim in the question; the question with those values
+            masked ("What is the unit price of the {0}") is the plan's intent
+  constant  anything else ('shipped' when the question never says it, LIMIT 1);
+            stays inline in the SQL
+
+user and query literals become %s parameters of the plan's template. A later
+question hits a plan when it matches the intent with new values in the query
+slots, or, for plans without query slots or inline constants, when its MiniLM
+embedding (the one knn_route computed, when it is enabled) is at least
+SQL_PLAN_CACHE_THRESHOLD similar to the original question's. Constants may have
+been worked out from the question ("in March" -> month = 3), so a similar
+question ("in April") must not reuse them. The template then runs as a prepared statement with
+the new parameters, and generate_query skips the LLM.
+
+A plan without a user slot may still be specific to its user: the LLM can look
+the user up once and filter on a constant (customer_id = 42). Such plans are
+owned by the user whose question created them and only returned to that user.
+
+Only single SELECT/WITH statements are cached, and not when a query value is
+ambiguous (it occurs twice in the question or in more than one literal) or a
+constant looks like a date (the LLM resolved "last week" against today). Plans
+expire after SQL_PLAN_CACHE_TTL_SECONDS, the least recently used are evicted
+beyond SQL_PLAN_CACHE_MAX_ENTRIES, and all are dropped when the schema file
+changes. A plan that fails to execute is discarded.
+"""
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from vector_store import normalize_rows
+
+SQL_PLAN_CACHE_ENABLED = bool(int(os.getenv("SQL_PLAN_CACHE_ENABLED", "1")))
+SQL_PLAN_CACHE_THRESHOLD = float(os.getenv("SQL_PLAN_CACHE_THRESHOLD", "0.95"))
+SQL_PLAN_CACHE_TTL_SECONDS = float(os.getenv("SQL_PLAN_CACHE_TTL_SECONDS", "3600"))
+SQL_PLAN_CACHE_MAX_ENTRIES = int(os.getenv("SQL_PLAN_CACHE_MAX_ENTRIES", "500"))
+SQL_PLAN_CACHE_SOURCE_CHECK_SECONDS = float(os.getenv("SQL_PLAN_CACHE_SOURCE_CHECK_SECONDS", "5"))
+
+# Placeholder for the user identifier inside normalized questions and intents
+_USER = "\x00user\x00"
+
+_SQL_TOKEN = re.compile(
+    r"""
+      (?P<string>'(?:[^']|'')*')
+    | (?P<ident>"(?:[^"]|"")*")
+    | (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<number>(?<![\w.$])\d+(?:\.\d+)?(?![\w.]))
+    | (?P<percent>%)
+    | (?P<semicolon>;)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+# Typed literals (interval '7 days') must stay string constants, they cannot take a parameter.
+_TYPED_LITERAL = re.compile(r"\b(?:interval|date|time|timestamp|timestamptz)\s*$", re.IGNORECASE)
+_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+_READ_ONLY = re.compile(r"\s*(?:select|with)\b", re.IGNORECASE)
+_NUMBER_SLOT = r"(\d+(?:\.\d+)?)"
+_STRING_SLOT = r"(.+?)"
+# Intents need this much fixed text besides the slots, so "{0}" alone never matches everything.
+MIN_INTENT_CHARS = 12
+
+
+def normalize_question(question: str, user_identifier: str = "") -> str:
+    """Collapse whitespace, drop trailing punctuation and mask the user identifier."""
+    text = " ".join(question.split()).rstrip("?.! ")
+    if user_identifier:
+        text = re.sub(re.escape(user_identifier), _USER, text, flags=re.IGNORECASE)
+    return text
+
+
+@dataclass
+class Slot:
+    source: str  # "user" or "query"
+    group: int = 0  # capture group of the intent (query slots)
+    number: bool = False
+    prefix: str = ""  # LIKE wildcards around the value, e.g. '%desk%'
+    suffix: str = ""
+    case: str = "same"  # how the literal's case relates to the question's: same, lower, upper or title
+
+
+@dataclass
+class SqlPlan:
+    question: str
+    template: str  # psycopg query with one %s per slot
+    slots: List[Slot]
+    intent: re.Pattern
+    vector: Optional[np.ndarray]
+    expires_at: float
+    generate_ms: float  # LLM latency when the SQL was generated
+    inline_constants: bool = False  # literals left in the template; such plans only match by intent
+    owner: Optional[str] = None  # lowercased user identifier of plans without a user slot
+    hits: int = 0
+    query_slots: int = field(init=False)
+
+    def __post_init__(self):
+        self.query_slots = sum(slot.source == "query" for slot in self.slots)
+
+    def bind(self, user_identifier: str, match: Optional[re.Match] = None) -> list:
+        """Parameters for the template: the current user and the values matched in the new question."""
+        params = []
+        for slot in self.slots:
+            if slot.source == "user":
+                params.append(slot.prefix + user_identifier + slot.suffix)
+                continue
+            value = match.group(slot.group)
+            if slot.number:
+                params.append(Decimal(value) if "." in value else int(value))
+                continue
+            if slot.case == "lower":
+                value = value.lower()
+            elif slot.case == "upper":
+                value = value.upper()
+            elif slot.case == "title":
+                value = value.title()
+            params.append(slot.prefix + value + slot.suffix)
+        return params
+
+
+def _case(literal: str, occurrence: str) -> str:
+    if literal == occurrence:
+        return "same"
+    for case in ("lower", "upper", "title"):
+        if literal == getattr(occurrence, case)():
+            return case
+    return "same"
+
+
+def parameterize(sql: str, question: str, user_identifier: str) -> Optional[Tuple[str, List[Slot], str, bool]]:
+    """
+    Purpose: lift the user and query literals of sql out into parameters.
+    Input: the generated SQL, the question it answers and the user identifier.
+    Output: (template, slots, intent regex source, whether any string or number literal stayed inline),
+            or None when the query is not safely reusable.
+    """
+    sql = sql.strip().rstrip(";").strip()
+    if not _READ_ONLY.match(sql) or "$$" in sql:
+        return None
+    normalized = normalize_question(question, user_identifier)
+    pieces = []
+    slots = []
+    spans = {}  # lowercased query value -> (start, end, number) in normalized
+    inline_constants = False
+    position = 0
+    for token in _SQL_TOKEN.finditer(sql):
+        kind = token.lastgroup
+        pieces.append(sql[position:token.start()])
+        position = token.end()
+        text = token.group()
+        if kind == "semicolon":
+            return None  # more than one statement
+        if kind == "percent":
+            pieces.append("%%")
+            continue
+        if kind not in ("string", "number"):
+            pieces.append(text.replace("%", "%%"))
+            continue
+        value = text[1:-1].replace("''", "'") if kind == "string" else text
+        core = value.strip("%") if kind == "string" else value
+        prefix = value[:len(value) - len(value.lstrip("%"))] if kind == "string" else ""
+        suffix = value[len(value.rstrip("%")):] if kind == "string" and core else ""
+        slot = None
+        if kind == "string" and user_identifier and core.lower() == user_identifier.lower():
+            slot = Slot("user", prefix=prefix, suffix=suffix)
+        elif core:
+            found = [m for m in re.finditer(r"(?<!\w)" + re.escape(core) + r"(?!\w)", normalized, re.IGNORECASE)]
+            if len(found) > 1 or (found and core.lower() in spans):
+                return None
+            if found:
+                spans[core.lower()] = (found[0].start(), found[0].end(), kind == "number")
+                slot = Slot("query", number=kind == "number", prefix=prefix, suffix=suffix,
+                            case=_case(core, found[0].group()))
+        if slot is None:
+            if _DATE.search(value):
+                return None
+            inline_constants = True
+            pieces.append(text.replace("%", "%%"))
+            continue
+        if kind == "string" and _TYPED_LITERAL.search("".join(pieces)):
+            return None
+        slots.append(slot)
+        pieces.append("%s")
+    pieces.append(sql[position:].replace("%", "%%"))
+
+    # Intent: the normalized question with each query value replaced by a capture group
+    ordered = sorted(spans.items(), key=lambda item: item[1][0])
+    intent, cursor, groups = [], 0, {}
+    for index, (value, (start, end, number)) in enumerate(ordered, start=1):
+        if start < cursor:
+            return None  # overlapping values
+        intent.append(re.escape(normalized[cursor:start]))
+        intent.append(_NUMBER_SLOT if number else _STRING_SLOT)
+        groups[value] = index
+        cursor = end
+    intent.append(re.escape(normalized[cursor:]))
+    fixed = len(normalized) - sum(end - start for _, (start, end, _) in ordered)
+    if fixed < MIN_INTENT_CHARS:
+        return None
+    query_values = iter(value for value, _ in spans.items())
+    for slot in slots:
+        if slot.source == "query":
+            slot.group = groups[next(query_values)]
+    return "".join(pieces), slots, "".join(intent), inline_constants
+
+
+class SqlPlanCache:
+    def __init__(self, source_path: str, threshold: float = SQL_PLAN_CACHE_THRESHOLD,
+                 ttl_seconds: float = SQL_PLAN_CACHE_TTL_SECONDS, max_entries: int = SQL_PLAN_CACHE_MAX_ENTRIES,
+                 source_check_interval: float = SQL_PLAN_CACHE_SOURCE_CHECK_SECONDS):
+        """source_path: the schema file plans are generated from; changing it drops every plan."""
+        self.source_path = source_path
+        self.threshold = threshold
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.source_check_interval = source_check_interval
+        self._plans = OrderedDict()  # (owner, template) -> SqlPlan, least recently used first
+        self._lock = threading.Lock()
+        # Stacked vectors of the plans without query slots or constants, rebuilt on the first lookup after a change
+        self._matrix = None
+        self._keys = []
+        self._owners = None  # owner of each row of _matrix
+        self._source_mtime = None
+        self._next_source_check = 0.0
+        self._hits = {}
+        self._misses = 0
+
+    def _check_source(self) -> None:
+        # Caller holds self._lock.
+        now = time.monotonic()
+        if now < self._next_source_check:
+            return
+        self._next_source_check = now + self.source_check_interval
+        try:
+            mtime = os.stat(self.source_path).st_mtime_ns
+        except OSError:
+            return
+        if self._source_mtime is not None and mtime != self._source_mtime:
+            self._plans.clear()
+            self._matrix = None
+            print(f"SQL plan cache cleared: {self.source_path} changed.")
+        self._source_mtime = mtime
+
+    def _evict_expired(self, now: float) -> None:
+        expired = [key for key, plan in self._plans.items() if plan.expires_at <= now]
+        for key in expired:
+            del self._plans[key]
+        if expired:
+            self._matrix = None
+
+    def _use(self, key: tuple, how: str) -> SqlPlan:
+        plan = self._plans[key]
+        plan.hits += 1
+        self._plans.move_to_end(key)
+        self._hits[how] = self._hits.get(how, 0) + 1
+        return plan
+
+    def lookup(self, question: str, user_identifier: str,
+               vector: Sequence[float] = None) -> Optional[Tuple[SqlPlan, list, str, float]]:
+        """
+        Purpose: find a cached plan for question.
+        Input: the question, the current user and, when already computed, the question's embedding.
+        Output: (plan, params, "intent" or "embedding", similarity) or None.
+        """
+        normalized = normalize_question(question, user_identifier)
+        user = user_identifier.lower()
+        with self._lock:
+            self._check_source()
+            self._evict_expired(time.monotonic())
+            for key, plan in reversed(self._plans.items()):
+                if plan.owner is not None and plan.owner != user:
+                    continue
+                match = plan.intent.fullmatch(normalized)
+                # A slot must not swallow the user identifier (it is masked in normalized)
+                if match is not None and not any(_USER in value for value in match.groups()):
+                    return self._use(key, "intent"), plan.bind(user_identifier, match), "intent", 1.0
+            if vector is not None:
+                if self._matrix is None:
+                    self._keys = [key for key, plan in self._plans.items()
+                                  if plan.query_slots == 0 and not plan.inline_constants
+                                  and plan.vector is not None]
+                    self._matrix = np.stack([self._plans[key].vector for key in self._keys]) if self._keys else None
+                    self._owners = np.array([key[0] or "" for key in self._keys], dtype=object)
+                if self._matrix is not None:
+                    scores = self._matrix @ normalize_rows(vector)[0]
+                    scores[(self._owners != "") & (self._owners != user)] = -np.inf
+                    best = int(np.argmax(scores))
+                    similarity = float(scores[best])
+                    if similarity >= self.threshold:
+                        plan = self._use(self._keys[best], "embedding")
+                        return plan, plan.bind(user_identifier), "embedding", similarity
+            self._misses += 1
+        return None
+
+    def put(self, question: str, sql: str, user_identifier: str, vector: Sequence[float] = None,
+            generate_ms: float = 0.0) -> bool:
+        """Cache the plan of a query that ran successfully. Returns False when it is not reusable."""
+        parameterized = parameterize(sql, question, user_identifier)
+        if parameterized is None:
+            return False
+        template, slots, intent, inline_constants = parameterized
+        owner = None if any(slot.source == "user" for slot in slots) else user_identifier.lower()
+        plan = SqlPlan(
+            question=question,
+            template=template,
+            slots=slots,
+            intent=re.compile(intent, re.IGNORECASE | re.DOTALL),
+            vector=normalize_rows(vector)[0] if vector is not None else None,
+            expires_at=time.monotonic() + self.ttl,
+            generate_ms=generate_ms,
+            inline_constants=inline_constants,
+            owner=owner,
+        )
+        key = (owner, template)
+        with self._lock:
+            self._check_source()
+            self._plans[key] = plan
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last=False)
+            self._matrix = None
+        return True
+
+    def discard(self, template: str, user_identifier: str = "") -> None:
+        """Drop the plan with this template: the shared one, and user_identifier's own."""
+        with self._lock:
+            shared = self._plans.pop((None, template), None)
+            owned = self._plans.pop((user_identifier.lower(), template), None) if user_identifier else None
+            if shared is not None or owned is not None:
+                self._matrix = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._plans.clear()
+            self._matrix = None
+
+    def stats(self) -> dict:
+        hits = sum(self._hits.values())
+        total = hits + self._misses
+        return {
+            "entries": len(self._plans),
+            "hits": hits,
+            "hits_by_match": dict(self._hits),
+            "misses": self._misses,
+            "hit_ratio": round(hits / total, 4) if total else None,
+        }
+
+    def __len__(self) -> int:
+        return len(self._plans)
@@ -0,0 +1,194 @@
+"""
+Startup manager for slow-loading resources (NLTK data, embedding model, policy
+index, HuggingFace pipelines).
+
+Modules register a loader (and optionally a warmup) per component at import
+instead of doing the work at import time. Loading then happens either:
+
+  - "background" (STARTUP_MODE default): start() loads every component in
+    parallel on STARTUP_WORKERS threads while the app is already serving
+    /health; or
+  - "lazy": each component loads the first time something asks for it.
+
+In both modes get(name) blocks until the component is ready (loading it on the
+calling thread if nobody has started it yet), so callers never observe a
+half-initialized resource. A component that failed to load is not retried by
+get(), which fails fast instead; a background timer retries it after
+STARTUP_RETRY_BASE_SECONDS, doubling the delay after every failure up to
+STARTUP_RETRY_MAX_SECONDS. Per-component status and load/warmup times are
+exposed by status() for the /ready endpoint and emitted as
+chatbot.startup.* gauges.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from datadog import statsd
+
+STARTUP_MODE = os.getenv("STARTUP_MODE", "background")
+STARTUP_WORKERS = int(os.getenv("STARTUP_WORKERS", "4"))
+STARTUP_RETRY_BASE_SECONDS = float(os.getenv("STARTUP_RETRY_BASE_SECONDS", "5"))
+STARTUP_RETRY_MAX_SECONDS = float(os.getenv("STARTUP_RETRY_MAX_SECONDS", "300"))
+
+STARTUP_MODES = ("background", "lazy")
+
+
+def _rounded(seconds):
+    return None if seconds is None else round(seconds, 3)
+
+
+class _Component:
+    def __init__(self, name: str, loader: Callable[[], Any], warmup: Optional[Callable[[Any], None]], required: bool):
+        self.name = name
+        self.loader = loader
+        self.warmup = warmup
+        self.required = required
+        self.lock = threading.Lock()
+        self.state = "not_loaded"
+        self.value = None
+        self.error = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.failures = 0  # consecutive failed loads
+        self.retry_at = None  # monotonic time of the next background retry
+
+
+class StartupManager:
+    def __init__(self, mode: str = STARTUP_MODE, workers: int = STARTUP_WORKERS,
+                 retry_base_seconds: float = STARTUP_RETRY_BASE_SECONDS,
+                 retry_max_seconds: float = STARTUP_RETRY_MAX_SECONDS):
+        if mode not in STARTUP_MODES:
+            raise ValueError(f"STARTUP_MODE must be one of {', '.join(STARTUP_MODES)}")
+        self.mode = mode
+        self.workers = workers
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self._components = {}
+        self._started_at = None
+        self._start_lock = threading.Lock()
+
+    def register(self, name: str, loader: Callable[[], Any], warmup: Callable[[Any], None] = None,
+                 required: bool = True) -> None:
+        """
+        Purpose: declare a component; nothing is loaded here.
+        Input: loader returns the resource; warmup (optional) runs one inference on it;
+               required=False components do not hold back readiness (background tagging models).
+        """
+        self._components[name] = _Component(name, loader, warmup, required)
+
+    def get(self, name: str) -> Any:
+        """
+        Purpose: return a loaded component, loading it on this thread if nobody has tried yet.
+        Errors: KeyError for unknown names; RuntimeError if loading failed (retried in the background).
+        """
+        component = self._components[name]
+        if component.state == "ready":
+            return component.value
+        if component.state != "failed":
+            with component.lock:
+                if component.state == "not_loaded":
+                    self._load(component)
+        if component.state != "ready":
+            raise RuntimeError(f"{name} failed to load: {component.error}")
+        return component.value
+
+    def peek(self, name: str) -> Any:
+        """The component if it is already loaded, else None; never loads or blocks."""
+        component = self._components.get(name)
+        return component.value if component is not None and component.state == "ready" else None
+
+    async def aget(self, name: str) -> Any:
+        """get() for coroutines: waits on a worker thread so the event loop is never blocked by a load."""
+        component = self._components[name]
+        if component.state == "ready":
+            return component.value
+        return await asyncio.to_thread(self.get, name)
+
+    def _load(self, component: _Component) -> None:
+        component.state = "loading"
+        component.error = None
+        tags = ["component:{}".format(component.name)]
+        try:
+            start = time.perf_counter()
+            value = component.loader()
+            component.load_seconds = time.perf_counter() - start
+            statsd.gauge("chatbot.startup.load_seconds", component.load_seconds, tags=tags)
+            if component.warmup is not None:
+                start = time.perf_counter()
+                component.warmup(value)
+                component.warmup_seconds = time.perf_counter() - start
+                statsd.gauge("chatbot.startup.warmup_seconds", component.warmup_seconds, tags=tags)
+        except Exception as exc:
+            component.state = "failed"
+            component.error = str(exc)
+            component.failures += 1
+            statsd.increment("chatbot.startup.failures", tags=tags)
+            delay = min(self.retry_base_seconds * 2 ** (component.failures - 1), self.retry_max_seconds)
+            component.retry_at = time.monotonic() + delay
+            retry = threading.Timer(delay, self._retry, args=(component,))
+            retry.daemon = True
+            retry.name = f"startup-retry-{component.name}"
+            retry.start()
+            print(f"Startup: {component.name} failed to load: {exc} (retrying in {delay:.0f}s)")
+            return
+        component.value = value
+        component.state = "ready"
+        component.failures = 0
+        component.retry_at = None
+
+    def _retry(self, component: _Component) -> None:
+        with component.lock:
+            if component.state == "failed":
+                self._load(component)
+
+    def start(self) -> None:
+        """Begin loading every component in the background (no-op in lazy mode or when already started)."""
+        if self.mode != "background":
+            return
+        with self._start_lock:
+            if self._started_at is not None:
+                return
+            self._started_at = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="startup")
+        for name in list(self._components):
+            executor.submit(self._load_quietly, name)
+        # Let the threads exit once everything is loaded; nothing waits on the executor itself.
+        executor.shutdown(wait=False)
+
+    def _load_quietly(self, name: str) -> None:
+        try:
+            self.get(name)
+        except RuntimeError:
+            pass  # recorded on the component and reported by status()
+
+    def is_ready(self) -> bool:
+        if self.mode == "lazy":
+            return True
+        return all(c.state == "ready" for c in self._components.values() if c.required)
+
+    def status(self) -> dict:
+        """Readiness plus per-component state, load and warmup seconds."""
+        return {
+            "ready": self.is_ready(),
+            "mode": self.mode,
+            "uptime_seconds": None if self._started_at is None else _rounded(time.monotonic() - self._started_at),
+            "components": {
+                c.name: {
+                    "state": c.state,
+                    "required": c.required,
+                    "load_seconds": _rounded(c.load_seconds),
+                    "warmup_seconds": _rounded(c.warmup_seconds),
+                    "error": c.error,
+                    "failures": c.failures,
+                    "retry_in_seconds": None if c.retry_at is None else _rounded(max(c.retry_at - time.monotonic(), 0.0)),
+                }
+                for c in self._components.values()
+            },
+        }
+
+
+components = StartupManager()
@@ -14,3 +14,15 @@ class State(TypedDict):
     is_question: bool
     user_identifier: str
     sql_query: str
+    sql_params: list
+    sql_generate_ms: float
+    answer_relevant: str
+    answer_cache_hit: bool
+    query_embedding: list
+    started_at: float
+    prefetched_policy_context: str
+    answer_span: dict
+    session_id: str
+    request_id: str
+    route_confidence: float
+    route_source: str
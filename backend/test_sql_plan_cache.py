@@ -0,0 +1,74 @@
+"""
+Unit tests for sql_plan_cache.py: plans without a user slot stay with their user, and plans
+with constants the LLM derived from the question are never reused by embedding similarity.
+
+Usage: python -m pytest test_sql_plan_cache.py
+"""
+
+import numpy as np
+
+from sql_plan_cache import SqlPlanCache
+
+QUESTION = "Show my recent orders"
+CONSTANT_SQL = "SELECT order_id, status FROM orders WHERE customer_id = 42 ORDER BY placed_at DESC LIMIT 5"
+# No literals at all: the plan is owned (no user slot) but can match by embedding
+OWNED_SQL = "SELECT order_id, status FROM orders ORDER BY placed_at DESC"
+USER_SQL = (
+    "SELECT o.order_id, o.status FROM orders o JOIN customers c ON c.customer_id = o.customer_id "
+    "WHERE c.email = 'a@x.com' ORDER BY o.placed_at DESC LIMIT 5"
+)
+
+
+def make_cache() -> SqlPlanCache:
+    return SqlPlanCache(__file__, threshold=0.95)
+
+
+def test_constant_plan_is_not_shared_by_intent():
+    cache = make_cache()
+    assert cache.put(QUESTION, CONSTANT_SQL, "a@x.com")
+    assert cache.lookup(QUESTION, "b@x.com") is None
+    plan, params, match, _ = cache.lookup(QUESTION, "a@x.com")
+    assert (params, match) == ([], "intent")
+    assert plan.owner == "a@x.com"
+
+
+def test_owned_plan_is_not_shared_by_embedding():
+    cache = make_cache()
+    vector = np.array([1.0, 0.0, 0.0])
+    assert cache.put(QUESTION, OWNED_SQL, "a@x.com", vector)
+    assert cache.lookup("List my latest orders", "b@x.com", vector) is None
+    assert cache.lookup("List my latest orders", "A@X.com", vector)[2] == "embedding"
+
+
+def test_plan_with_derived_constants_is_not_reused_by_embedding():
+    cache = make_cache()
+    question = "How many orders did I place in March"
+    sql = (
+        "SELECT count(*) FROM orders o JOIN customers c ON c.customer_id = o.customer_id "
+        "WHERE c.email = 'a@x.com' AND extract(month from o.placed_at) = 3"
+    )
+    vector = np.array([1.0, 0.0, 0.0])
+    assert cache.put(question, sql, "a@x.com", vector)
+    plan, params, match, _ = cache.lookup(question, "b@x.com")
+    assert (params, match) == (["b@x.com"], "intent")
+    assert plan.inline_constants
+    similar = np.array([1.0, 0.05, 0.0])
+    assert cache.lookup("How many orders did I place in April", "b@x.com", similar) is None
+
+
+def test_user_slot_plan_is_shared_and_rebound():
+    cache = make_cache()
+    assert cache.put(QUESTION, USER_SQL, "a@x.com")
+    plan, params, _, _ = cache.lookup(QUESTION, "b@x.com")
+    assert plan.owner is None
+    assert params == ["b@x.com"]
+
+
+def test_discard_only_drops_that_users_plan():
+    cache = make_cache()
+    cache.put(QUESTION, CONSTANT_SQL, "a@x.com")
+    cache.put(QUESTION, CONSTANT_SQL, "b@x.com")
+    plan, _, _, _ = cache.lookup(QUESTION, "a@x.com")
+    cache.discard(plan.template, "a@x.com")
+    assert cache.lookup(QUESTION, "a@x.com") is None
+    assert cache.lookup(QUESTION, "b@x.com") is not None
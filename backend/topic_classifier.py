@@ -0,0 +1,136 @@
+"""
+Topic classification for background message tagging.
+
+Two interchangeable classifiers produce the same output shape as the
+transformers zero-shot pipeline ({"sequence", "labels", "scores"}, labels sorted
+best first), so callers only ever read result["labels"][0]:
+
+  - "bart": facebook/bart-large-mnli zero-shot classification. One forward
+    pass of a 400M-parameter model per (message, label) pair.
+  - "embedding": reuses the all-MiniLM-L6-v2 embeddings from rag.py. Each label
+    gets a prototype vector (the normalized mean of its name and, optionally,
+    the example queries listed under it in tag_queries.md); a batch of messages
+    is embedded once and scored against all prototypes with one matrix product.
+
+TOPIC_CLASSIFIER selects the mode (default "bart", which the existing user.topic
+monitors were built on); TOPIC_PROTOTYPES_PATH points at the seed
+examples (set it to an empty string to use label names only).
+"""
+
+import os
+import re
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+TOPIC_CLASSIFIER = os.getenv("TOPIC_CLASSIFIER", "bart")
+TOPIC_PROTOTYPES_PATH = os.getenv(
+    "TOPIC_PROTOTYPES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tag_queries.md")
+)
+
+TOPIC_CLASSIFIERS = ("bart", "embedding")
+
+CANDIDATE_LABELS = [
+    "Order Status",
+    "Return & Refund",
+    "Product Info",
+    "Billing & Account",
+    "Shipping Policy",
+    "Technical Support",
+    "Other"
+]
+
+
+def load_prototypes(path: str, labels: Sequence[str] = CANDIDATE_LABELS) -> Dict[str, List[str]]:
+    """
+    Purpose: read example queries per label from a markdown file laid out like tag_queries.md.
+    Input: path to the file; "## <heading>" sections whose heading starts with a label name
+           (e.g. "Other / Conversational" -> "Other") and "* <query>" bullets underneath.
+    Output: {label: [query, ...]}; sections that match no label are ignored.
+    Errors: OSError if the file cannot be read.
+    """
+    prototypes = {}
+    current = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("## "):
+                heading = line[3:].strip()
+                current = next((label for label in labels if heading.startswith(label)), None)
+            elif current and re.match(r"[*-] ", line):
+                prototypes.setdefault(current, []).append(line[2:].strip())
+    return prototypes
+
+
+def _normalize(vectors) -> np.ndarray:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class EmbeddingTopicClassifier:
+    def __init__(self, embeddings, labels: Sequence[str] = CANDIDATE_LABELS, prototypes: Dict[str, List[str]] = None):
+        """
+        embeddings: a LangChain Embeddings instance (embed_documents).
+        prototypes: optional {label: [example query, ...]} added to each label's name.
+        """
+        self.embeddings = embeddings
+        self.labels = list(labels)
+        prototypes = prototypes or {}
+        texts, owners = [], []
+        for i, label in enumerate(self.labels):
+            for text in [label] + list(prototypes.get(label, ())):
+                texts.append(text)
+                owners.append(i)
+        vectors = _normalize(self.embeddings.embed_documents(texts))
+        owners = np.asarray(owners)
+        # One row per label: the re-normalized centroid of its prototype embeddings.
+        self.label_matrix = _normalize(
+            np.stack([vectors[owners == i].mean(axis=0) for i in range(len(self.labels))])
+        )
+
+    def __call__(self, texts: Sequence[str]) -> List[dict]:
+        if not texts:
+            return []
+        scores = _normalize(self.embeddings.embed_documents(list(texts))) @ self.label_matrix.T
+        order = np.argsort(-scores, axis=1)
+        return [
+            {
+                "sequence": text,
+                "labels": [self.labels[j] for j in order[row]],
+                "scores": [float(scores[row, j]) for j in order[row]],
+            }
+            for row, text in enumerate(texts)
+        ]
+
+    def top_labels(self, vectors) -> List[str]:
+        """Best label for each precomputed MiniLM vector (e.g. a query embedding the graph already has)."""
+        scores = _normalize(vectors) @ self.label_matrix.T
+        return [self.labels[j] for j in np.argmax(scores, axis=1)]
+
+
+class BartTopicClassifier:
+    def __init__(self, labels: Sequence[str] = CANDIDATE_LABELS, device: str = "cpu"):
+        from transformers import pipeline
+
+        self.labels = list(labels)
+        self.pipeline = pipeline("zero-shot-classification", model="facebook/bart-large-mnli", device=device)
+
+    def __call__(self, texts: Sequence[str]) -> List[dict]:
+        if not texts:
+            return []
+        results = self.pipeline(list(texts), self.labels, batch_size=len(texts))
+        # The pipeline returns a bare dict for a single input.
+        return [results] if isinstance(results, dict) else results
+
+
+def build_classifier(mode: str = TOPIC_CLASSIFIER, device: str = "cpu", prototypes_path: str = TOPIC_PROTOTYPES_PATH):
+    """Construct the classifier for mode ("bart" or "embedding"). Raises ValueError for unknown modes."""
+    if mode == "bart":
+        return BartTopicClassifier(device=device)
+    if mode == "embedding":
+        from rag import get_embeddings
+
+        prototypes = load_prototypes(prototypes_path) if prototypes_path else None
+        return EmbeddingTopicClassifier(get_embeddings(), prototypes=prototypes)
+    raise ValueError(f"TOPIC_CLASSIFIER must be one of {', '.join(TOPIC_CLASSIFIERS)}")
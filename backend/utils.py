@@ -1,19 +1,22 @@
 from datetime import datetime, timedelta, timezone
-import json
 import os
-from typing import Optional
+import threading
+import time
 import uuid
 import psycopg
-from transformers import pipeline
 from datadog import statsd
 
 from db_utils import get_db_conn
+from cost_ledger import pricing
+from session_activity import activity, validity_cache
 
 # 1. Load the Emotion Pipeline
 # This model returns all 28 emotions. We will filter for "confusion".
 
 
 SESSION_MAX_AGE_SECONDS = int(os.getenv('SESSION_MAX_AGE_SECONDS', '300'))
+SESSION_REAP_INTERVAL_SECONDS = float(os.getenv('SESSION_REAP_INTERVAL_SECONDS', '30'))
+SESSION_REAP_BATCH_SIZE = int(os.getenv('SESSION_REAP_BATCH_SIZE', '500'))
 
 def render_graph_image(app):
     png_data = app.get_graph().draw_mermaid_png()
@@ -21,34 +24,69 @@ def render_graph_image(app):
         f.write(png_data)
 
 
-def remove_expired_sessions(cur, user_identifier: Optional[str] = None) -> None:
-    global SESSION_MAX_AGE_SECONDS
+def _emit_expired_sessions(chat_lengths) -> None:
+  # One count per batch; chat_length samples carry no per-session tag.
+  if not chat_lengths:
+    return
+  statsd.increment("chatbot.session.expired", len(chat_lengths))
+  for chat_length in chat_lengths:
+    statsd.distribution("chatbot.session.chat_length", chat_length)
+
+
+def remove_expired_sessions(cur, user_identifier: str) -> None:
+  """Drop one user's expired sessions (index on user_identifier, created_at)."""
+  cutoff = datetime.now(timezone.utc) - timedelta(seconds=SESSION_MAX_AGE_SECONDS)
+  cur.execute(
+      "DELETE FROM user_sessions WHERE user_identifier = %s AND created_at < %s RETURNING conversation_count;",
+      (user_identifier, cutoff),
+  )
+  _emit_expired_sessions([row[0] for row in cur.fetchall()])
+
+
+def reap_expired_sessions(batch_size: int = SESSION_REAP_BATCH_SIZE) -> int:
+  """
+  Delete expired sessions in batches of at most batch_size rows (index on created_at).
+  Each batch is its own short transaction; SKIP LOCKED lets concurrent reapers share the work.
+  Returns the number of sessions removed.
+  """
+  removed = 0
+  while True:
     cutoff = datetime.now(timezone.utc) - timedelta(seconds=SESSION_MAX_AGE_SECONDS)
-    if user_identifier:
-        res = cur.execute("SELECT session_id, session_count FROM user_sessions WHERE user_identifier = %s AND created_at < %s;", (user_identifier, cutoff))
-        for session_id, session_count in res:
-            statsd.distribution(
-                "chatbot.session.chat_length",
-                session_count,
-                tags=[
-                    "session_id:{}".format(session_id)
-                ]
-            )
-        cur.execute(
-            "DELETE FROM user_sessions WHERE user_identifier = %s AND created_at < %s;",
-            (user_identifier, cutoff),
-        )
-    else:
-        res = cur.execute("SELECT session_id, session_count FROM user_sessions WHERE created_at < %s;", (cutoff,))
-        for session_id, session_count in res:
-            statsd.distribution(
-                "chatbot.session.chat_length",
-                session_count,
-                tags=[
-                    "session_id:{}".format(session_id)
-                ]
-            )
-        cur.execute("DELETE FROM user_sessions WHERE created_at < %s;", (cutoff,))
+    with get_db_conn() as conn, conn.cursor() as cur:
+      cur.execute(
+          """
+          DELETE FROM user_sessions
+          WHERE session_id IN (
+            SELECT session_id FROM user_sessions
+            WHERE created_at < %s
+            ORDER BY created_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+          )
+          RETURNING conversation_count;
+          """,
+          (cutoff, batch_size),
+      )
+      chat_lengths = [row[0] for row in cur.fetchall()]
+    _emit_expired_sessions(chat_lengths)
+    removed += len(chat_lengths)
+    if len(chat_lengths) < batch_size:
+      return removed
+
+
+def start_session_reaper(interval_seconds: float = SESSION_REAP_INTERVAL_SECONDS) -> threading.Thread:
+  """Run reap_expired_sessions from a daemon thread every interval_seconds."""
+  def _loop():
+    while True:
+      try:
+        reap_expired_sessions()
+      except Exception as exc:  # keep reaping after transient DB errors
+        print(f"Session reaper failed: {exc}")
+      time.sleep(interval_seconds)
+
+  thread = threading.Thread(target=_loop, name="session-reaper", daemon=True)
+  thread.start()
+  return thread
 
 
 def create_session(user_identifier: str) -> str:
@@ -77,50 +115,43 @@ def create_session(user_identifier: str) -> str:
 def validate_session(session_id: str) -> bool:
   if not session_id:
     return False
-  #ensure_session_table_exists()
-  with get_db_conn() as conn, conn.cursor() as cur:
-    remove_expired_sessions(cur)
-    cur.execute(
-        "SELECT created_at FROM user_sessions WHERE session_id = %s LIMIT 1;",
-        (session_id,),
-    )
-    row = cur.fetchone()
+  # Expired rows are removed by the background reaper; last_seen is written
+  # behind by the activity buffer, so this is at most one primary-key SELECT
+  # and none at all while the session sits in the validity cache.
+  cutoff = datetime.now(timezone.utc) - timedelta(seconds=SESSION_MAX_AGE_SECONDS)
+  created_at = validity_cache.get(session_id)
+  if created_at is None:
+    with get_db_conn() as conn, conn.cursor() as cur:
+      cur.execute(
+          "SELECT created_at FROM user_sessions WHERE session_id = %s;",
+          (session_id,),
+      )
+      row = cur.fetchone()
     if not row:
-      conn.commit()
       return False
     created_at = row[0]
-    if created_at < datetime.now(timezone.utc) - timedelta(seconds=SESSION_MAX_AGE_SECONDS):
-      cur.execute("DELETE FROM user_sessions WHERE session_id = %s;", (session_id,))
-      conn.commit()
-      return False
-    cur.execute(
-        "UPDATE user_sessions SET last_seen = NOW() WHERE session_id = %s;",
-        (session_id,),
-    )
-    conn.commit()
-    return True
+    validity_cache.put(session_id, created_at)
+  if created_at < cutoff:
+    validity_cache.evict(session_id)
+    return False
+  activity.touch(session_id)
+  return True
 
 
 def increment_session_count(session_id: str) -> None:
   if not session_id:
     return
-  with get_db_conn() as conn, conn.cursor() as cur:
-    cur.execute(
-        """
-        UPDATE user_sessions
-        SET conversation_count = conversation_count + 1
-        WHERE session_id = %s;
-        """,
-        (session_id,),
-    )
-    conn.commit()
+  activity.increment(session_id)
+
+
+def flush_session_activity(*session_ids: str) -> None:
+  """Write buffered activity through (e.g. before reading conversation_count) and forget cached validity."""
+  activity.flush()
+  validity_cache.evict(*session_ids)
 
 def get_cost(input_tokens: int, output_tokens: int, model_name: str) -> float:
-  with open("cost-per-mil.json", "r") as f:
-    cost_per_mil = json.load(f)
-  cost = (cost_per_mil[model_name]["input"] * input_tokens / 1_000_000) + (cost_per_mil[model_name]["output"] * output_tokens / 1_000_000)
-  #print(f"input_tokens: {input_tokens}, output_tokens: {output_tokens}, model_name: {model_name}, cost: {cost}")
-  return cost
+  # Pricing is cached in memory and only re-read when cost-per-mil.json changes.
+  return pricing.cost(input_tokens, output_tokens, model_name)
 
 # # Test it
 # user_input = "I don't understand how this billing works, it makes no sense."
@@ -0,0 +1,242 @@
+"""
+VectorStore backed by a single embedding matrix.
+
+Documents are held as parallel lists (texts, metadatas) plus one row per
+document in a contiguous NumPy matrix of L2-normalized embeddings, so cosine
+similarity for a query is one matrix-vector product and the top k come from
+np.argpartition instead of sorting every score. The matrix may be a read-only
+np.memmap (see policy_index.py), in which case every process on the host
+shares the same page-cache copy instead of holding its own.
+
+Many questions can be answered at once with batch_similarity_search (one
+embedding call and one matrix-matrix product); the retriever returned by
+as_retriever() routes batch()/abatch() there.
+
+For very large corpora an approximate inverted-file index (IVF) can be used:
+rows are clustered with spherical k-means, and a query only scores the rows in
+the VECTOR_ANN_PROBES lists whose centroids are closest to it. It is built on
+first search once the store holds VECTOR_ANN_MIN_ROWS rows, or when
+approximate=True is passed.
+
+Works anywhere a LangChain VectorStore does, including
+as_retriever(search_kwargs={"k": 3}).
+"""
+
+import os
+import threading
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore, VectorStoreRetriever
+
+VECTOR_ANN_MIN_ROWS = int(os.getenv("VECTOR_ANN_MIN_ROWS", "200000"))
+VECTOR_ANN_PROBES = int(os.getenv("VECTOR_ANN_PROBES", "8"))
+VECTOR_ANN_ITERATIONS = int(os.getenv("VECTOR_ANN_ITERATIONS", "10"))
+# Upper bound on scores materialized at once (queries x rows) for batch search
+VECTOR_SCORE_BLOCK = int(os.getenv("VECTOR_SCORE_BLOCK", str(1 << 24)))
+
+
+def normalize_rows(vectors, dtype=np.float32) -> np.ndarray:
+    """L2-normalize each row (zero rows stay zero) and return a contiguous array of dtype."""
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.ascontiguousarray(matrix / np.maximum(norms, 1e-12), dtype=dtype)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores along the last axis, best first."""
+    n = scores.shape[-1]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+    if k < n:
+        part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        part = np.broadcast_to(np.arange(n), scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, part, axis=-1), axis=-1, kind="stable")
+    return np.take_along_axis(part, order, axis=-1)
+
+
+class IVFIndex:
+    """Inverted-file index over normalized rows: spherical k-means lists, probed nearest-first."""
+
+    def __init__(self, matrix: np.ndarray, n_lists: int = None, n_probe: int = VECTOR_ANN_PROBES,
+                 iterations: int = VECTOR_ANN_ITERATIONS, seed: int = 0):
+        rows = len(matrix)
+        self.n_lists = max(1, min(rows, n_lists or int(np.sqrt(rows))))
+        self.n_probe = max(1, min(n_probe, self.n_lists))
+        rng = np.random.default_rng(seed)
+        # Train on a sample (as FAISS does); every row is assigned to a list afterwards.
+        sample_rows = np.sort(rng.choice(rows, min(rows, 64 * self.n_lists), replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), self.n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = self._assign(sample, centroids)
+            counts = np.bincount(assignment, minlength=self.n_lists)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            filled = counts > 0
+            sums = np.empty_like(centroids)
+            sums[filled] = np.add.reduceat(sample[np.argsort(assignment, kind="stable")], starts[filled])
+            # Re-seed empty lists so every centroid keeps covering some rows.
+            sums[~filled] = sample[rng.choice(len(sample), int((~filled).sum()), replace=False)]
+            centroids = normalize_rows(sums)
+        assignment = self._assign(matrix, centroids)
+        self.centroids = centroids
+        # CSR layout: rows of list i are order[offsets[i]:offsets[i + 1]]
+        self.order = np.argsort(assignment, kind="stable")
+        self.offsets = np.searchsorted(assignment[self.order], np.arange(self.n_lists + 1))
+
+    @staticmethod
+    def _assign(matrix: np.ndarray, centroids: np.ndarray, block: int = 65536) -> np.ndarray:
+        return np.concatenate([
+            np.argmax(np.asarray(matrix[i:i + block], dtype=np.float32) @ centroids.T, axis=1)
+            for i in range(0, len(matrix), block)
+        ])
+
+    def candidates(self, query: np.ndarray) -> np.ndarray:
+        lists = top_k(self.centroids @ query, self.n_probe)
+        return np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+
+
+class MatrixRetriever(VectorStoreRetriever):
+    """VectorStoreRetriever whose batch()/abatch() run one vectorized search for all inputs."""
+
+    def batch(self, inputs: List[str], config=None, *, return_exceptions: bool = False, **kwargs: Any) -> List[List[Document]]:
+        if self.search_type != "similarity" or not inputs:
+            return super().batch(inputs, config, return_exceptions=return_exceptions, **kwargs)
+        return self.vectorstore.batch_similarity_search(list(inputs), **(self.search_kwargs | kwargs))
+
+    async def abatch(self, inputs: List[str], config=None, *, return_exceptions: bool = False, **kwargs: Any) -> List[List[Document]]:
+        if self.search_type != "similarity" or not inputs:
+            return await super().abatch(inputs, config, return_exceptions=return_exceptions, **kwargs)
+        return await self.vectorstore.abatch_similarity_search(list(inputs), **(self.search_kwargs | kwargs))
+
+
+class MatrixVectorStore(VectorStore):
+    def __init__(self, embedding: Embeddings, texts: Sequence[str], metadatas: Sequence[dict], matrix,
+                 approximate: Optional[bool] = None, n_lists: int = None, n_probe: int = VECTOR_ANN_PROBES):
+        """
+        matrix: (len(texts), dim) array of normalized embeddings, possibly memory-mapped.
+        approximate: True/False forces the IVF index on/off; None enables it from VECTOR_ANN_MIN_ROWS rows.
+        """
+        if len(texts) != len(metadatas) or len(texts) != len(matrix):
+            raise ValueError("texts, metadatas and matrix must have the same length")
+        self.embedding = embedding
+        self.texts = list(texts)
+        self.metadatas = [dict(m) for m in metadatas]
+        self.matrix = matrix
+        self.approximate = approximate
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self._ivf = None
+        self._ivf_lock = threading.Lock()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> "MatrixVectorStore":
+        texts = list(texts)
+        matrix = normalize_rows(embedding.embed_documents(texts)) if texts else np.zeros((0, 0), dtype=np.float32)
+        options = {name: kwargs[name] for name in ("approximate", "n_lists", "n_probe") if name in kwargs}
+        return cls(embedding, texts, metadatas or [{} for _ in texts], matrix, **options)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        rows = normalize_rows(self.embedding.embed_documents(texts), dtype=self.matrix.dtype if len(self.matrix) else np.float32)
+        start = len(self.texts)
+        # Appending copies the matrix into memory; a memory-mapped index stays read-only.
+        self.matrix = np.concatenate([self.matrix, rows]) if len(self.matrix) else rows
+        self.texts.extend(texts)
+        self.metadatas.extend(dict(m) for m in (metadatas or [{} for _ in texts]))
+        self._ivf = None  # rebuilt over the new rows on the next search
+        return [str(i) for i in range(start, len(self.texts))]
+
+    def as_retriever(self, **kwargs: Any) -> MatrixRetriever:
+        tags = kwargs.pop("tags", None) or [*self._get_retriever_tags()]
+        return MatrixRetriever(vectorstore=self, tags=tags, **kwargs)
+
+    def _document(self, i: int) -> Document:
+        return Document(id=str(i), page_content=self.texts[i], metadata=self.metadatas[i])
+
+    def _use_ivf(self) -> bool:
+        if self.approximate is None:
+            return len(self.texts) >= VECTOR_ANN_MIN_ROWS
+        return self.approximate
+
+    def _get_ivf(self) -> IVFIndex:
+        if self._ivf is None:
+            with self._ivf_lock:
+                if self._ivf is None:
+                    self._ivf = IVFIndex(self.matrix, self.n_lists, self.n_probe)
+        return self._ivf
+
+    def _search(self, query: np.ndarray, k: int) -> List[Tuple[Document, float]]:
+        if self._use_ivf():
+            rows = self._get_ivf().candidates(query)
+            scores = np.asarray(self.matrix[rows] @ query.astype(self.matrix.dtype), dtype=np.float32)
+            best = top_k(scores, k)
+            return [(self._document(int(rows[i])), float(scores[i])) for i in best]
+        scores = np.asarray(self.matrix @ query.astype(self.matrix.dtype), dtype=np.float32)
+        return [(self._document(int(i)), float(scores[i])) for i in top_k(scores, k)]
+
+    def batch_similarity_search_by_vector_with_score(self, embeddings: Sequence[List[float]],
+                                                     k: int = 4) -> List[List[Tuple[Document, float]]]:
+        """Top k per query vector; exact search scores blocks of queries with one matrix product."""
+        if not self.texts:
+            return [[] for _ in embeddings]
+        queries = normalize_rows(embeddings)
+        if self._use_ivf():
+            return [self._search(query, k) for query in queries]
+        results = []
+        block = max(1, VECTOR_SCORE_BLOCK // len(self.texts))
+        for start in range(0, len(queries), block):
+            scores = np.asarray(queries[start:start + block].astype(self.matrix.dtype) @ self.matrix.T, dtype=np.float32)
+            for row, best in zip(scores, top_k(scores, k)):
+                results.append([(self._document(int(i)), float(row[i])) for i in best])
+        return results
+
+    def batch_similarity_search(self, queries: Sequence[str], k: int = 4, **kwargs: Any) -> List[List[Document]]:
+        """Answer many questions at once: one embedding call and one vectorized search."""
+        if not queries:
+            return []
+        scored = self.batch_similarity_search_by_vector_with_score(self.embedding.embed_documents(list(queries)), k)
+        return [[doc for doc, _ in hits] for hits in scored]
+
+    async def abatch_similarity_search(self, queries: Sequence[str], k: int = 4, **kwargs: Any) -> List[List[Document]]:
+        if not queries:
+            return []
+        vectors = await self.embedding.aembed_documents(list(queries))
+        scored = self.batch_similarity_search_by_vector_with_score(vectors, k)
+        return [[doc for doc, _ in hits] for hits in scored]
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4) -> List[Tuple[Document, float]]:
+        if not self.texts:
+            return []
+        return self._search(normalize_rows(embedding)[0], k)
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding.embed_query(query), k)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # Scores are cosine similarities in [-1, 1]; relevance is expected in [0, 1].
+        return lambda similarity: (similarity + 1) / 2
@@ -62,6 +62,8 @@ export default function App() {
   const [messages, setMessages] = useState(initialMessages);
   const [inputValue, setInputValue] = useState('');
   const [isThinking, setIsThinking] = useState(false);
+  const [isStreaming, setIsStreaming] = useState(false);
+  const [thinkingStatus, setThinkingStatus] = useState('');
   const [isLoggedIn, setIsLoggedIn] = useState(false);
   const [loginState, setLoginState] = useState({ user: '', accessCode: '', error: '', pending: false });
   const scrollAnchorRef = useRef(null);
@@ -89,29 +91,60 @@ export default function App() {
     setMessages((prev) => [...prev, userMessage]);
     setInputValue('');
     setIsThinking(true);
+    setThinkingStatus('');
+
+    const botId = createId('bot');
+    let streamed = false;
+    const setBotText = (update) =>
+      setMessages((prev) =>
+        prev.map((message) => (message.id === botId ? { ...message, text: update(message.text) } : message))
+      );
 
     try {
-      const reply = await fetchBotReply(trimmed);
-      const botMessage = {
-        id: createId('bot'),
-        sender: 'bot',
-        text: reply,
-        timestamp: new Date().toISOString()
-      };
-      setMessages((prev) => [...prev, botMessage]);
+      const reply = await fetchBotReply(trimmed, {
+        onStatus: (event) => {
+          const status = describeStatus(event);
+          if (status) setThinkingStatus(status);
+        },
+        onToken: (text) => {
+          if (streamed) {
+            setBotText((current) => current + text);
+            return;
+          }
+          streamed = true;
+          setIsStreaming(true);
+          setMessages((prev) => [
+            ...prev,
+            { id: botId, sender: 'bot', text, timestamp: new Date().toISOString() }
+          ]);
+        }
+      });
+      // The final reply is authoritative (e.g. it drops text streamed before a tool call).
+      if (streamed) {
+        setBotText(() => reply);
+      } else {
+        setMessages((prev) => [
+          ...prev,
+          { id: botId, sender: 'bot', text: reply, timestamp: new Date().toISOString() }
+        ]);
+      }
     } catch (error) {
-      const fallback = {
-        id: createId('bot'),
-        sender: 'bot',
-        text:
-          error instanceof Error
-            ? `Something went wrong: ${error.message}`
-            : 'Our support assistant is offline. Please try again shortly.',
-        timestamp: new Date().toISOString()
-      };
-      setMessages((prev) => [...prev, fallback]);
+      const errorText =
+        error instanceof Error
+          ? `Something went wrong: ${error.message}`
+          : 'Our support assistant is offline. Please try again shortly.';
+      // A partially streamed reply is replaced, not left above a second bubble.
+      if (streamed) {
+        setBotText(() => errorText);
+      } else {
+        setMessages((prev) => [
+          ...prev,
+          { id: botId, sender: 'bot', text: errorText, timestamp: new Date().toISOString() }
+        ]);
+      }
     } finally {
       setIsThinking(false);
+      setIsStreaming(false);
     }
   };
 
@@ -201,7 +234,7 @@ export default function App() {
           {messages.map((message) => (
             <MessageBubble key={message.id} message={message} />
           ))}
-          {isThinking && <TypingBubble />}
+          {isThinking && !isStreaming && <TypingBubble status={thinkingStatus} />}
           <div ref={scrollAnchorRef} />
         </section>
 
@@ -239,7 +272,7 @@ function MessageBubble({ message }) {
   );
 }
 
-function TypingBubble() {
+function TypingBubble({ status }) {
   return (
     <div className="bubble-row bot">
       <span className="bubble-chip">Clara</span>
@@ -247,6 +280,7 @@ function TypingBubble() {
         <span />
         <span />
         <span />
+        {status && <p className="typing-status">{status}</p>}
       </div>
     </div>
   );
@@ -264,11 +298,14 @@ function SuggestionTray({ suggestions, onSelect }) {
   );
 }
 
-async function fetchBotReply(prompt) {
-  const response = await fetch(`${API_BASE_URL}/api/chat`, {
+// Streams /api/chat/stream (Server-Sent Events): status events while the request is routed,
+// token events as the answer is generated, then done with the final reply.
+async function fetchBotReply(prompt, { onStatus, onToken } = {}) {
+  const response = await fetch(`${API_BASE_URL}/api/chat/stream`, {
     method: 'POST',
     headers: {
-      'Content-Type': 'application/json'
+      'Content-Type': 'application/json',
+      Accept: 'text/event-stream'
     },
     credentials: 'include',
     body: JSON.stringify({ prompt })
@@ -279,10 +316,52 @@ async function fetchBotReply(prompt) {
     throw new Error(detail?.error ?? 'Unable to reach support assistant');
   }
 
-  const payload = await response.json();
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let payload = null;
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const event = parseSseEvent(buffer.slice(0, boundary));
+      buffer = buffer.slice(boundary + 2);
+      if (!event) continue;
+      if (event.type === 'status') onStatus?.(event.data);
+      else if (event.type === 'token') onToken?.(event.data.text);
+      else if (event.type === 'error') throw new Error(event.data.error);
+      else if (event.type === 'done') payload = event.data;
+    }
+  }
+
+  if (!payload) {
+    throw new Error('The support assistant stopped before replying');
+  }
   return payload.reply ?? 'Thanks! An agent will follow up shortly.';
 }
 
+function parseSseEvent(block) {
+  let type = 'message';
+  const data = [];
+  for (const line of block.split('\n')) {
+    if (line.startsWith('event:')) type = line.slice(6).trim();
+    else if (line.startsWith('data:')) data.push(line.slice(5).trimStart());
+  }
+  // Comment-only blocks are keep-alives
+  if (!data.length) return null;
+  return { type, data: JSON.parse(data.join('\n')) };
+}
+
+function describeStatus(event) {
+  if (event.is_question === 'request') return 'Working on your request…';
+  if (event.rag_type === 'policy') return 'Checking our policies…';
+  if (event.rag_type === 'database') return 'Looking up your account…';
+  if (event.is_question && event.is_question !== 'yes') return 'Writing a reply…';
+  return null;
+}
+
 function formatTime(value) {
   try {
     return new Intl.DateTimeFormat('en', {